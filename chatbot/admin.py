@@ -1,6 +1,8 @@
 # chatbot/admin.py
 from django.contrib import admin
-from .models import Conversation, Message, Desease, MedicalSummary # <<--- AÑADIR MedicalSummary
+from .models import Conversation, Message, MessageImage, Desease, MedicalSummary, CNNPredictionCache, ChatJob, LLMTurnTelemetry # <<--- AÑADIR MedicalSummary
+from .services.llm_telemetry import daily_percentiles
+from django.conf import settings
 from django.utils.html import format_html
 
 @admin.register(Conversation)
@@ -19,6 +21,14 @@ class ConversationAdmin(admin.ModelAdmin):
     has_summary.short_description = '¿Tiene Resumen?'
 
 
+class MessageImageInline(admin.TabularInline):
+    model = MessageImage
+    extra = 0
+    fields = ('position', 'image', 'cnn_predicted_desease', 'cnn_confidence')
+    readonly_fields = ('position', 'image', 'cnn_predicted_desease', 'cnn_confidence')
+    can_delete = False
+
+
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     # ... (como lo tenías antes está bien, sin cambios necesarios aquí por MedicalSummary) ...
@@ -41,6 +51,7 @@ class MessageAdmin(admin.ModelAdmin):
         ('Contenido del Mensaje', {'fields': ('content', 'image_display_for_detail', 'image')}),
         ('Análisis CNN (si aplica)', {'fields': ('cnn_predicted_desease', 'cnn_confidence')}),
     )
+    inlines = [MessageImageInline]
     def conversation_id_short(self, obj): return str(obj.conversation.id)[:8]
     conversation_id_short.short_description = 'ID Conversación'
     def timestamp_formatted(self, obj):
@@ -117,4 +128,65 @@ class MedicalSummaryAdmin(admin.ModelAdmin):
         if obj.main_complaint:
             return (obj.main_complaint[:75] + '...') if len(obj.main_complaint) > 75 else obj.main_complaint
         return "N/A"
-    main_complaint_preview.short_description = 'Motivo Principal'
\ No newline at end of file
+    main_complaint_preview.short_description = 'Motivo Principal'
+
+
+@admin.register(CNNPredictionCache)
+class CNNPredictionCacheAdmin(admin.ModelAdmin):
+    list_display = ('image_hash_short', 'model_version_short', 'preprocessing_version', 'predicted_index', 'confidence', 'created_at')
+    list_filter = ('model_version', 'preprocessing_version')
+    search_fields = ('image_hash',)
+    readonly_fields = ('image_hash', 'model_version', 'preprocessing_version', 'predicted_index', 'confidence', 'probabilities', 'created_at')
+    list_per_page = 25
+
+    def image_hash_short(self, obj):
+        return obj.image_hash[:12]
+    image_hash_short.short_description = 'Hash Imagen'
+
+    def model_version_short(self, obj):
+        return obj.model_version[:12]
+    model_version_short.short_description = 'Versión Modelo'
+
+
+@admin.register(ChatJob)
+class ChatJobAdmin(admin.ModelAdmin):
+    list_display = ('id_short', 'conversation_id_short', 'status', 'attempts', 'max_attempts', 'locked_by', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('conversation__id__iexact', 'locked_by')
+    readonly_fields = ('id', 'conversation', 'user_message', 'bot_message', 'user_identifier', 'attempts', 'locked_by',
+                       'locked_until', 'last_error', 'created_at', 'started_at', 'finished_at')
+    list_per_page = 25
+
+    def id_short(self, obj):
+        return str(obj.id)[:8]
+    id_short.short_description = 'ID Corto'
+
+    def conversation_id_short(self, obj):
+        return str(obj.conversation_id)[:8]
+    conversation_id_short.short_description = 'ID Conversación'
+
+
+@admin.register(LLMTurnTelemetry)
+class LLMTurnTelemetryAdmin(admin.ModelAdmin):
+    # Arriba de la lista, percentiles diarios (una sola consulta agregada); ordenar por duración muestra los casos atípicos
+    change_list_template = 'admin/chatbot/llmturntelemetry/change_list.html'
+    list_display = ('created_at', 'conversation_id_short', 'call_mode', 'model_name', 'prompt_tokens', 'cached_tokens',
+                    'completion_tokens', 'wall_ms', 'ttft_ms', 'error_class')
+    list_filter = ('call_mode', 'model_name', 'error_class', 'created_at')
+    search_fields = ('conversation__id__iexact', 'error_class')
+    readonly_fields = ('conversation', 'message', 'model_name', 'call_mode', 'prompt_tokens', 'completion_tokens',
+                       'cached_tokens', 'wall_ms', 'ttft_ms', 'error_class', 'created_at')
+    list_select_related = ('conversation',)
+    list_per_page = 50
+
+    def conversation_id_short(self, obj):
+        return str(obj.conversation_id)[:8]
+    conversation_id_short.short_description = 'ID Conversación'
+
+    def has_add_permission(self, request):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['daily_stats'] = daily_percentiles(days=getattr(settings, 'CHATBOT_LLM_TELEMETRY_ADMIN_DAYS', 14))
+        return super().changelist_view(request, extra_context=extra_context)
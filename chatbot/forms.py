@@ -1,5 +1,62 @@
 # chatbot/forms.py
 from django import forms
+from django.conf import settings
+
+from .services.image_pipeline import ImageTooLargeError, StageTimer, decode_for_model
+
+
+class MultipleImageInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleImageField(forms.ImageField):
+    """ImageField que acepta varios archivos y devuelve siempre una lista (vacía si no se subió nada)."""
+
+    def __init__(self, *args, max_files=None, **kwargs):
+        self.max_files = max_files
+        kwargs.setdefault("widget", MultipleImageInput())
+        super().__init__(*args, **kwargs)
+
+    def to_python(self, data):
+        """
+        Reemplaza la validación de ImageField (Image.open + verify) por la decodificación del
+        pipeline de subida: se valida decodificando UNA vez, directo al tamaño del modelo, y la
+        imagen resultante queda en el archivo (model_input_image) para que la CNN la reutilice.
+        """
+        uploaded_file = forms.FileField.to_python(self, data)
+        if uploaded_file is None:
+            return None
+        timer = StageTimer(f"validación de {uploaded_file.name}")
+        try:
+            with timer.stage("decode"):
+                uploaded_file.seek(0)
+                model_input_image = decode_for_model(uploaded_file)
+        except ImageTooLargeError as e:
+            raise forms.ValidationError(str(e), code='image_too_large')
+        except Exception as e:
+            raise forms.ValidationError(self.error_messages['invalid_image'], code='invalid_image') from e
+        finally:
+            if hasattr(uploaded_file, 'seek') and callable(uploaded_file.seek):
+                uploaded_file.seek(0)
+        timer.log()
+        uploaded_file.image = model_input_image
+        uploaded_file.model_input_image = model_input_image
+        return uploaded_file
+
+    def clean(self, data, initial=None):
+        single_image_clean = super().clean
+        if isinstance(data, (list, tuple)):
+            images = [single_image_clean(d, initial) for d in data if d]
+        else:
+            image = single_image_clean(data, initial)
+            images = [image] if image else []
+        if self.max_files and len(images) > self.max_files:
+            raise forms.ValidationError(
+                f"Puedes subir como máximo {self.max_files} imágenes por mensaje.",
+                code='too_many_images'
+            )
+        return images
+
 
 class MessageForm(forms.Form):
     user_input = forms.CharField(
@@ -11,18 +68,19 @@ class MessageForm(forms.Form):
             }),
         required=False
     )
-    image_upload = forms.ImageField(
-        label="Adjuntar Imagen (Opcional)",
+    image_upload = MultipleImageField(
+        label="Adjuntar Imágenes (Opcional, puedes elegir varias de la misma lesión)",
         required=False,
-        widget=forms.ClearableFileInput(attrs={'class': 'form-control-file mt-2 mb-2'})
+        max_files=getattr(settings, 'CHATBOT_MAX_IMAGES_PER_MESSAGE', 5),
+        widget=MultipleImageInput(attrs={'class': 'form-control-file mt-2 mb-2', 'accept': 'image/*'})
     )
 
     def clean(self):
         cleaned_data = super().clean()
         user_input_text = cleaned_data.get("user_input")
-        image = cleaned_data.get("image_upload")
+        images = cleaned_data.get("image_upload")
 
-        if not user_input_text and not image:
+        if not user_input_text and not images and "image_upload" not in self.errors:
             raise forms.ValidationError(
                 "Debes escribir un mensaje o subir una imagen.",
                 code='no_input'
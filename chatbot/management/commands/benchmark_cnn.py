@@ -0,0 +1,162 @@
+# chatbot/management/commands/benchmark_cnn.py
+import json
+import os
+import platform
+import time
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from PIL import Image
+
+from chatbot.management.commands.convert_cnn_model import DEFAULT_SAMPLE_DIR, IMAGE_EXTENSIONS
+from chatbot.services.image_pipeline import decode_for_model
+
+try:
+    import resource # Solo Unix; en Windows no se reporta memoria
+except ImportError:
+    resource = None
+
+
+def _rss_mb():
+    """RSS máximo (pico) del proceso en MB, o None si no se puede medir."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024.0, 1) # Linux reporta KB
+
+
+def _summarize(timings_ms):
+    timings = np.asarray(timings_ms, dtype=np.float64)
+    if not len(timings):
+        return {"n": 0}
+    return {
+        "n": int(len(timings)),
+        "mean_ms": round(float(timings.mean()), 3),
+        "p50_ms": round(float(np.percentile(timings, 50)), 3),
+        "p95_ms": round(float(np.percentile(timings, 95)), 3),
+        "p99_ms": round(float(np.percentile(timings, 99)), 3),
+        "max_ms": round(float(timings.max()), 3),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark reproducible de CNNProcessor: arranque en frío, decodificación, preprocesamiento "
+        "e inferencia por separado, percentiles p50/p95/p99 por tamaño de lote y memoria pico. "
+        "Imprime (o guarda) un JSON para comparar corridas entre modelos o backends."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+        parser.add_argument('--iterations', type=int, default=30, help="Mediciones por tamaño de lote.")
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--sample-dir', default=DEFAULT_SAMPLE_DIR)
+        parser.add_argument('--synthetic-images', type=int, default=16, help="Cantidad de JPEG sintéticos a generar.")
+        parser.add_argument('--synthetic-size', type=int, nargs=2, default=[1600, 1200], metavar=('ANCHO', 'ALTO'))
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help="Archivo JSON de salida (por defecto, stdout).")
+
+    def handle(self, *args, **options):
+        # Import diferido: cargar el modelo es parte de lo que se mide
+        from chatbot.services.cnn_service import CNNProcessor
+
+        rss_before_load = _rss_mb()
+        load_started = time.perf_counter()
+        processor = CNNProcessor.get_instance()
+        load_seconds = time.perf_counter() - load_started
+        if processor.model_cnn is None and processor.model_server_client is None:
+            raise CommandError("El modelo CNN no está cargado; no se puede medir.")
+        rss_after_load = _rss_mb()
+
+        first_input = processor._preprocess_image(Image.new("RGB", (224, 224)))
+        first_started = time.perf_counter()
+        processor._predict_batch(first_input)
+        first_inference_ms = (time.perf_counter() - first_started) * 1000.0
+
+        encoded_images = self._load_encoded_images(options)
+        decode_ms, preprocess_ms, arrays = {}, {}, []
+        for source, images in encoded_images.items():
+            decode_ms[source], preprocess_ms[source] = [], []
+            for image_bytes in images:
+                started = time.perf_counter()
+                img_pil = decode_for_model(image_bytes) # Mismo pipeline que las subidas (draft/reduce)
+                decoded = time.perf_counter()
+                arrays.append(processor._preprocess_image(img_pil))
+                finished = time.perf_counter()
+                decode_ms[source].append((decoded - started) * 1000.0)
+                preprocess_ms[source].append((finished - decoded) * 1000.0)
+        if not arrays:
+            raise CommandError("No hay imágenes para medir (sintéticas ni de muestra).")
+        pool = np.concatenate(arrays, axis=0)
+
+        rng = np.random.default_rng(options['seed'])
+        inference = {}
+        for batch_size in options['batch_sizes']:
+            batch = pool[rng.integers(0, len(pool), size=batch_size)]
+            for _ in range(options['warmup']):
+                processor._predict_batch(batch)
+            timings = []
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                processor._predict_batch(batch)
+                timings.append((time.perf_counter() - started) * 1000.0)
+            summary = _summarize(timings)
+            summary["per_image_p50_ms"] = round(summary["p50_ms"] / batch_size, 3)
+            summary["images_per_second"] = round(1000.0 * batch_size / summary["p50_ms"], 1) if summary["p50_ms"] else None
+            inference[str(batch_size)] = summary
+            self.stderr.write(f"lote={batch_size:>3}  p50={summary['p50_ms']:.1f} ms  p95={summary['p95_ms']:.1f} ms  p99={summary['p99_ms']:.1f} ms")
+
+        backend = processor.model_cnn
+        report = {
+            "timestamp": timezone.now().isoformat(),
+            "environment": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "backend": backend.name if backend is not None else "model_server",
+                "configured_backend": getattr(settings, 'CNN_BACKEND', 'keras'),
+                "model_version": CNNProcessor._model_version,
+            },
+            "config": {key: options[key] for key in ('batch_sizes', 'iterations', 'warmup', 'synthetic_images', 'synthetic_size', 'seed')},
+            "cold_start": {
+                "load_seconds": round(load_seconds, 3),
+                "first_inference_ms": round(first_inference_ms, 3),
+                "rss_before_load_mb": rss_before_load,
+                "rss_after_load_mb": rss_after_load,
+            },
+            "decode": {source: _summarize(timings) for source, timings in decode_ms.items()},
+            "preprocess": {source: _summarize(timings) for source, timings in preprocess_ms.items()},
+            "inference": inference,
+            "peak_rss_mb": _rss_mb(),
+        }
+
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output_file:
+                output_file.write(output)
+            self.stderr.write(self.style.SUCCESS(f"Resultados guardados en {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def _load_encoded_images(self, options):
+        """Bytes JPEG/PNG tal como llegarían en una subida: sintéticos (reproducibles) y de muestra."""
+        rng = np.random.default_rng(options['seed'])
+        width, height = options['synthetic_size']
+        synthetic = []
+        for _ in range(options['synthetic_images']):
+            pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+            buffer = BytesIO()
+            Image.fromarray(pixels, 'RGB').save(buffer, format='JPEG', quality=90)
+            synthetic.append(buffer.getvalue())
+
+        samples = []
+        if options['sample_dir'] and os.path.isdir(options['sample_dir']):
+            for name in sorted(os.listdir(options['sample_dir'])):
+                if any(name.lower().endswith(pattern[1:]) for pattern in IMAGE_EXTENSIONS):
+                    with open(os.path.join(options['sample_dir'], name), 'rb') as sample_file:
+                        samples.append(sample_file.read())
+        return {"synthetic": synthetic, "samples": samples}
@@ -0,0 +1,87 @@
+# chatbot/management/commands/benchmark_cnn_serving.py
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from chatbot.services.cnn_backends import AVAILABLE_BACKENDS, KerasBackend, build_serving_function, load_backend
+from chatbot.services.image_pipeline import MODEL_INPUT_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Latencia por llamada de un backend de inferencia de la CNN, para una sola imagen. Con el "
+        "backend 'keras' compara model.predict contra la función trazada (tf.function); TFLite y "
+        "ONNX Runtime se miden sin tener TensorFlow instalado."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=AVAILABLE_BACKENDS, default=None, help="Por defecto, settings.CNN_BACKEND.")
+        parser.add_argument('--iterations', type=int, default=100, help="Llamadas medidas por cada ruta.")
+        parser.add_argument('--warmup', type=int, default=5, help="Llamadas de calentamiento (no se miden).")
+        parser.add_argument('--image', type=str, default=None, help="Imagen a usar; por defecto una imagen sintética.")
+
+    def handle(self, *args, **options):
+        backend_name = options['backend'] or getattr(settings, 'CNN_BACKEND', 'keras')
+        try:
+            backend = load_backend(backend_name) # Sin CNNProcessor: ni servidor de modelo ni caché de predicciones
+        except Exception as e:
+            raise CommandError(f"No se pudo cargar el backend '{backend_name}': {e}")
+
+        if options['image']:
+            with Image.open(options['image']) as img_pil:
+                resized = img_pil.convert("RGB").resize(MODEL_INPUT_SIZE)
+                input_array = np.expand_dims(np.asarray(resized, dtype=np.float32), axis=0) # Igual que CNNProcessor._preprocess_image
+        else:
+            input_shape = (1,) + tuple(backend.input_shape[1:])
+            input_array = np.random.default_rng(0).uniform(0, 255, size=input_shape).astype(np.float32)
+
+        if not isinstance(backend, KerasBackend):
+            backend_ms = self._measure(lambda: backend.predict(input_array), options['iterations'], options['warmup'])
+            self._report(f"{backend.name}.predict", backend_ms)
+            return
+
+        import tensorflow as tf # Solo la ruta Keras necesita TensorFlow
+
+        keras_model = backend.model
+        serving_function = backend.serving_function or build_serving_function(keras_model)
+
+        predict_ms = self._measure(
+            lambda: keras_model.predict(input_array, verbose=0),
+            options['iterations'], options['warmup'],
+        )
+        input_tensor = tf.constant(input_array, dtype=tf.float32)
+        serving_ms = self._measure(
+            lambda: serving_function(input_tensor).numpy(),
+            options['iterations'], options['warmup'],
+        )
+
+        predict_output = keras_model.predict(input_array, verbose=0)
+        serving_output = serving_function(input_tensor).numpy()
+        max_abs_diff = float(np.max(np.abs(predict_output - serving_output)))
+
+        self._report("model.predict", predict_ms)
+        self._report("tf.function", serving_ms)
+        speedup = np.median(predict_ms) / np.median(serving_ms) if np.median(serving_ms) > 0 else float('inf')
+        self.stdout.write(self.style.SUCCESS(
+            f"Aceleración (p50): x{speedup:.1f} | Diferencia máx. entre salidas: {max_abs_diff:.2e}"
+        ))
+
+    def _measure(self, call, iterations, warmup):
+        for _ in range(warmup):
+            call()
+        timings_ms = []
+        for _ in range(iterations):
+            started_at = time.perf_counter()
+            call()
+            timings_ms.append((time.perf_counter() - started_at) * 1000.0)
+        return np.asarray(timings_ms)
+
+    def _report(self, label, timings_ms):
+        self.stdout.write(
+            f"{label:<15} p50={np.percentile(timings_ms, 50):7.2f} ms  "
+            f"p95={np.percentile(timings_ms, 95):7.2f} ms  "
+            f"media={timings_ms.mean():7.2f} ms  (n={len(timings_ms)})"
+        )
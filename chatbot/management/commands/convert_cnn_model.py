@@ -0,0 +1,140 @@
+# chatbot/management/commands/convert_cnn_model.py
+import glob
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from chatbot.services.cnn_backends import (
+    KerasBackend, ONNXRuntimeBackend, TFLiteBackend, converted_model_path,
+)
+
+DEFAULT_SAMPLE_DIR = os.path.join(settings.MEDIA_ROOT, 'chatbot_images')
+IMAGE_EXTENSIONS = ('*.jpg', '*.jpeg', '*.png', '*.bmp')
+
+
+def load_sample_images(sample_dir, input_shape, limit=None):
+    """Carga y preprocesa (igual que CNNProcessor) las imágenes de muestra de un directorio."""
+    paths = []
+    for pattern in IMAGE_EXTENSIONS:
+        paths.extend(glob.glob(os.path.join(sample_dir, pattern)))
+    paths = sorted(paths)[:limit] if limit else sorted(paths)
+    target_size = (input_shape[2], input_shape[1]) # PIL usa (ancho, alto)
+    arrays = []
+    for path in paths:
+        with Image.open(path) as img_pil:
+            arrays.append(np.asarray(img_pil.convert('RGB').resize(target_size), dtype=np.float32))
+    return paths, (np.stack(arrays) if arrays else np.zeros((0,) + tuple(input_shape[1:]), dtype=np.float32))
+
+
+class Command(BaseCommand):
+    help = (
+        "Convierte el modelo Keras (.h5 + pesos .keras) a TFLite y/o ONNX, con cuantización "
+        "int8 post-entrenamiento opcional, y verifica la paridad de predicciones contra Keras."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--formats', nargs='+', choices=['tflite', 'onnx'], default=['tflite', 'onnx'])
+        parser.add_argument('--int8', action='store_true', help="Cuantización int8 post-entrenamiento (calibrada con las imágenes de muestra).")
+        parser.add_argument('--sample-dir', default=DEFAULT_SAMPLE_DIR, help="Imágenes para calibración y chequeo de paridad.")
+        parser.add_argument('--calibration-samples', type=int, default=100)
+        parser.add_argument('--min-agreement', type=float, default=1.0,
+                            help="Fracción mínima de imágenes con la misma clase top-1 que Keras (1.0 = todas).")
+        parser.add_argument('--skip-parity', action='store_true')
+
+    def handle(self, *args, **options):
+        keras_backend = KerasBackend(use_serving_function=False)
+        input_shape = keras_backend.input_shape
+        sample_paths, sample_batch = load_sample_images(options['sample_dir'], input_shape)
+        if options['int8'] and not len(sample_batch):
+            raise CommandError(f"La cuantización int8 necesita imágenes de calibración en {options['sample_dir']}.")
+        calibration_batch = sample_batch[:options['calibration_samples']]
+
+        for backend_name in options['formats']:
+            output_path = converted_model_path(backend_name, quantized=options['int8'])
+            # CNN_BACKEND=tflite|onnx carga output_path: se convierte al lado y solo se reemplaza si pasa la paridad
+            work_dir = tempfile.mkdtemp(prefix=f'.convert-{backend_name}-', dir=os.path.dirname(output_path) or '.')
+            try:
+                candidate_path = os.path.join(work_dir, os.path.basename(output_path))
+                if backend_name == 'tflite':
+                    self._convert_tflite(keras_backend.model, candidate_path, options['int8'], calibration_batch)
+                    converted_backend = TFLiteBackend(candidate_path)
+                else:
+                    self._convert_onnx(keras_backend.model, candidate_path, options['int8'], calibration_batch, work_dir)
+                    converted_backend = ONNXRuntimeBackend(candidate_path)
+
+                if not options['skip_parity']:
+                    self._check_parity(backend_name, keras_backend, converted_backend, sample_paths, sample_batch, options['min_agreement'])
+                os.replace(candidate_path, output_path)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            size_mb = os.path.getsize(output_path) / (1024 * 1024)
+            self.stdout.write(self.style.SUCCESS(f"[{backend_name}] Modelo guardado en {output_path} ({size_mb:.1f} MB)"))
+
+    def _convert_tflite(self, keras_model, output_path, quantize_int8, calibration_batch):
+        import tensorflow as tf
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+        if quantize_int8:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: ([image[np.newaxis, ...]] for image in calibration_batch)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            # Entrada/salida siguen en float32 para no cambiar el preprocesamiento de CNNProcessor
+        with open(output_path, 'wb') as output_file:
+            output_file.write(converter.convert())
+
+    def _convert_onnx(self, keras_model, output_path, quantize_int8, calibration_batch, work_dir):
+        try:
+            import tensorflow as tf
+            import tf2onnx
+        except ImportError:
+            raise CommandError("Falta la librería 'tf2onnx' (pip install tf2onnx onnxruntime) para exportar a ONNX.")
+
+        input_signature = [tf.TensorSpec((None,) + tuple(keras_model.input_shape[1:]), tf.float32, name='images')]
+        if not quantize_int8:
+            tf2onnx.convert.from_keras(keras_model, input_signature=input_signature, opset=13, output_path=output_path)
+            return
+
+        from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+        float_path = os.path.join(work_dir, 'float32.onnx') # Intermedio: no pisa el .onnx float que se sirve
+        tf2onnx.convert.from_keras(keras_model, input_signature=input_signature, opset=13, output_path=float_path)
+
+        class _SampleReader(CalibrationDataReader):
+            def __init__(self, batch):
+                self._items = iter({'images': image[np.newaxis, ...]} for image in batch)
+
+            def get_next(self):
+                return next(self._items, None)
+
+        quantize_static(float_path, output_path, _SampleReader(calibration_batch),
+                        activation_type=QuantType.QInt8, weight_type=QuantType.QInt8)
+
+    def _check_parity(self, backend_name, keras_backend, converted_backend, sample_paths, sample_batch, min_agreement):
+        if not len(sample_batch):
+            self.stdout.write(self.style.WARNING(f"[{backend_name}] Sin imágenes de muestra: se omite el chequeo de paridad."))
+            return
+
+        reference = np.concatenate([keras_backend.predict(image[np.newaxis, ...]) for image in sample_batch])
+        candidate = np.concatenate([converted_backend.predict(image[np.newaxis, ...]) for image in sample_batch])
+        reference_top1 = np.argmax(reference, axis=1)
+        candidate_top1 = np.argmax(candidate, axis=1)
+        agreement = float(np.mean(reference_top1 == candidate_top1))
+        max_prob_diff = float(np.max(np.abs(reference - candidate)))
+
+        for path, expected, got in zip(sample_paths, reference_top1, candidate_top1):
+            if expected != got:
+                self.stdout.write(self.style.WARNING(f"[{backend_name}] Clase distinta en {os.path.basename(path)}: keras={expected} {backend_name}={got}"))
+
+        summary = (f"[{backend_name}] Paridad top-1: {agreement * 100:.1f}% de {len(sample_batch)} imágenes | "
+                   f"diferencia máx. de probabilidad: {max_prob_diff:.4f}")
+        if agreement < min_agreement:
+            raise CommandError(
+                f"{summary} — por debajo del mínimo requerido ({min_agreement * 100:.1f}%). "
+                f"Se descarta la conversión; el modelo que se sirve no cambió."
+            )
+        self.stdout.write(self.style.SUCCESS(summary))
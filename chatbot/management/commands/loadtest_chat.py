@@ -0,0 +1,126 @@
+# chatbot/management/commands/loadtest_chat.py
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+
+from chatbot.models import Conversation
+from chatbot.services import admission
+from chatbot.services.llm_stub_server import StubLLMServer
+from chatbot.services.model_lifecycle import model_lifecycle
+
+USER_MESSAGE = "Tengo manchas rojas que pican en el antebrazo."
+
+
+class Command(BaseCommand):
+    help = (
+        "Prueba de carga del chat contra un LLM stub local (latencia fija, sin red): N conversaciones "
+        "concurrentes por la vista sync con un pool de hilos tipo WSGI (gthread) y por la vista async "
+        "a través del handler ASGI. Reporta latencias, throughput y cuántas llamadas al LLM llegaron a "
+        "estar en vuelo a la vez."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64], help="Conversaciones simultáneas por corrida.")
+        parser.add_argument('--llm-delay', type=float, default=1.0, help="Segundos que tarda el stub en responder.")
+        parser.add_argument('--wsgi-threads', type=int, default=8, help="Hilos del worker WSGI emulado.")
+        parser.add_argument('--modes', nargs='+', choices=['wsgi', 'asgi'], default=['wsgi', 'asgi'])
+        parser.add_argument('--output', default=None, help="Archivo JSON con los resultados.")
+        parser.add_argument('--keep-data', action='store_true', help="No borrar las conversaciones creadas.")
+
+    def handle(self, *args, **options):
+        from chatbot.services.openai_agent_service import DermaBotAgent
+
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, 'testserver'] # Host de Client/AsyncClient
+        created_ids = []
+        results = []
+        # Se mide la capacidad de las vistas: sin el token bucket por sesión (todos los clientes de prueba
+        # comparten la IP 127.0.0.1) ni el tope de turnos del LLM, y con el turno completo dentro de la petición
+        no_admission_limits = override_settings(
+            CHATBOT_SESSION_TURNS_PER_MINUTE=0,
+            CHATBOT_LLM_MAX_IN_FLIGHT=0,
+            CHATBOT_BACKGROUND_JOBS=False,
+        )
+        with StubLLMServer(delay_seconds=options['llm_delay']) as stub, no_admission_limits:
+            settings.OPENAI_BASE_URL = stub.base_url
+            settings.OPENAI_API_KEY = getattr(settings, 'OPENAI_API_KEY', None) or 'sk-stub'
+            admission.reset_limiters() # Los limitadores se arman con los settings de arriba
+            model_lifecycle.use_models(derma_agent=DermaBotAgent()) # Agente nuevo apuntado al stub; sin CNN
+
+            try:
+                for concurrency in options['concurrency']:
+                    for mode in options['modes']:
+                        conversations = [Conversation.objects.create() for _ in range(concurrency)]
+                        created_ids.extend(conversation.id for conversation in conversations)
+                        stub.reset_counters()
+                        if mode == 'wsgi':
+                            outcomes, wall_seconds = self._run_wsgi(conversations, options['wsgi_threads'])
+                        else:
+                            outcomes, wall_seconds = asyncio.run(self._run_asgi(conversations))
+                        result = self._summarize(mode, concurrency, outcomes, wall_seconds, stub)
+                        results.append(result)
+                        self.stdout.write(
+                            f"{mode:>4}  conversaciones={concurrency:>3}  ok={result['ok']:>3}  errores={result['errors']:>3}  "
+                            f"p50={result['latency_p50_s']:.2f} s  p95={result['latency_p95_s']:.2f} s  "
+                            f"{result['conversations_per_second']:.1f} conv/s  LLM en vuelo (máx)={result['llm_max_in_flight']}"
+                        )
+            finally:
+                admission.reset_limiters()
+                if not options['keep_data']:
+                    Conversation.objects.filter(id__in=created_ids).delete()
+
+        if options['output']:
+            config = {key: options[key] for key in ('concurrency', 'llm_delay', 'wsgi_threads', 'modes')}
+            with open(options['output'], 'w', encoding='utf-8') as output_file:
+                json.dump({"config": config, "results": results}, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Resultados guardados en {options['output']}"))
+
+    def _run_wsgi(self, conversations, threads):
+        """Vista sync: cada petición ocupa un hilo del pool durante toda la llamada al LLM."""
+        batch_started = time.perf_counter()
+
+        def post_turn(conversation):
+            try:
+                response = Client().post(reverse('chatbot:chat_window', args=[conversation.id]), {'user_input': USER_MESSAGE})
+                return time.perf_counter() - batch_started, response.status_code
+            finally:
+                connection.close() # Conexión propia de este hilo del pool
+
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi-worker') as pool:
+            outcomes = list(pool.map(post_turn, conversations))
+        return outcomes, time.perf_counter() - batch_started
+
+    async def _run_asgi(self, conversations):
+        """Vista async a través del handler ASGI: las esperas al LLM comparten un solo event loop."""
+        batch_started = time.perf_counter()
+
+        async def post_turn(conversation):
+            response = await AsyncClient().post(reverse('chatbot:chat_window_async', args=[conversation.id]), {'user_input': USER_MESSAGE})
+            return time.perf_counter() - batch_started, response.status_code
+
+        outcomes = await asyncio.gather(*(post_turn(conversation) for conversation in conversations))
+        return outcomes, time.perf_counter() - batch_started
+
+    def _summarize(self, mode, concurrency, outcomes, wall_seconds, stub):
+        # La latencia se cuenta desde el inicio de la tanda: incluye la espera por un hilo libre
+        latencies = np.asarray([latency for latency, status in outcomes if status == 302])
+        ok = len(latencies)
+        return {
+            "mode": mode,
+            "concurrency": concurrency,
+            "ok": ok,
+            "errors": len(outcomes) - ok,
+            "wall_seconds": round(wall_seconds, 3),
+            "conversations_per_second": round(ok / wall_seconds, 2) if wall_seconds else 0.0,
+            "latency_p50_s": round(float(np.percentile(latencies, 50)), 3) if ok else 0.0,
+            "latency_p95_s": round(float(np.percentile(latencies, 95)), 3) if ok else 0.0,
+            "llm_requests": stub.requests,
+            "llm_max_in_flight": stub.max_in_flight,
+        }
@@ -0,0 +1,131 @@
+# chatbot/management/commands/loadtest_llm_transport.py
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+from django.core.management.base import BaseCommand
+from langchain_core.messages import HumanMessage
+from langchain_openai import ChatOpenAI
+
+from chatbot.services.llm_stub_server import StubLLMServer
+from chatbot.services.llm_transport import LLMTransportPolicy, build_clients
+
+USER_MESSAGE = "¿Qué es la dermatitis atópica?"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara el transporte HTTP del LLM contra un stub local que inyecta latencia y errores: "
+        "cliente por defecto de la librería, pool compartido con plazo y reintentos con jitter, y "
+        "lo mismo con hedging tras el p95. Reporta p50/p95/p99/máx, errores, reintentos y réplicas."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200, help="Llamadas al LLM por modo.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Llamadas simultáneas.")
+        parser.add_argument('--llm-delay', type=float, default=0.2, help="Latencia normal del stub (s).")
+        parser.add_argument('--slow-rate', type=float, default=0.04, help="Fracción de respuestas lentas.")
+        parser.add_argument('--slow-delay', type=float, default=5.0, help="Latencia de las respuestas lentas (s).")
+        parser.add_argument('--error-rate', type=float, default=0.05, help="Fracción de respuestas 503.")
+        parser.add_argument('--deadline', type=float, default=8.0, help="Plazo por llamada del transporte propio (s).")
+        parser.add_argument('--max-retries', type=int, default=2)
+        parser.add_argument('--modes', nargs='+', choices=['default', 'pooled', 'hedged'], default=['default', 'pooled', 'hedged'])
+        parser.add_argument('--seed', type=int, default=7)
+        parser.add_argument('--output', default=None, help="Archivo JSON con los resultados.")
+
+    def handle(self, *args, **options):
+        results = []
+        for mode in options['modes']:
+            stub = StubLLMServer(
+                delay_seconds=options['llm_delay'], slow_rate=options['slow_rate'], slow_delay_seconds=options['slow_delay'],
+                error_rate=options['error_rate'], seed=options['seed'],
+            )
+            with stub:
+                chat_model, policy, clients = self._build_model(mode, stub.base_url, options)
+                try:
+                    self._run_calls(chat_model, 40, options['concurrency']) # Calentamiento: conexiones y latencias para el p95
+                    # Los contadores del stub y de la política se miden desde acá; las latencias del calentamiento se quedan para el p95
+                    stub.reset_counters()
+                    warmup_metrics = policy.get_metrics() if policy is not None else None
+                    outcomes, wall_seconds = self._run_calls(chat_model, options['calls'], options['concurrency'])
+                finally:
+                    for client in clients:
+                        if isinstance(client, httpx.AsyncClient):
+                            asyncio.run(client.aclose())
+                        else:
+                            client.close()
+                result = self._summarize(mode, outcomes, wall_seconds, stub, policy, warmup_metrics)
+            results.append(result)
+            self.stdout.write(
+                f"{mode:>7}  ok={result['ok']:>4}  errores={result['errors']:>3}  p50={result['latency_p50_s']:.2f} s  "
+                f"p95={result['latency_p95_s']:.2f} s  p99={result['latency_p99_s']:.2f} s  máx={result['latency_max_s']:.2f} s  "
+                f"peticiones al stub={result['llm_requests']} (lentas={result['slow_injected']}, 503={result['errors_injected']})  "
+                f"reintentos={result.get('retries', '-')}  réplicas={result.get('hedges', '-')} (ganaron {result.get('hedge_wins', '-')})"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output_file:
+                json.dump({"config": {key: options[key] for key in ('calls', 'concurrency', 'llm_delay', 'slow_rate', 'slow_delay', 'error_rate', 'deadline', 'max_retries')}, "results": results}, output_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Resultados guardados en {options['output']}"))
+
+    def _build_model(self, mode, base_url, options):
+        """(ChatOpenAI, policy o None, clientes httpx a cerrar) para el modo."""
+        if mode == 'default':
+            return ChatOpenAI(model="gpt-4o-mini", api_key='sk-stub', base_url=base_url, max_tokens=100), None, []
+        policy = LLMTransportPolicy(
+            deadline_seconds=options['deadline'],
+            max_retries=options['max_retries'],
+            retry_backoff_seconds=0.1,
+            hedging_enabled=(mode == 'hedged'),
+            hedge_min_samples=20,
+        )
+        _, sync_client, async_client = build_clients(policy, max_connections=max(20, options['concurrency'] * 2))
+        chat_model = ChatOpenAI(
+            model="gpt-4o-mini", api_key='sk-stub', base_url=base_url, max_tokens=100,
+            http_client=sync_client, http_async_client=async_client, timeout=policy.deadline_seconds, max_retries=0,
+        )
+        return chat_model, policy, [sync_client, async_client]
+
+    def _run_calls(self, chat_model, calls, concurrency):
+        batch_started = time.perf_counter()
+
+        def call_llm(_):
+            started_at = time.perf_counter()
+            try:
+                chat_model.invoke([HumanMessage(content=USER_MESSAGE)])
+                return time.perf_counter() - started_at, None
+            except Exception as e:
+                return time.perf_counter() - started_at, type(e).__name__
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='llm-load') as pool:
+            outcomes = list(pool.map(call_llm, range(calls)))
+        return outcomes, time.perf_counter() - batch_started
+
+    def _summarize(self, mode, outcomes, wall_seconds, stub, policy, warmup_metrics=None):
+        latencies = np.asarray([latency for latency, error in outcomes if error is None])
+        errors = [error for _, error in outcomes if error is not None]
+        ok = len(latencies)
+        result = {
+            "mode": mode,
+            "ok": ok,
+            "errors": len(errors),
+            "error_types": sorted(set(errors)),
+            "wall_seconds": round(wall_seconds, 3),
+            "latency_p50_s": round(float(np.percentile(latencies, 50)), 3) if ok else 0.0,
+            "latency_p95_s": round(float(np.percentile(latencies, 95)), 3) if ok else 0.0,
+            "latency_p99_s": round(float(np.percentile(latencies, 99)), 3) if ok else 0.0,
+            "latency_max_s": round(float(latencies.max()), 3) if ok else 0.0,
+            "llm_requests": stub.requests,
+            "slow_injected": stub.slow_injected,
+            "errors_injected": stub.errors_injected,
+        }
+        if policy is not None:
+            metrics = policy.get_metrics()
+            result.update({
+                key: metrics[key] - (warmup_metrics[key] if warmup_metrics else 0)
+                for key in ('attempts', 'retries', 'hedges', 'hedge_wins', 'deadline_exceeded')
+            })
+        return result
@@ -0,0 +1,166 @@
+# chatbot/management/commands/rescore_images.py
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from chatbot.models import Message, MessageImage
+from chatbot.services.cnn_service import CNNProcessor
+from chatbot.services.desease_index import desease_index
+from chatbot.services.image_pipeline import decode_for_model
+
+DEFAULT_CHECKPOINT_PATH = os.path.join(settings.BASE_DIR, '.rescore_images_checkpoint.json')
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcula cnn_predicted_desease y cnn_confidence de los mensajes con imagen usando el "
+        "modelo actual: cada MessageImage y la predicción agregada del Message (promedio de las "
+        "probabilidades, igual que en el chat). Recorre la BD en streaming, decodifica en un pool "
+        "de hilos, infiere por lotes, guarda con bulk_update y deja un checkpoint para poder reanudar."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Filas por lectura de la BD (iterator).")
+        parser.add_argument('--batch-size', type=int, default=32, help="Imágenes por forward pass (se agrupan mensajes completos).")
+        parser.add_argument('--workers', type=int, default=4, help="Hilos para leer y decodificar imágenes.")
+        parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH, help="Archivo JSON de checkpoint.")
+        parser.add_argument('--resume', action='store_true', help="Continuar desde el último checkpoint (mismo modelo).")
+        parser.add_argument('--limit', type=int, default=None, help="Procesar como máximo N mensajes.")
+        parser.add_argument('--dry-run', action='store_true', help="Inferir pero no escribir en la BD.")
+
+    def handle(self, *args, **options):
+        processor = CNNProcessor.get_instance()
+        if processor.model_cnn is None and processor.model_server_client is None:
+            raise CommandError("El modelo CNN no está cargado; no se puede re-puntuar.")
+        model_version = CNNProcessor._model_version
+
+        start_after_id = 0
+        processed_before = 0
+        if options['resume']:
+            checkpoint = self._read_checkpoint(options['checkpoint'])
+            if checkpoint and checkpoint.get('model_version') == model_version:
+                start_after_id = checkpoint['last_id']
+                processed_before = checkpoint.get('processed', 0)
+                self.stdout.write(f"Reanudando después del mensaje id={start_after_id} ({processed_before} ya procesados).")
+            elif checkpoint:
+                self.stdout.write(self.style.WARNING("El checkpoint es de otra versión del modelo: se empieza desde cero."))
+
+        messages = (
+            Message.objects.filter(id__gt=start_after_id)
+            .filter(Q(images__isnull=False) | (Q(image__isnull=False) & ~Q(image='')))
+            .distinct()
+            .order_by('id')
+            .only('id', 'image')
+            .prefetch_related('images')
+            .iterator(chunk_size=options['chunk_size'])
+        )
+        if options['limit']:
+            messages = itertools.islice(messages, options['limit'])
+        batches = self._batches_of_images(messages, options['batch_size'])
+
+        processed = failed = 0
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='rescore-decode') as pool:
+            # Se decodifica el lote siguiente mientras se infiere el actual: en memoria hay como máximo 2 lotes
+            pending = self._submit_decode(pool, processor, next(batches, None))
+            while pending is not None:
+                batch_messages, decode_futures = pending
+                pending = self._submit_decode(pool, processor, next(batches, None))
+
+                # (mensaje, MessageImage o None si es un mensaje viejo sin filas MessageImage, array)
+                decoded = [(message, message_image, future.result()) for message, message_image, future in decode_futures]
+                ready = [item for item in decoded if item[2] is not None]
+                failed += len(decoded) - len(ready)
+
+                updated_messages, updated_images = self._apply_predictions(processor, ready)
+                if not options['dry_run']:
+                    if updated_images:
+                        MessageImage.objects.bulk_update(updated_images, ['cnn_predicted_desease', 'cnn_confidence'])
+                    if updated_messages:
+                        Message.objects.bulk_update(updated_messages, ['cnn_predicted_desease', 'cnn_confidence'])
+
+                processed += len(ready)
+                if not options['dry_run']:
+                    self._write_checkpoint(options['checkpoint'], model_version, batch_messages[-1].id, processed_before + processed)
+
+                elapsed = time.perf_counter() - started_at
+                self.stdout.write(
+                    f"Procesadas {processed} imágenes (fallidas {failed}) - último mensaje id={batch_messages[-1].id} - "
+                    f"{processed / elapsed if elapsed else 0.0:.1f} imágenes/s"
+                )
+
+        elapsed = time.perf_counter() - started_at
+        self.stdout.write(self.style.SUCCESS(
+            f"Listo: {processed} imágenes re-puntuadas, {failed} fallidas, en {elapsed:.1f} s "
+            f"({processed / elapsed if elapsed else 0.0:.1f} imágenes/s)."
+        ))
+
+    def _batches_of_images(self, messages, batch_size):
+        """Lotes de mensajes completos con unas batch_size imágenes en total (un mensaje no se parte entre lotes)."""
+        batch, image_count = [], 0
+        for message in messages:
+            batch.append(message)
+            image_count += len(message.images.all()) or 1
+            if image_count >= batch_size:
+                yield batch
+                batch, image_count = [], 0
+        if batch:
+            yield batch
+
+    def _apply_predictions(self, processor, ready):
+        """Asigna la predicción a cada MessageImage y la agregada a cada Message. Devuelve (mensajes, imágenes) a guardar."""
+        if not ready:
+            return [], []
+        predictions = processor._predict_batch(np.concatenate([array for _, _, array in ready]))
+        probabilities_by_message = {}
+        updated_messages, updated_images = {}, []
+        for (message, message_image, _), probabilities in zip(ready, predictions):
+            if message_image is not None:
+                message_image.cnn_predicted_desease = desease_index.get(int(np.argmax(probabilities)))
+                message_image.cnn_confidence = float(np.max(probabilities) * 100)
+                updated_images.append(message_image)
+            probabilities_by_message.setdefault(message.id, []).append(probabilities)
+            updated_messages[message.id] = message
+        for message_id, message in updated_messages.items():
+            # Misma agregación que el chat (CNNProcessor.predict_from_image_files)
+            message.cnn_predicted_desease, message.cnn_confidence = processor.aggregate_prediction(probabilities_by_message[message_id])
+        return list(updated_messages.values()), updated_images
+
+    def _submit_decode(self, pool, processor, batch_messages):
+        if not batch_messages:
+            return None
+        decode_futures = []
+        for message in batch_messages:
+            message_images = list(message.images.all())
+            # Mensajes anteriores a MessageImage: su única imagen es Message.image
+            sources = [(message_image, message_image.image) for message_image in message_images] or [(None, message.image)]
+            for message_image, image_field in sources:
+                decode_futures.append((message, message_image, pool.submit(self._load_image_array, processor, message, image_field)))
+        return batch_messages, decode_futures
+
+    def _load_image_array(self, processor, message, image_field):
+        try:
+            with image_field.open('rb') as image_file:
+                return processor._preprocess_image(decode_for_model(image_file.read()))
+        except Exception as e:
+            print(f"--- RESCORE ERROR: No se pudo leer la imagen del mensaje {message.id} ({image_field.name}): {e}")
+            return None
+
+    def _read_checkpoint(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    def _write_checkpoint(self, path, model_version, last_id, processed):
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump({'model_version': model_version, 'last_id': last_id, 'processed': processed}, checkpoint_file)
+        os.replace(temporary_path, path) # Escritura atómica: un corte no deja el checkpoint a medias
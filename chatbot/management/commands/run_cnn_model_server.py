@@ -0,0 +1,28 @@
+# chatbot/management/commands/run_cnn_model_server.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.services.cnn_model_server import CNNModelServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Inicia el servidor de inferencia CNN en un socket Unix local. Los workers de Django "
+        "con CNN_MODEL_SERVER_SOCKET configurado le envían los tensores por memoria compartida."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=getattr(settings, 'CNN_MODEL_SERVER_SOCKET', None) or '/tmp/dermabot_cnn.sock')
+        parser.add_argument('--max-batch-size', type=int, default=getattr(settings, 'CNN_BATCH_MAX_SIZE', 16))
+        parser.add_argument('--max-wait-ms', type=float, default=getattr(settings, 'CNN_BATCH_MAX_WAIT_MS', 5.0))
+
+    def handle(self, *args, **options):
+        server = CNNModelServer(
+            options['socket'],
+            max_batch_size=options['max_batch_size'],
+            max_wait_ms=options['max_wait_ms'],
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write("Servidor de modelo detenido.")
@@ -0,0 +1,52 @@
+# chatbot/management/commands/run_dermabot_worker.py
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.chat_jobs import ChatJobWorker
+from chatbot.services.model_lifecycle import model_lifecycle
+
+
+class Command(BaseCommand):
+    help = (
+        "Worker de la cola de trabajos del chat (tabla ChatJob): corre la CNN y el agente LLM fuera "
+        "de la petición HTTP y completa el mensaje pendiente del bot. Se pueden levantar varios "
+        "workers contra la misma BD (SQLite o Postgres)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'CHATBOT_WORKER_CONCURRENCY', 4), help="Trabajos en paralelo en este worker.")
+        parser.add_argument('--visibility-timeout', type=int, default=getattr(settings, 'CHATBOT_JOB_VISIBILITY_TIMEOUT_SECONDS', 300), help="Segundos de bloqueo de un trabajo tomado.")
+        parser.add_argument('--poll-interval', type=float, default=getattr(settings, 'CHATBOT_WORKER_POLL_SECONDS', 1.0), help="Segundos entre consultas a la cola vacía.")
+        parser.add_argument('--worker-id', default=None, help="Nombre del worker (por defecto uno aleatorio).")
+        parser.add_argument('--until-empty', action='store_true', help="Procesar lo que haya en la cola y terminar.")
+
+    def handle(self, *args, **options):
+        model_lifecycle.start_background_load() # Los comandos de manage.py no precargan los modelos
+        model_lifecycle.wait_until_loaded()
+        if model_lifecycle.derma_agent is None:
+            raise CommandError(f"El agente LLM no se pudo cargar: {model_lifecycle.errors}")
+
+        worker = ChatJobWorker(
+            worker_id=options['worker_id'],
+            concurrency=options['concurrency'],
+            visibility_timeout_seconds=options['visibility_timeout'],
+            poll_interval_seconds=options['poll_interval'],
+        )
+        stop_event = threading.Event()
+
+        def request_stop(signum, frame):
+            self.stdout.write("Deteniendo: se terminan los trabajos en curso y no se toman nuevos...")
+            stop_event.set()
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+
+        worker.run(stop_event=stop_event, until_empty=options['until_empty'])
+        metrics = worker.get_metrics()
+        self.stdout.write(self.style.SUCCESS(
+            f"Worker {metrics['worker_id']} detenido: {metrics['done']} terminados, {metrics['retried']} reintentos, "
+            f"{metrics['failed']} fallidos, {metrics['leases_lost']} bloqueos perdidos."
+        ))
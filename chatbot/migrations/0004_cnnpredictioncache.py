@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_medicalsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CNNPredictionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_hash', models.CharField(db_index=True, max_length=64, verbose_name='Hash del Contenido (xxhash)')),
+                ('model_version', models.CharField(help_text='Hash de los archivos .h5/.keras; al cambiarlos, las entradas viejas dejan de usarse.', max_length=64, verbose_name='Versión del Modelo CNN')),
+                ('predicted_index', models.IntegerField(verbose_name='Índice Predicho')),
+                ('confidence', models.FloatField(verbose_name='Confianza (%)')),
+                ('probabilities', models.JSONField(blank=True, null=True, verbose_name='Vector de Probabilidades')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Fecha de Creación')),
+            ],
+            options={
+                'verbose_name': 'Predicción CNN en Caché',
+                'verbose_name_plural': 'Predicciones CNN en Caché',
+                'ordering': ['-created_at'],
+                'unique_together': {('image_hash', 'model_version')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-18 09:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_cnnpredictioncache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField(default=0, verbose_name='Orden en el Mensaje')),
+                ('image', models.ImageField(upload_to='chatbot_images/', verbose_name='Imagen')),
+                ('cnn_confidence', models.FloatField(blank=True, null=True, verbose_name='Confianza CNN (%)')),
+                ('cnn_predicted_desease', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='chatbot.desease', verbose_name='Enfermedad Sugerida por CNN (esta imagen)')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='images', to='chatbot.message', verbose_name='Mensaje')),
+            ],
+            options={
+                'verbose_name': 'Imagen de Mensaje',
+                'verbose_name_plural': 'Imágenes de Mensajes',
+                'ordering': ['message', 'position'],
+            },
+        ),
+    ]
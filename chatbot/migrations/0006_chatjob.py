@@ -0,0 +1,42 @@
+# Generated by Django 5.2.3 on 2026-10-18 09:59
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_messageimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('user_identifier', models.CharField(max_length=150, verbose_name='Identificador de Usuario')),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('running', 'En proceso'), ('done', 'Terminado'), ('failed', 'Fallido')], db_index=True, default='pending', max_length=10, verbose_name='Estado')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Intentos')),
+                ('max_attempts', models.PositiveSmallIntegerField(default=3, verbose_name='Máximo de Intentos')),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Disponible Desde')),
+                ('locked_by', models.CharField(blank=True, default='', max_length=100, verbose_name='Worker')),
+                ('locked_until', models.DateTimeField(blank=True, help_text='Timeout de visibilidad: pasado este momento otro worker puede retomar el trabajo.', null=True, verbose_name='Bloqueado Hasta')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Último Error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Fecha de Creación')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Inicio del Último Intento')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Fecha de Término')),
+                ('bot_message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='chat_job', to='chatbot.message', verbose_name='Mensaje del Bot (pendiente hasta que termine)')),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_jobs', to='chatbot.conversation', verbose_name='Conversación')),
+                ('user_message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chatbot.message', verbose_name='Mensaje del Usuario')),
+            ],
+            options={
+                'verbose_name': 'Trabajo de Chat en Cola',
+                'verbose_name_plural': 'Trabajos de Chat en Cola',
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='chatjob_status_available_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_chatjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMTurnTelemetry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(blank=True, default='', max_length=64, verbose_name='Modelo')),
+                ('call_mode', models.CharField(choices=[('sync', 'Sync (get_response)'), ('async', 'Async (aget_response)'), ('stream', 'Stream (stream_response)')], default='sync', max_length=8, verbose_name='Modo')),
+                ('prompt_tokens', models.PositiveIntegerField(default=0, verbose_name='Tokens de Prompt')),
+                ('completion_tokens', models.PositiveIntegerField(default=0, verbose_name='Tokens de Respuesta')),
+                ('cached_tokens', models.PositiveIntegerField(default=0, verbose_name='Tokens en Caché del Proveedor')),
+                ('wall_ms', models.PositiveIntegerField(verbose_name='Duración (ms)')),
+                ('ttft_ms', models.PositiveIntegerField(blank=True, help_text='Solo en modo stream; sin stream la respuesta llega entera.', null=True, verbose_name='Primer Token (ms)')),
+                ('error_class', models.CharField(blank=True, db_index=True, default='', max_length=64, verbose_name='Clase de Error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Fecha')),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='llm_telemetry', to='chatbot.conversation', verbose_name='Conversación')),
+                ('message', models.ForeignKey(blank=True, help_text='Se enlaza cuando la vista (o el worker) guarda la respuesta del bot.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='llm_telemetry', to='chatbot.message', verbose_name='Mensaje del Bot')),
+            ],
+            options={
+                'verbose_name': 'Telemetría de Llamada al LLM',
+                'verbose_name_plural': 'Telemetría de Llamadas al LLM',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0007_llmturntelemetry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='history_summary',
+            field=models.TextField(blank=True, default='', verbose_name='Resumen del Historial'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='history_summary_messages',
+            field=models.PositiveIntegerField(default=0, verbose_name='Mensajes Cubiertos por el Resumen'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.3 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_conversation_history_summary'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='cnnpredictioncache',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='cnnpredictioncache',
+            name='preprocessing_version',
+            field=models.CharField(blank=True, default='', help_text='image_pipeline.PREPROCESSING_VERSION: la misma imagen decodificada de otra forma da otra entrada al modelo.', max_length=32, verbose_name='Versión del Preprocesamiento'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cnnpredictioncache',
+            unique_together={('image_hash', 'model_version', 'preprocessing_version')},
+        ),
+    ]
@@ -61,6 +61,17 @@ class Conversation(models.Model):
         verbose_name="Fecha de Creación"
     )
     # user_identifier_in_session = models.CharField(max_length=100, blank=True, null=True, verbose_name="Identificador de Usuario (Sesión)")
+    # Resumen rodante del historial (ConversationContextManager) y cuántos mensajes de la BD ya cubre:
+    # al reconstruir la memoria del hilo en otro worker se parte de aquí en vez de volver a resumir todo
+    history_summary = models.TextField(
+        blank=True,
+        default="",
+        verbose_name="Resumen del Historial"
+    )
+    history_summary_messages = models.PositiveIntegerField(
+        default=0,
+        verbose_name="Mensajes Cubiertos por el Resumen"
+    )
 
 
     def __str__(self):
@@ -132,6 +143,33 @@ class Message(models.Model):
             base_str += f" (CNN Sugiere: {self.cnn_predicted_desease.name_desease}{conf_str})"
         return base_str + ("..." if len(self.content or "") > 50 else "")
 
+# --- Imágenes de un mensaje (un mensaje puede traer varias fotos de la misma lesión) ---
+class MessageImage(models.Model):
+    message = models.ForeignKey(
+        Message,
+        related_name='images',
+        on_delete=models.CASCADE,
+        verbose_name="Mensaje"
+    )
+    position = models.PositiveSmallIntegerField(default=0, verbose_name="Orden en el Mensaje")
+    image = models.ImageField(upload_to='chatbot_images/', verbose_name="Imagen")
+    cnn_predicted_desease = models.ForeignKey(
+        Desease,
+        verbose_name='Enfermedad Sugerida por CNN (esta imagen)',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL
+    )
+    cnn_confidence = models.FloatField(null=True, blank=True, verbose_name="Confianza CNN (%)")
+
+    class Meta:
+        ordering = ['message', 'position']
+        verbose_name = "Imagen de Mensaje"
+        verbose_name_plural = "Imágenes de Mensajes"
+
+    def __str__(self):
+        return f"Imagen {self.position + 1} del mensaje {self.message_id}: {os.path.basename(self.image.name or '')}"
+
 # --- NUEVO MODELO: MedicalSummary ---
 class MedicalSummary(models.Model):
     conversation = models.OneToOneField(
@@ -168,4 +206,145 @@ class MedicalSummary(models.Model):
     class Meta:
         verbose_name = "Resumen de Conversación (Ficha Preliminar IA)"
         verbose_name_plural = "Resúmenes de Conversación (Fichas Preliminares IA)"
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+
+# --- Caché persistente de predicciones CNN (por contenido de la imagen) ---
+class CNNPredictionCache(models.Model):
+    image_hash = models.CharField(
+        max_length=64, db_index=True,
+        verbose_name="Hash del Contenido (xxhash)"
+    )
+    model_version = models.CharField(
+        max_length=64,
+        verbose_name="Versión del Modelo CNN",
+        help_text="Hash de los archivos .h5/.keras; al cambiarlos, las entradas viejas dejan de usarse."
+    )
+    preprocessing_version = models.CharField(
+        max_length=32, default='', blank=True,
+        verbose_name="Versión del Preprocesamiento",
+        help_text="image_pipeline.PREPROCESSING_VERSION: la misma imagen decodificada de otra forma da otra entrada al modelo."
+    )
+    predicted_index = models.IntegerField(verbose_name="Índice Predicho")
+    confidence = models.FloatField(verbose_name="Confianza (%)")
+    probabilities = models.JSONField(
+        null=True, blank=True,
+        verbose_name="Vector de Probabilidades"
+    )
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de Creación")
+
+    def __str__(self):
+        return f"{self.image_hash[:12]} @ {self.model_version[:8]} -> {self.predicted_index} ({self.confidence:.1f}%)"
+
+    class Meta:
+        verbose_name = "Predicción CNN en Caché"
+        verbose_name_plural = "Predicciones CNN en Caché"
+        unique_together = ('image_hash', 'model_version', 'preprocessing_version')
+        ordering = ['-created_at']
+
+# --- Cola de trabajos del chat en la BD (CNN + LLM fuera de la petición HTTP; ver chatbot/services/chat_jobs.py) ---
+class ChatJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pendiente'),
+        (STATUS_RUNNING, 'En proceso'),
+        (STATUS_DONE, 'Terminado'),
+        (STATUS_FAILED, 'Fallido'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    conversation = models.ForeignKey(
+        Conversation,
+        related_name='chat_jobs',
+        on_delete=models.CASCADE,
+        verbose_name="Conversación"
+    )
+    user_message = models.ForeignKey(
+        Message,
+        related_name='+',
+        on_delete=models.CASCADE,
+        verbose_name="Mensaje del Usuario"
+    )
+    bot_message = models.OneToOneField(
+        Message,
+        related_name='chat_job',
+        on_delete=models.CASCADE,
+        verbose_name="Mensaje del Bot (pendiente hasta que termine)"
+    )
+    user_identifier = models.CharField(max_length=150, verbose_name="Identificador de Usuario")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True, verbose_name="Estado")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="Intentos")
+    max_attempts = models.PositiveSmallIntegerField(default=3, verbose_name="Máximo de Intentos")
+    available_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="Disponible Desde")
+    locked_by = models.CharField(max_length=100, blank=True, default='', verbose_name="Worker")
+    locked_until = models.DateTimeField(
+        null=True, blank=True,
+        verbose_name="Bloqueado Hasta",
+        help_text="Timeout de visibilidad: pasado este momento otro worker puede retomar el trabajo."
+    )
+    last_error = models.TextField(blank=True, default='', verbose_name="Último Error")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Fecha de Creación")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Inicio del Último Intento")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Fecha de Término")
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    def __str__(self):
+        return f"Trabajo {str(self.id)[:8]} ({self.status}, intento {self.attempts}/{self.max_attempts})"
+
+    class Meta:
+        verbose_name = "Trabajo de Chat en Cola"
+        verbose_name_plural = "Trabajos de Chat en Cola"
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'available_at'], name='chatjob_status_available_idx')]
+
+# --- Telemetría por llamada al LLM (tokens y latencias de cada turno; ver chatbot/services/llm_telemetry.py) ---
+class LLMTurnTelemetry(models.Model):
+    MODE_SYNC = 'sync'
+    MODE_ASYNC = 'async'
+    MODE_STREAM = 'stream'
+    MODE_CHOICES = [
+        (MODE_SYNC, 'Sync (get_response)'),
+        (MODE_ASYNC, 'Async (aget_response)'),
+        (MODE_STREAM, 'Stream (stream_response)'),
+    ]
+
+    conversation = models.ForeignKey(
+        Conversation,
+        related_name='llm_telemetry',
+        on_delete=models.CASCADE,
+        verbose_name="Conversación"
+    )
+    message = models.ForeignKey(
+        Message,
+        related_name='llm_telemetry',
+        on_delete=models.SET_NULL,
+        null=True, blank=True,
+        verbose_name="Mensaje del Bot",
+        help_text="Se enlaza cuando la vista (o el worker) guarda la respuesta del bot."
+    )
+    model_name = models.CharField(max_length=64, blank=True, default='', verbose_name="Modelo")
+    call_mode = models.CharField(max_length=8, choices=MODE_CHOICES, default=MODE_SYNC, verbose_name="Modo")
+    prompt_tokens = models.PositiveIntegerField(default=0, verbose_name="Tokens de Prompt")
+    completion_tokens = models.PositiveIntegerField(default=0, verbose_name="Tokens de Respuesta")
+    cached_tokens = models.PositiveIntegerField(default=0, verbose_name="Tokens en Caché del Proveedor")
+    wall_ms = models.PositiveIntegerField(verbose_name="Duración (ms)")
+    ttft_ms = models.PositiveIntegerField(
+        null=True, blank=True,
+        verbose_name="Primer Token (ms)",
+        help_text="Solo en modo stream; sin stream la respuesta llega entera."
+    )
+    error_class = models.CharField(max_length=64, blank=True, default='', db_index=True, verbose_name="Clase de Error")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="Fecha")
+
+    def __str__(self):
+        return f"{self.model_name or 'LLM'} {self.wall_ms} ms ({self.prompt_tokens}+{self.completion_tokens} tokens)"
+
+    class Meta:
+        verbose_name = "Telemetría de Llamada al LLM"
+        verbose_name_plural = "Telemetría de Llamadas al LLM"
+        ordering = ['-created_at']
@@ -0,0 +1,259 @@
+# chatbot/services/admission.py
+"""
+Control de admisión para las llamadas caras: LLM (DermaBotAgent) e inferencia CNN (CNNProcessor).
+
+Sin esto, una sola sesión que postea en bucle, o una ráfaga de usuarios, deja a todos los workers
+bloqueados esperando al proveedor y el sitio se frena para todos. Hay dos capas:
+- ConcurrencyLimiter: tope global de llamadas en vuelo por proceso, con una cola de espera acotada
+  y un tiempo máximo de espera. Si la cola está llena o se vence la espera se rechaza enseguida
+  (AdmissionRejected) en lugar de apilar peticiones.
+- SessionRateLimiter: un token bucket por sesión del navegador (turnos por minuto con ráfaga);
+  la vista lo consulta antes de guardar nada y responde 429 si la sesión se quedó sin tokens.
+Las métricas (en vuelo, profundidad de la cola, rechazos) se ven en /dermabot/health/admission.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+BUSY_BOT_MESSAGE = (
+    "En este momento el asistente está atendiendo muchas consultas. "
+    "Por favor, espera unos segundos y vuelve a enviar tu mensaje."
+)
+RATE_LIMITED_MESSAGE = "Estás enviando mensajes muy seguido. Espera unos segundos antes de enviar otro."
+
+
+class AdmissionRejected(Exception):
+    """La llamada no se admitió (tope de concurrencia o límite de la sesión)."""
+
+    def __init__(self, message, retry_after_seconds=1.0):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+
+class ConcurrencyLimiter:
+
+    def __init__(self, name, max_in_flight=16, max_queue=32, queue_timeout_seconds=5.0):
+        self.name = name
+        self.max_in_flight = max_in_flight # 0 = sin tope
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._queue_depth = 0
+        self.max_queue_depth_seen = 0
+        self.admitted = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+        self.total_wait_ms = 0.0
+
+    def is_saturated(self):
+        """True si una llamada nueva se rechazaría ya mismo (todo ocupado y la cola llena)."""
+        with self._condition:
+            return bool(self.max_in_flight) and self._in_flight >= self.max_in_flight and self._queue_depth >= self.max_queue
+
+    def acquire(self):
+        started_at = time.monotonic()
+        with self._condition:
+            if not self.max_in_flight or self._in_flight < self.max_in_flight:
+                self._in_flight += 1
+                self.admitted += 1
+                return
+            if self._queue_depth >= self.max_queue:
+                self.shed_queue_full += 1
+                raise AdmissionRejected(f"{self.name}: {self._in_flight} en vuelo y cola llena ({self._queue_depth})")
+
+            self._queue_depth += 1
+            self.max_queue_depth_seen = max(self.max_queue_depth_seen, self._queue_depth)
+            deadline = started_at + self.queue_timeout_seconds
+            try:
+                while self._in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed_timeout += 1
+                        raise AdmissionRejected(f"{self.name}: {self.queue_timeout_seconds} s en cola sin lugar libre")
+                    self._condition.wait(remaining)
+                self._in_flight += 1
+                self.admitted += 1
+                self.total_wait_ms += (time.monotonic() - started_at) * 1000.0
+            finally:
+                self._queue_depth -= 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        # La espera en cola bloquea un hilo del executor, no el event loop (la cola está acotada)
+        await sync_to_async(self.acquire, thread_sensitive=False)()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_metrics(self):
+        with self._condition:
+            return {
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self._in_flight,
+                'queue_depth': self._queue_depth,
+                'max_queue_depth_seen': self.max_queue_depth_seen,
+                'admitted': self.admitted,
+                'shed_queue_full': self.shed_queue_full,
+                'shed_timeout': self.shed_timeout,
+                'avg_queue_wait_ms': self.total_wait_ms / self.admitted if self.admitted else 0.0,
+            }
+
+
+class SessionRateLimiter:
+    """Token bucket por sesión: `rate_per_minute` turnos sostenidos, hasta `burst` seguidos."""
+
+    def __init__(self, rate_per_minute=12, burst=5, max_sessions=10000):
+        self.refill_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # clave de sesión -> [tokens, último relleno] (orden LRU)
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, session_key, cost=1.0):
+        """(True, 0) si hay tokens; si no, (False, segundos hasta que alcancen)."""
+        if not self.refill_per_second:
+            return True, 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(session_key, None) or [float(self.burst), now]
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.refill_per_second)
+            bucket[1] = now
+            self._buckets[session_key] = bucket
+            while len(self._buckets) > self.max_sessions:
+                self._buckets.popitem(last=False)
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return True, 0.0
+            self.limited += 1
+            return False, (cost - bucket[0]) / self.refill_per_second
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'sessions_tracked': len(self._buckets),
+                'allowed': self.allowed,
+                'limited': self.limited,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _get_or_create(key, factory):
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                limiter = _limiters[key] = factory()
+    return limiter
+
+
+def reset_limiters():
+    """Descarta los limitadores; los próximos se arman con los settings vigentes (pruebas de carga, tests)."""
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def get_llm_limiter():
+    return _get_or_create('llm', lambda: ConcurrencyLimiter(
+        'LLM',
+        max_in_flight=getattr(settings, 'CHATBOT_LLM_MAX_IN_FLIGHT', 16),
+        max_queue=getattr(settings, 'CHATBOT_LLM_MAX_QUEUE', 32),
+        queue_timeout_seconds=getattr(settings, 'CHATBOT_ADMISSION_QUEUE_TIMEOUT_SECONDS', 5.0),
+    ))
+
+
+def cnn_batch_max_size():
+    """
+    Tamaño de lote de CNNBatchScheduler: CNN_BATCH_MAX_SIZE, recortado a CHATBOT_CNN_MAX_IN_FLIGHT. El lugar
+    se toma antes de encolar, así que con menos lugares que el tamaño de lote el lote nunca se llenaría y
+    cada uno esperaría la ventana completa. El tope de admisión que eligió el operador no se toca.
+    """
+    batch_max_size = getattr(settings, 'CNN_BATCH_MAX_SIZE', 16)
+    max_in_flight = getattr(settings, 'CHATBOT_CNN_MAX_IN_FLIGHT', 32)
+    if max_in_flight and max_in_flight < batch_max_size:
+        print(f"--- ADMISSION DEBUG: CNN_BATCH_MAX_SIZE={batch_max_size} > CHATBOT_CNN_MAX_IN_FLIGHT={max_in_flight}; lotes de hasta {max_in_flight} ---")
+        return max_in_flight
+    return batch_max_size
+
+
+def get_cnn_limiter():
+    return _get_or_create('cnn', lambda: ConcurrencyLimiter(
+        'CNN',
+        max_in_flight=getattr(settings, 'CHATBOT_CNN_MAX_IN_FLIGHT', 32),
+        max_queue=getattr(settings, 'CHATBOT_CNN_MAX_QUEUE', 32),
+        queue_timeout_seconds=getattr(settings, 'CHATBOT_ADMISSION_QUEUE_TIMEOUT_SECONDS', 5.0),
+    ))
+
+
+def get_session_rate_limiter():
+    return _get_or_create('session', lambda: SessionRateLimiter(
+        rate_per_minute=getattr(settings, 'CHATBOT_SESSION_TURNS_PER_MINUTE', 12),
+        burst=getattr(settings, 'CHATBOT_SESSION_TURN_BURST', 5),
+    ))
+
+
+def client_ip_for(request):
+    """
+    IP del cliente. Detrás de un proxy inverso REMOTE_ADDR es la del proxy (todos los clientes sin sesión
+    compartirían un bucket): con CHATBOT_TRUSTED_PROXY_COUNT=N se toma la dirección que agregó a
+    X-Forwarded-For el primero de los N proxies de confianza. Las anteriores las escribe el cliente y no se usan.
+    """
+    trusted_proxy_count = getattr(settings, 'CHATBOT_TRUSTED_PROXY_COUNT', 0)
+    if trusted_proxy_count:
+        forwarded_for = [address.strip() for address in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if address.strip()]
+        if len(forwarded_for) >= trusted_proxy_count:
+            return forwarded_for[-trusted_proxy_count]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def session_key_for(request):
+    """Clave del bucket: la sesión de Django, o la IP del cliente si el navegador todavía no tiene sesión."""
+    return request.session.session_key or f"ip:{client_ip_for(request)}"
+
+
+def check_turn_admission(request, check_llm_capacity=True):
+    """
+    Chequeo rápido antes de guardar nada del turno. Devuelve None si se admite, o
+    (mensaje, segundos para reintentar) para responder 429 sin tocar el LLM ni la CNN.
+    """
+    allowed, retry_after_seconds = get_session_rate_limiter().allow(session_key_for(request))
+    if not allowed:
+        print(f"--- ADMISSION DEBUG: Sesión limitada, reintentar en {retry_after_seconds:.1f} s ---")
+        return RATE_LIMITED_MESSAGE, retry_after_seconds
+    if check_llm_capacity and get_llm_limiter().is_saturated():
+        print("--- ADMISSION DEBUG: LLM saturado (en vuelo y cola al tope), se rechaza el turno ---")
+        return BUSY_BOT_MESSAGE, 1.0
+    return None
+
+
+def get_metrics():
+    return {
+        'llm': get_llm_limiter().get_metrics(),
+        'cnn': get_cnn_limiter().get_metrics(),
+        'sessions': get_session_rate_limiter().get_metrics(),
+    }
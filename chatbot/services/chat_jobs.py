@@ -0,0 +1,274 @@
+# chatbot/services/chat_jobs.py
+"""
+Cola de trabajos del chat sobre la BD (tabla ChatJob), sin broker externo.
+
+La vista guarda el mensaje del usuario y un mensaje del bot "pendiente" y encola un ChatJob;
+`python manage.py run_dermabot_worker` corre la CNN y el agente fuera de la petición HTTP y
+completa el mensaje del bot. Funciona igual con SQLite y con Postgres:
+- un worker toma un trabajo con un UPDATE condicional (solo uno de los que compiten lo logra);
+- mientras lo procesa, el trabajo queda bloqueado hasta locked_until (timeout de visibilidad);
+  si el worker muere, al vencer otro worker lo retoma;
+- los errores se reintentan con espera exponencial hasta max_attempts;
+- los trabajos de una misma conversación se procesan en orden, de a uno.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from ..models import ChatJob, Message, MessageImage
+from . import llm_telemetry, turn_input
+
+PENDING_BOT_MESSAGE = "DermaBot está analizando tu consulta..."
+FAILED_BOT_MESSAGE = "Lo siento, no pudimos procesar tu consulta en este momento. Por favor, intenta de nuevo."
+CNN_UNAVAILABLE_BOT_MESSAGE = "Lo siento, el servicio de análisis de imágenes no está disponible actualmente."
+
+
+class LeaseLostError(Exception):
+    """El trabajo dejó de pertenecer a este worker (venció el timeout de visibilidad y otro lo tomó)."""
+
+
+class RetryableJobError(Exception):
+    """Falla transitoria (p. ej. la API del LLM no respondió): el trabajo se reintenta."""
+
+
+def enqueue_chat_turn(conversation, user_message, user_identifier):
+    """Crea el mensaje pendiente del bot y el ChatJob del turno. Devuelve el ChatJob."""
+    with transaction.atomic():
+        bot_message = Message.objects.create(conversation=conversation, content=PENDING_BOT_MESSAGE, is_bot=True)
+        job = ChatJob.objects.create(
+            conversation=conversation,
+            user_message=user_message,
+            bot_message=bot_message,
+            user_identifier=user_identifier,
+            max_attempts=getattr(settings, 'CHATBOT_JOB_MAX_ATTEMPTS', 3),
+        )
+    print(f"--- JOBS DEBUG: Trabajo {job.id} encolado para la conversación {conversation.id} ---")
+    return job
+
+
+def _claimable(now):
+    """Trabajos listos para tomar: pendientes ya disponibles o en proceso con el bloqueo vencido."""
+    return Q(status=ChatJob.STATUS_PENDING, available_at__lte=now) | Q(status=ChatJob.STATUS_RUNNING, locked_until__lte=now)
+
+
+class ChatJobWorker:
+
+    def __init__(self, worker_id=None, concurrency=None, visibility_timeout_seconds=None, retry_backoff_seconds=None, poll_interval_seconds=None):
+        self.worker_id = worker_id or f"worker-{uuid.uuid4().hex[:8]}"
+        self.concurrency = concurrency or getattr(settings, 'CHATBOT_WORKER_CONCURRENCY', 4)
+        self.visibility_timeout_seconds = visibility_timeout_seconds or getattr(settings, 'CHATBOT_JOB_VISIBILITY_TIMEOUT_SECONDS', 300)
+        self.retry_backoff_seconds = retry_backoff_seconds if retry_backoff_seconds is not None else getattr(settings, 'CHATBOT_JOB_RETRY_BACKOFF_SECONDS', 5.0)
+        self.poll_interval_seconds = poll_interval_seconds or getattr(settings, 'CHATBOT_WORKER_POLL_SECONDS', 1.0)
+        self._metrics_lock = threading.Lock()
+        self.claimed = 0
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+        self.leases_lost = 0
+
+    # --- Toma y bloqueo ---
+
+    def claim_next(self):
+        """Toma el trabajo más antiguo disponible. Devuelve el ChatJob o None si no hay."""
+        now = timezone.now()
+        older_unfinished = ChatJob.objects.filter(
+            conversation_id=OuterRef('conversation_id'),
+            status__in=[ChatJob.STATUS_PENDING, ChatJob.STATUS_RUNNING],
+            created_at__lt=OuterRef('created_at'),
+        )
+        candidate_ids = list(
+            ChatJob.objects.filter(_claimable(now), attempts__lt=F('max_attempts'))
+            .exclude(Exists(older_unfinished)) # Orden dentro de la conversación: primero el turno anterior
+            .order_by('created_at')
+            .values_list('id', flat=True)[:self.concurrency]
+        )
+        for job_id in candidate_ids:
+            claimed = ChatJob.objects.filter(_claimable(now), id=job_id, attempts__lt=F('max_attempts')).update(
+                status=ChatJob.STATUS_RUNNING,
+                locked_by=self.worker_id,
+                locked_until=now + timedelta(seconds=self.visibility_timeout_seconds),
+                attempts=F('attempts') + 1,
+                started_at=now,
+            )
+            if claimed: # 0 si otro worker lo tomó entre la lectura y el UPDATE
+                with self._metrics_lock:
+                    self.claimed += 1
+                return ChatJob.objects.select_related('conversation', 'user_message').get(id=job_id)
+        return None
+
+    def extend_lease(self, job):
+        """Renueva el bloqueo; LeaseLostError si el trabajo ya no es de este worker."""
+        extended = ChatJob.objects.filter(id=job.id, locked_by=self.worker_id, status=ChatJob.STATUS_RUNNING).update(
+            locked_until=timezone.now() + timedelta(seconds=self.visibility_timeout_seconds)
+        )
+        if not extended:
+            raise LeaseLostError(f"Trabajo {job.id}: el bloqueo ya no pertenece a {self.worker_id}")
+
+    def fail_exhausted(self):
+        """Marca como fallidos los trabajos cuyo worker murió en el último intento permitido."""
+        now = timezone.now()
+        exhausted_ids = list(
+            ChatJob.objects.filter(status=ChatJob.STATUS_RUNNING, locked_until__lte=now, attempts__gte=F('max_attempts'))
+            .values_list('id', flat=True)
+        )
+        for job_id in exhausted_ids:
+            with transaction.atomic():
+                updated = ChatJob.objects.filter(id=job_id, status=ChatJob.STATUS_RUNNING, locked_until__lte=now).update(
+                    status=ChatJob.STATUS_FAILED, finished_at=now, last_error="Timeout de visibilidad vencido en el último intento."
+                )
+                if updated:
+                    Message.objects.filter(chat_job__id=job_id).update(content=FAILED_BOT_MESSAGE)
+                    with self._metrics_lock:
+                        self.failed += 1
+        return len(exhausted_ids)
+
+    # --- Procesamiento ---
+
+    def process(self, job):
+        """Corre el turno completo de un trabajo ya tomado y registra el resultado."""
+        started = time.perf_counter()
+        try:
+            bot_content = self._run_turn(job)
+            self._finish(job, ChatJob.STATUS_DONE, bot_content)
+            with self._metrics_lock:
+                self.done += 1
+            print(f"--- JOBS DEBUG: Trabajo {job.id} terminado en {time.perf_counter() - started:.2f} s (intento {job.attempts}) ---")
+        except LeaseLostError as e:
+            with self._metrics_lock:
+                self.leases_lost += 1
+            print(f"!!!!!!!! JOBS: {e}. Se descarta el resultado. !!!!!!!!")
+        except Exception as e:
+            self._retry_or_fail(job, e)
+        finally:
+            close_old_connections()
+
+    def _run_turn(self, job):
+        from .model_lifecycle import model_lifecycle
+        from .openai_agent_service import AGENT_CATASTROPHIC_ERROR_MESSAGE, LLM_TECHNICAL_ERROR_MESSAGE
+
+        user_message = job.user_message
+        image_rows = list(MessageImage.objects.filter(message=user_message).order_by('position'))
+        cnn_prediction_info_for_llm = ""
+
+        if image_rows or user_message.image:
+            cnn_image_processor = model_lifecycle.get_cnn_processor()
+            if cnn_image_processor is None:
+                return CNN_UNAVAILABLE_BOT_MESSAGE
+            stored_images = [row.image for row in image_rows] or [user_message.image]
+            for stored_image in stored_images:
+                stored_image.open('rb')
+            try:
+                predicted_desease_obj, confidence_percent, per_image_results = cnn_image_processor.predict_from_image_files(stored_images)
+            finally:
+                for stored_image in stored_images:
+                    stored_image.close()
+
+            user_message.cnn_predicted_desease = predicted_desease_obj
+            user_message.cnn_confidence = confidence_percent
+            user_message.save(update_fields=['cnn_predicted_desease', 'cnn_confidence'])
+            for row, (desease, confidence) in zip(image_rows, per_image_results):
+                row.cnn_predicted_desease = desease
+                row.cnn_confidence = confidence
+            if image_rows:
+                MessageImage.objects.bulk_update(image_rows, ['cnn_predicted_desease', 'cnn_confidence'])
+            cnn_prediction_info_for_llm = turn_input.cnn_context_for_llm(stored_images, predicted_desease_obj, confidence_percent, per_image_results)
+            self.extend_lease(job) # La CNN pudo tardar: renovar antes de la llamada al LLM
+
+        derma_agent_llm = model_lifecycle.get_agent()
+        if derma_agent_llm is None:
+            raise RetryableJobError("Agente LLM no disponible en el worker.")
+        telemetry_ids = []
+        bot_content = derma_agent_llm.get_response(
+            user_input=turn_input.final_input_for_llm(user_message.content, cnn_prediction_info_for_llm),
+            conversation_id=str(job.conversation_id),
+            user_identifier=job.user_identifier,
+            telemetry_ids=telemetry_ids,
+        )
+        # El mensaje del bot ya existe: cada intento enlaza sus filas, también los que fallan y se reintentan
+        llm_telemetry.attach_to_message(job.conversation_id, job.bot_message_id, telemetry_ids)
+        if bot_content in (LLM_TECHNICAL_ERROR_MESSAGE, AGENT_CATASTROPHIC_ERROR_MESSAGE):
+            # El agente ya dejó el turno fallido en su memoria: se descarta y se reconstruye desde la BD al reintentar
+            derma_agent_llm.checkpointer.delete_thread(str(job.conversation_id))
+            raise RetryableJobError(f"El LLM no respondió: {bot_content}")
+        return bot_content
+
+    def _finish(self, job, status, bot_content, error=""):
+        """Cierra el trabajo y completa el mensaje del bot, solo si el bloqueo sigue siendo nuestro."""
+        with transaction.atomic():
+            finished = ChatJob.objects.filter(id=job.id, locked_by=self.worker_id, status=ChatJob.STATUS_RUNNING).update(
+                status=status, finished_at=timezone.now(), locked_until=None, last_error=error
+            )
+            if not finished:
+                raise LeaseLostError(f"Trabajo {job.id}: el bloqueo venció antes de terminar")
+            Message.objects.filter(id=job.bot_message_id).update(content=bot_content)
+
+    def _retry_or_fail(self, job, error):
+        error_text = f"{type(error).__name__}: {error}"
+        if job.attempts >= job.max_attempts:
+            print(f"!!!!!!!! JOBS: Trabajo {job.id} fallido tras {job.attempts} intentos: {error_text} !!!!!!!!")
+            try:
+                self._finish(job, ChatJob.STATUS_FAILED, FAILED_BOT_MESSAGE, error=error_text)
+                with self._metrics_lock:
+                    self.failed += 1
+            except LeaseLostError as e:
+                print(f"!!!!!!!! JOBS: {e} !!!!!!!!")
+            return
+
+        delay_seconds = self.retry_backoff_seconds * (2 ** (job.attempts - 1))
+        released = ChatJob.objects.filter(id=job.id, locked_by=self.worker_id, status=ChatJob.STATUS_RUNNING).update(
+            status=ChatJob.STATUS_PENDING,
+            available_at=timezone.now() + timedelta(seconds=delay_seconds),
+            locked_by='',
+            locked_until=None,
+            last_error=error_text,
+        )
+        if released:
+            with self._metrics_lock:
+                self.retried += 1
+        print(f"--- JOBS DEBUG: Trabajo {job.id} reintentará en {delay_seconds:.1f} s (intento {job.attempts}/{job.max_attempts}): {error_text} ---")
+
+    # --- Bucle del worker ---
+
+    def run(self, stop_event=None, until_empty=False):
+        """
+        Procesa trabajos con como máximo `concurrency` en paralelo. Con until_empty=True termina
+        cuando no queda nada disponible; si no, sigue hasta que se active stop_event.
+        """
+        stop_event = stop_event or threading.Event()
+        in_flight = set()
+        print(f"--- JOBS DEBUG: Worker {self.worker_id} iniciado (concurrencia={self.concurrency}, visibilidad={self.visibility_timeout_seconds} s) ---")
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='dermabot-job') as pool:
+            while not stop_event.is_set():
+                self.fail_exhausted()
+                while len(in_flight) < self.concurrency:
+                    job = self.claim_next()
+                    if job is None:
+                        break
+                    in_flight.add(pool.submit(self.process, job))
+
+                if not in_flight:
+                    if until_empty:
+                        break
+                    stop_event.wait(self.poll_interval_seconds)
+                    continue
+                _, in_flight = wait(in_flight, timeout=self.poll_interval_seconds, return_when=FIRST_COMPLETED)
+            wait(in_flight) # Al detenerse se terminan los trabajos ya tomados
+        close_old_connections()
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            return {
+                'worker_id': self.worker_id,
+                'claimed': self.claimed,
+                'done': self.done,
+                'retried': self.retried,
+                'failed': self.failed,
+                'leases_lost': self.leases_lost,
+            }
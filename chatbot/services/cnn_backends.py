@@ -0,0 +1,187 @@
+# chatbot/services/cnn_backends.py
+"""
+Backends de inferencia intercambiables para CNNProcessor (settings.CNN_BACKEND):
+
+- 'keras':  el modelo .h5 + pesos .keras original (requiere TensorFlow completo).
+- 'tflite': modelo convertido a TFLite (tflite_runtime si está instalado, si no tf.lite).
+- 'onnx':   modelo convertido a ONNX, ejecutado con ONNX Runtime.
+
+Todos exponen la misma interfaz: predict(batch_array) -> np.ndarray (N, clases),
+input_shape, model_files y model_version. TensorFlow solo se importa desde el backend
+Keras (o como respaldo de TFLite), así los workers con TFLite/ONNX no lo cargan.
+Los archivos .tflite/.onnx se generan con `python manage.py convert_cnn_model`.
+"""
+import os
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .prediction_cache import compute_model_version
+
+MODEL_DIR = os.path.join(settings.BASE_DIR, 'chatbot', 'AI_Model')
+MODEL_BASENAME = 'skin-cancer-7-classes_MobileNet_ph2'
+KERAS_MODEL_PATH = os.path.join(MODEL_DIR, f'{MODEL_BASENAME}_model.h5')
+KERAS_WEIGHTS_PATH = os.path.join(MODEL_DIR, f'{MODEL_BASENAME}_weights.keras')
+
+
+def converted_model_path(backend_name, quantized=False):
+    """Ruta del modelo convertido para 'tflite' u 'onnx' (sufijo _int8 si está cuantizado)."""
+    extension = {'tflite': 'tflite', 'onnx': 'onnx'}[backend_name]
+    suffix = '_int8' if quantized else ''
+    return os.path.join(MODEL_DIR, f'{MODEL_BASENAME}{suffix}.{extension}')
+
+
+def build_serving_function(model):
+    """
+    Traza UNA vez el forward pass del modelo con una firma fija
+    (batch variable, float32) y devuelve la ConcreteFunction resultante.
+    Llamarla no reconstruye el pipeline tf.data ni callbacks como model.predict,
+    y al ser una función concreta no se re-traza: es segura entre hilos.
+    """
+    import tensorflow as tf
+
+    input_spec = tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32, name="images")
+
+    @tf.function(input_signature=[input_spec])
+    def serve(images):
+        return model(images, training=False)
+
+    return serve.get_concrete_function()
+
+
+class KerasBackend:
+    name = 'keras'
+
+    def __init__(self, model_path=KERAS_MODEL_PATH, weights_path=KERAS_WEIGHTS_PATH, use_serving_function=True):
+        from tensorflow.keras.models import load_model
+
+        self.model_files = (model_path, weights_path)
+        print(f"--- CNN DEBUG: Intentando cargar modelo desde: {model_path} con compile=False ---")
+        # Cargar el modelo sin compilar primero
+        self.model = load_model(
+            model_path,
+            custom_objects=None,
+            compile=False  # Crucial para muchos modelos guardados
+        )
+        print(f"--- CNN DEBUG: Modelo cargado (compile=False). Intentando cargar pesos desde: {weights_path} ---")
+        self.model.load_weights(weights_path)
+        self.input_shape = tuple(self.model.input_shape)
+        self.model_version = compute_model_version(*self.model_files)
+
+        self.serving_function = None
+        if use_serving_function:
+            self._prepare_serving_function()
+
+    def _prepare_serving_function(self):
+        """Traza la función de inferencia y la calienta con una imagen sintética."""
+        import tensorflow as tf
+        try:
+            started_at = time.perf_counter()
+            serving_function = build_serving_function(self.model)
+            warmup_input = np.zeros((1,) + self.input_shape[1:], dtype=np.float32)
+            serving_function(tf.constant(warmup_input))
+            self.serving_function = serving_function
+            print(f"--- CNN DEBUG: Función de inferencia trazada y calentada en {(time.perf_counter() - started_at) * 1000:.0f} ms ---")
+        except Exception as e:
+            print(f"--- CNN ADVERTENCIA: No se pudo preparar la función de inferencia trazada, se usará model.predict: {e}")
+            self.serving_function = None
+
+    def predict(self, batch_array):
+        if self.serving_function is not None:
+            import tensorflow as tf
+            return self.serving_function(tf.constant(batch_array, dtype=tf.float32)).numpy()
+        return self.model.predict(batch_array, verbose=0)
+
+
+class TFLiteBackend:
+    name = 'tflite'
+
+    def __init__(self, model_path, num_threads=None):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(model_path)
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.model_files = (model_path,)
+        self._interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._lock = threading.Lock() # El intérprete TFLite NO es seguro entre hilos
+        input_details = self._interpreter.get_input_details()[0]
+        self._allocated_batch_size = int(input_details['shape'][0])
+        self.input_shape = (None,) + tuple(int(dim) for dim in input_details['shape'][1:])
+        self.model_version = compute_model_version(*self.model_files)
+
+    def predict(self, batch_array):
+        batch_array = np.asarray(batch_array, dtype=np.float32)
+        with self._lock:
+            input_details = self._interpreter.get_input_details()[0]
+            if len(batch_array) != self._allocated_batch_size:
+                self._interpreter.resize_tensor_input(input_details['index'], list(batch_array.shape))
+                self._interpreter.allocate_tensors()
+                self._allocated_batch_size = len(batch_array)
+                input_details = self._interpreter.get_input_details()[0]
+            output_details = self._interpreter.get_output_details()[0]
+
+            input_tensor = batch_array
+            if input_details['dtype'] in (np.int8, np.uint8):
+                scale, zero_point = input_details['quantization']
+                input_tensor = np.round(batch_array / scale + zero_point)
+                info = np.iinfo(input_details['dtype'])
+                input_tensor = np.clip(input_tensor, info.min, info.max).astype(input_details['dtype'])
+
+            self._interpreter.set_tensor(input_details['index'], input_tensor)
+            self._interpreter.invoke()
+            output = self._interpreter.get_tensor(output_details['index']).copy()
+
+        if output_details['dtype'] in (np.int8, np.uint8):
+            scale, zero_point = output_details['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output.astype(np.float32)
+
+
+class ONNXRuntimeBackend:
+    name = 'onnx'
+
+    def __init__(self, model_path, num_threads=None):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(model_path)
+        import onnxruntime as ort
+
+        self.model_files = (model_path,)
+        session_options = ort.SessionOptions()
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+        self._session = ort.InferenceSession(model_path, sess_options=session_options, providers=['CPUExecutionProvider'])
+        model_input = self._session.get_inputs()[0]
+        self._input_name = model_input.name
+        self.input_shape = (None,) + tuple(dim if isinstance(dim, int) else None for dim in model_input.shape[1:])
+        self.model_version = compute_model_version(*self.model_files)
+
+    def predict(self, batch_array):
+        # InferenceSession.run es seguro para llamadas concurrentes
+        return self._session.run(None, {self._input_name: np.asarray(batch_array, dtype=np.float32)})[0]
+
+
+AVAILABLE_BACKENDS = ('keras', 'tflite', 'onnx')
+
+
+def load_backend(backend_name=None):
+    """Crea el backend configurado en settings (CNN_BACKEND, CNN_BACKEND_QUANTIZED, CNN_BACKEND_NUM_THREADS)."""
+    backend_name = (backend_name or getattr(settings, 'CNN_BACKEND', 'keras')).lower()
+    if backend_name not in AVAILABLE_BACKENDS:
+        raise ValueError(f"Backend CNN desconocido: '{backend_name}'. Opciones: {', '.join(AVAILABLE_BACKENDS)}")
+    num_threads = getattr(settings, 'CNN_BACKEND_NUM_THREADS', None)
+    if backend_name == 'keras':
+        return KerasBackend(use_serving_function=getattr(settings, 'CNN_USE_SERVING_FUNCTION', True))
+
+    quantized = getattr(settings, 'CNN_BACKEND_QUANTIZED', False)
+    model_path = getattr(settings, 'CNN_BACKEND_MODEL_PATH', None) or converted_model_path(backend_name, quantized)
+    print(f"--- CNN DEBUG: Cargando backend '{backend_name}' desde: {model_path} ---")
+    if backend_name == 'tflite':
+        return TFLiteBackend(model_path, num_threads=num_threads)
+    return ONNXRuntimeBackend(model_path, num_threads=num_threads)
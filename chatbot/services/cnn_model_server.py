@@ -0,0 +1,132 @@
+# chatbot/services/cnn_model_server.py
+"""
+Servidor de inferencia CNN fuera de proceso.
+
+Un único proceso (`python manage.py run_cnn_model_server`) carga el backend de inferencia
+y atiende a todos los workers de Django por un socket Unix local. El tensor ya preprocesado
+viaja por `multiprocessing.shared_memory` (sin pickle); por el socket solo van mensajes JSON
+cortos: el nombre del bloque de memoria, su forma y las probabilidades de salida.
+"""
+import json
+import os
+import socket
+import socketserver
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+class CNNModelServerError(Exception):
+    """El servidor de modelo respondió con un error (o no se pudo hablar con él)."""
+
+
+def _read_json_line(stream):
+    line = stream.readline()
+    if not line:
+        raise CNNModelServerError("Conexión cerrada sin respuesta.")
+    return json.loads(line)
+
+
+class CNNModelServerClient:
+    """Cliente liviano usado por CNNProcessor dentro de cada worker de Django."""
+
+    def __init__(self, socket_path, timeout=30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _request(self, payload):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps(payload) + "\n").encode("utf-8"))
+            with sock.makefile("rb") as stream:
+                response = _read_json_line(stream)
+        if not response.get("ok"):
+            raise CNNModelServerError(response.get("error", "Error desconocido del servidor de modelo."))
+        return response
+
+    def get_info(self):
+        """Devuelve {'backend', 'model_version', 'input_shape'} del modelo cargado en el servidor."""
+        return self._request({"op": "info"})
+
+    def predict(self, batch_array):
+        batch_array = np.ascontiguousarray(batch_array, dtype=np.float32)
+        shm = shared_memory.SharedMemory(create=True, size=batch_array.nbytes)
+        try:
+            shared_view = np.ndarray(batch_array.shape, dtype=np.float32, buffer=shm.buf)
+            shared_view[:] = batch_array
+            del shared_view # Liberar la vista antes de cerrar el bloque
+            response = self._request({
+                "op": "predict",
+                "shm_name": shm.name,
+                "shape": list(batch_array.shape),
+                "dtype": "float32",
+            })
+        finally:
+            shm.close()
+            shm.unlink()
+        return np.asarray(response["predictions"], dtype=np.float32)
+
+
+class _ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = _read_json_line(self.rfile)
+            response = self.server.model_server.handle_request(request)
+        except Exception as e:
+            print(f"--- CNN SERVER ERROR: {e}")
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+class CNNModelServer:
+    """Carga el backend una sola vez y agrupa en lotes las peticiones de todos los workers."""
+
+    def __init__(self, socket_path, backend=None, max_batch_size=16, max_wait_ms=5.0):
+        # Imports diferidos: cnn_service importa el cliente de este módulo
+        from .cnn_backends import load_backend
+        from .cnn_service import CNNBatchScheduler
+
+        self.socket_path = socket_path
+        self.backend = backend or load_backend()
+        self.scheduler = CNNBatchScheduler(self.backend.predict, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def handle_request(self, request):
+        op = request.get("op")
+        if op == "info":
+            return {
+                "ok": True,
+                "backend": self.backend.name,
+                "model_version": self.backend.model_version,
+                "input_shape": list(self.backend.input_shape),
+            }
+        if op == "predict":
+            shm = shared_memory.SharedMemory(name=request["shm_name"])
+            try:
+                # El bloque es del cliente: que el resource_tracker de este proceso no lo borre al salir
+                resource_tracker.unregister(shm._name, "shared_memory")
+                shared_view = np.ndarray(tuple(request["shape"]), dtype=np.dtype(request.get("dtype", "float32")), buffer=shm.buf)
+                batch_array = shared_view.copy()
+                del shared_view
+            finally:
+                shm.close()
+            predictions = self.scheduler.predict(batch_array)
+            return {"ok": True, "predictions": np.asarray(predictions).tolist()}
+        return {"ok": False, "error": f"Operación desconocida: {op}"}
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path) # Socket viejo de una ejecución anterior
+        with _ThreadingUnixStreamServer(self.socket_path, _RequestHandler) as server:
+            server.model_server = self
+            os.chmod(self.socket_path, 0o660)
+            print(f"--- CNN SERVER: Escuchando en {self.socket_path} (backend '{self.backend.name}', versión {self.backend.model_version[:12]}) ---")
+            try:
+                server.serve_forever()
+            finally:
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)
@@ -1,65 +1,221 @@
 # chatbot/services/cnn_service.py
 import os
 import sys
+import time
+import queue
+import threading
+from io import BytesIO
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
 from PIL import Image
 from django.conf import settings
-# Asegúrate de que las importaciones de Keras/TensorFlow sean consistentes
-# Si usas 'tensorflow.keras', sé consistente. Si es solo 'keras', también.
-# Dado que en tus errores aparece tensorflow, usaré tensorflow.keras.
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing.image import img_to_array
+from django.core.files.base import ContentFile
+from django.db import connection
+# TensorFlow/Keras ya no se importa aquí: solo lo carga el backend 'keras' de cnn_backends.py,
+# así los workers que usan TFLite u ONNX Runtime no pagan el import completo de TensorFlow.
 import numpy as np
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from ..models import Desease # Importa desde la app chatbot
+from .prediction_cache import PredictionCache, hash_image_bytes
+from .cnn_backends import KERAS_MODEL_PATH, KERAS_WEIGHTS_PATH, load_backend
+from .cnn_model_server import CNNModelServerClient, CNNModelServerError
+from .desease_index import desease_index
+from .admission import cnn_batch_max_size, get_cnn_limiter
+from .image_pipeline import MODEL_INPUT_SIZE, StageTimer, decode_for_model
+
+# Cantidad de lotes recientes que se guardan para calcular las métricas del scheduler
+_BATCH_METRICS_WINDOW = 500
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    return float(np.percentile(np.asarray(values, dtype=np.float64), percent))
+
+
+class CNNBatchScheduler:
+    """
+    Micro-batching de inferencias: junta las peticiones concurrentes durante una
+    ventana corta (max_wait_ms) o hasta max_batch_size imágenes, hace UN solo
+    forward pass y le devuelve a cada llamante sus propias filas de predicción.
+    """
+
+    def __init__(self, predict_batch_fn, max_batch_size=16, max_wait_ms=5.0):
+        self._predict_batch_fn = predict_batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_seconds = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+
+        self._metrics_lock = threading.Lock()
+        self._recent_batch_sizes = deque(maxlen=_BATCH_METRICS_WINDOW)
+        self._recent_queue_waits_ms = deque(maxlen=_BATCH_METRICS_WINDOW)
+        self._recent_inference_ms = deque(maxlen=_BATCH_METRICS_WINDOW)
+        self.total_batches = 0
+        self.total_images = 0
+        self.total_errors = 0
+
+        self._worker = threading.Thread(target=self._run_forever, name="cnn-batch-scheduler", daemon=True)
+        self._worker.start()
+        print(f"--- CNN DEBUG: CNNBatchScheduler iniciado (max_batch_size={self.max_batch_size}, max_wait_ms={max_wait_ms}) ---")
+
+    def submit(self, image_batch_array):
+        """
+        Encola un array (N, H, W, C) y devuelve un Future que se resuelve con
+        las N filas de predicciones correspondientes.
+        """
+        future = Future()
+        self._queue.put((image_batch_array, time.perf_counter(), future))
+        return future
+
+    def predict(self, image_batch_array, timeout=None):
+        return self.submit(image_batch_array).result(timeout=timeout)
+
+    def _collect_batch(self):
+        first_item = self._queue.get() # Bloquea hasta que llegue la primera petición
+        batch = [first_item]
+        batch_rows = len(first_item[0])
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while batch_rows < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            batch_rows += len(item[0])
+        return batch, batch_rows
+
+    def _run_forever(self):
+        while True:
+            batch, batch_rows = self._collect_batch()
+            started_at = time.perf_counter()
+            queue_waits_ms = [(started_at - enqueued_at) * 1000.0 for _, enqueued_at, _ in batch]
+            try:
+                inputs = np.concatenate([array for array, _, _ in batch], axis=0)
+                predictions = self._predict_batch_fn(inputs)
+            except Exception as e:
+                print(f"--- CNN ERROR: Falló el forward pass del lote ({batch_rows} imágenes): {e}")
+                with self._metrics_lock:
+                    self.total_errors += 1
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            inference_ms = (time.perf_counter() - started_at) * 1000.0
+
+            offset = 0
+            for array, _, future in batch:
+                rows = len(array)
+                future.set_result(predictions[offset:offset + rows])
+                offset += rows
+
+            self._record_batch(batch_rows, queue_waits_ms, inference_ms)
+
+    def _record_batch(self, batch_rows, queue_waits_ms, inference_ms):
+        with self._metrics_lock:
+            self.total_batches += 1
+            self.total_images += batch_rows
+            self._recent_batch_sizes.append(batch_rows)
+            self._recent_queue_waits_ms.extend(queue_waits_ms)
+            self._recent_inference_ms.append(inference_ms)
+        print(f"--- CNN DEBUG: Lote procesado - tamaño: {batch_rows}, espera máx. en cola: {max(queue_waits_ms):.1f} ms, inferencia: {inference_ms:.1f} ms ---")
+
+    def get_metrics(self):
+        """Métricas para ajustar la ventana: tamaño de lote y espera en cola (ms)."""
+        with self._metrics_lock:
+            batch_sizes = list(self._recent_batch_sizes)
+            queue_waits = list(self._recent_queue_waits_ms)
+            inference_times = list(self._recent_inference_ms)
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_seconds * 1000.0,
+                "total_batches": self.total_batches,
+                "total_images": self.total_images,
+                "total_errors": self.total_errors,
+                "queue_depth": self._queue.qsize(),
+                "batch_size_avg": float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+                "batch_size_max": max(batch_sizes) if batch_sizes else 0,
+                "queue_wait_ms_p50": _percentile(queue_waits, 50),
+                "queue_wait_ms_p95": _percentile(queue_waits, 95),
+                "queue_wait_ms_max": max(queue_waits) if queue_waits else 0.0,
+                "inference_ms_p50": _percentile(inference_times, 50),
+                "inference_ms_p95": _percentile(inference_times, 95),
+            }
+
 
 class CNNProcessor:
     _instance = None  # Para el Singleton de la clase CNNProcessor
-    _model_cnn_internal_instance = None  # Para el modelo Keras (renombrado para claridad)
+    _model_cnn_internal_instance = None  # Backend de inferencia cargado (ver cnn_backends.py)
+    _batch_scheduler = None  # Scheduler de micro-batching compartido por todo el proceso
+    _batch_scheduler_lock = threading.Lock()
+    _model_version = None  # Hash de los archivos del modelo (clave de la caché de predicciones)
+    _prediction_cache = None
+    _prediction_cache_lock = threading.Lock()
+    _local_backend_lock = threading.Lock()
+    _prediction_executor = None  # Pool para correr la CNN mientras la vista guarda el mensaje (submit_prediction)
+    _prediction_executor_lock = threading.Lock()
     
-    # Rutas del modelo (ajusta si es necesario)
-    _model_path = os.path.join(settings.BASE_DIR, 'chatbot', 'AI_Model', 'skin-cancer-7-classes_MobileNet_ph2_model.h5')
-    _weights_path = os.path.join(settings.BASE_DIR, 'chatbot', 'AI_Model', 'skin-cancer-7-classes_MobileNet_ph2_weights.keras')
+    # Rutas del modelo Keras original (ajusta si es necesario en cnn_backends.py)
+    _model_path = KERAS_MODEL_PATH
+    _weights_path = KERAS_WEIGHTS_PATH
 
     def __init__(self):
         """
-        Constructor privado. La carga del modelo Keras ocurre aquí si aún no está cargado.
+        Constructor privado. La carga del backend de inferencia ocurre aquí si aún no está cargado.
         Este constructor será llamado solo una vez por el método get_instance().
+        Si settings.CNN_MODEL_SERVER_SOCKET está definido, CNNProcessor es un cliente liviano del
+        servidor de modelo (run_cnn_model_server) y solo carga el modelo localmente como respaldo.
         """
-        if CNNProcessor._model_cnn_internal_instance is None:
-            print("--- CNN DEBUG: Cargando modelo Keras y pesos por primera vez (dentro de __init__) ---")
+        self.model_server_client = None
+        model_server_socket = getattr(settings, 'CNN_MODEL_SERVER_SOCKET', None)
+        if model_server_socket and CNNProcessor._model_cnn_internal_instance is None:
+            client = CNNModelServerClient(
+                model_server_socket,
+                timeout=getattr(settings, 'CNN_MODEL_SERVER_TIMEOUT_SECONDS', 30.0),
+            )
+            try:
+                server_info = client.get_info()
+                CNNProcessor._model_version = server_info['model_version']
+                self.model_server_client = client
+                print(f"--- CNN DEBUG: Usando servidor de modelo en {model_server_socket} (backend '{server_info['backend']}', versión {server_info['model_version'][:12]}) ---")
+            except (OSError, CNNModelServerError) as e:
+                print(f"--- CNN ADVERTENCIA: Servidor de modelo no disponible en {model_server_socket} ({e}). Se carga el modelo en este proceso. ---")
+
+        if self.model_server_client is None:
+            self._load_local_backend()
+
+        # Asignar el backend (posiblemente None si falló la carga o si se usa el servidor) a la instancia
+        self.model_cnn = CNNProcessor._model_cnn_internal_instance
+
+        if self.model_cnn is None and self.model_server_client is None:
+            print("--- CNN ADVERTENCIA: El modelo CNN (self.model_cnn) no está cargado. Las predicciones fallarán. ---")
+
+    def _load_local_backend(self):
+        if CNNProcessor._model_cnn_internal_instance is not None:
+            return CNNProcessor._model_cnn_internal_instance
+        with CNNProcessor._local_backend_lock:
+            if CNNProcessor._model_cnn_internal_instance is not None:
+                return CNNProcessor._model_cnn_internal_instance
+            backend_name = getattr(settings, 'CNN_BACKEND', 'keras')
+            print(f"--- CNN DEBUG: Cargando backend de inferencia '{backend_name}' por primera vez (dentro de __init__) ---")
             try:
-                print(f"--- CNN DEBUG: Intentando cargar modelo desde: {self._model_path} con compile=False ---")
-                # Cargar el modelo sin compilar primero
-                loaded_model = load_model(
-                    self._model_path,
-                    custom_objects=None,
-                    compile=False  # Crucial para muchos modelos guardados
-                )
-                print(f"--- CNN DEBUG: Modelo cargado (compile=False). Intentando cargar pesos desde: {self._weights_path} ---")
-                loaded_model.load_weights(self._weights_path)
-                CNNProcessor._model_cnn_internal_instance = loaded_model # Asignar a la variable de clase
-                print("--- CNN DEBUG: Modelo Keras y pesos cargados y asignados exitosamente. ---")
-                
-                # Opcional: Si necesitas compilarlo después de cargar los pesos para predicción
-                # (usualmente no es necesario si solo haces .predict() y no re-entrenamiento)
-                # print("--- CNN DEBUG: Compilando modelo (si es necesario)... ---")
-                # CNNProcessor._model_cnn_internal_instance.compile(optimizer='adam', loss='categorical_crossentropy') # Ajusta optimizador/loss
-                # print("--- CNN DEBUG: Modelo compilado. ---")
-
-            except FileNotFoundError:
-                print(f"!!!!!!!! CNN ERROR FATAL: Archivo de modelo o pesos NO ENCONTRADO. !!!!!!!!")
+                backend = load_backend(backend_name)
+                CNNProcessor._model_cnn_internal_instance = backend # Asignar a la variable de clase
+                CNNProcessor._model_version = backend.model_version
+                print(f"--- CNN DEBUG: Backend '{backend.name}' cargado exitosamente (versión {CNNProcessor._model_version[:12]}). ---")
+            except FileNotFoundError as e:
+                print(f"!!!!!!!! CNN ERROR FATAL: Archivo de modelo o pesos NO ENCONTRADO ({e}). !!!!!!!!")
                 print(f"Modelo esperado en: {self._model_path}")
                 print(f"Pesos esperados en: {self._weights_path}")
+                if backend_name != 'keras':
+                    print("Para TFLite/ONNX genera primero los archivos con: python manage.py convert_cnn_model")
                 CNNProcessor._model_cnn_internal_instance = None # Asegurar que quede None si falla
             except Exception as e:
-                print(f"!!!!!!!! CNN ERROR FATAL al cargar modelo/pesos Keras: {e} !!!!!!!!!")
+                print(f"!!!!!!!! CNN ERROR FATAL al cargar el backend de inferencia '{backend_name}': {e} !!!!!!!!!")
                 CNNProcessor._model_cnn_internal_instance = None # Asegurar que quede None si falla
-        
-        # Asignar el modelo (posiblemente None si falló la carga) a la instancia
-        self.model_cnn = CNNProcessor._model_cnn_internal_instance
-
-        if self.model_cnn is None:
-            print("--- CNN ADVERTENCIA: El modelo Keras (self.model_cnn) no está cargado. Las predicciones fallarán. ---")
+        return CNNProcessor._model_cnn_internal_instance
 
     @classmethod
     def get_instance(cls):
@@ -73,62 +229,281 @@ class CNNProcessor:
             # print("--- CNN DEBUG: Reutilizando instancia existente de CNNProcessor (Singleton) ---")
         return cls._instance
 
-    def _preprocess_image(self, image_pil, target_size=(224, 224)):
+    def warm_up(self):
+        """
+        Corre una inferencia con una imagen sintética para que el primer usuario real no pague
+        la construcción del grafo. Devuelve la duración en ms.
+        """
+        started_at = time.perf_counter()
+        synthetic_image = Image.new("RGB", MODEL_INPUT_SIZE, color=(128, 128, 128))
+        self._run_inference(self._preprocess_image(synthetic_image))
+        warmup_ms = (time.perf_counter() - started_at) * 1000.0
+        print(f"--- CNN DEBUG: Warm-up de inferencia completado en {warmup_ms:.0f} ms ---")
+        return warmup_ms
+
+    def _preprocess_image(self, image_pil, target_size=MODEL_INPUT_SIZE):
         if not isinstance(image_pil, Image.Image):
             print("--- CNN ERROR: _preprocess_image esperaba un objeto PIL.Image ---")
             return None
         if image_pil.mode != "RGB":
             image_pil = image_pil.convert("RGB")
         image_pil = image_pil.resize(target_size)
-        image_array = img_to_array(image_pil)
+        image_array = np.asarray(image_pil, dtype=np.float32) # Equivalente a keras img_to_array para RGB
         image_array = np.expand_dims(image_array, axis=0)
         # Descomenta la siguiente línea si tu modelo fue entrenado con imágenes normalizadas a [0,1]
         # image_array = image_array / 255.0 
         return image_array
     
-    def predict_from_image_file(self, image_file_object):
-        if not self.model_cnn: # Verificar si el modelo se cargó correctamente
+    def predict_from_image_file(self, image_file_object, return_probabilities=False):
+        """
+        Devuelve (Desease o None, confianza en %). Con return_probabilities=True agrega un tercer
+        elemento: {nombre de enfermedad: %} con el vector completo, sin consultas extra a la BD.
+        """
+        predicted_desease_object, confidence, probabilities = self._predict_with_probabilities(image_file_object)
+        if not return_probabilities:
+            return predicted_desease_object, confidence
+        named_probabilities = desease_index.probabilities_by_name(probabilities) if probabilities is not None else {}
+        return predicted_desease_object, confidence, named_probabilities
+
+    def predict_from_image_files(self, image_file_objects, admitted=False):
+        """
+        Varias imágenes de la misma lesión en UN solo forward pass (las que no estén en caché).
+        Devuelve (Desease agregada, confianza agregada %, [(Desease, confianza %) por imagen]);
+        la predicción agregada es el promedio de los vectores de probabilidades.
+        admitted=True: el llamador ya tiene lugar en el limitador de la CNN (ver submit_prediction).
+        """
+        if not self.model_cnn and self.model_server_client is None:
             print("--- CNN ERROR: Modelo no cargado. No se puede realizar la predicción.")
+            return None, 0.0, [(None, 0.0) for _ in image_file_objects]
+
+        entries = self._predict_entries(image_file_objects, admitted=admitted)
+        per_image_results = [
+            (self._get_desease_for_index(entry[0]), entry[1]) if entry is not None else (None, 0.0)
+            for entry in entries
+        ]
+        aggregated_desease, aggregated_confidence = self.aggregate_prediction(
+            [entry[2] for entry in entries if entry is not None and entry[2] is not None]
+        )
+        return aggregated_desease, aggregated_confidence, per_image_results
+
+    def aggregate_prediction(self, probability_vectors):
+        """Predicción de un mensaje con varias imágenes: promedio de los vectores de probabilidades. (None, 0.0) si no hay."""
+        if not len(probability_vectors):
             return None, 0.0
+        return self._resolve_prediction(np.mean([np.asarray(vector, dtype=np.float32) for vector in probability_vectors], axis=0))
+
+    def submit_prediction(self, image_file_objects):
+        """
+        predict_from_image_files en un hilo del pool, para que la vista escriba la imagen al storage y
+        cree el Message mientras tanto. Cada archivo se copia a memoria antes de encolar: la CNN lee la
+        copia y el storage el original, sin compartir el puntero del archivo subido.
+        Devuelve un Future con ((Desease, confianza %, resultados por imagen), ms de la predicción).
+        El lugar en el limitador de la CNN se toma aquí, en el hilo del llamador: si no hay, AdmissionRejected
+        sale antes de que la vista guarde nada, y los hilos del pool nunca quedan esperando en la cola de admisión.
+        """
+        limiter = get_cnn_limiter()
+        limiter.acquire()
+        try:
+            image_copies = [self._in_memory_copy(image_file_object) for image_file_object in image_file_objects]
+            return self.get_prediction_executor().submit(self._timed_prediction, image_copies, limiter)
+        except BaseException:
+            limiter.release()
+            raise
+
+    def _timed_prediction(self, image_file_objects, limiter):
+        started_at = time.perf_counter()
+        try:
+            return self.predict_from_image_files(image_file_objects, admitted=True), (time.perf_counter() - started_at) * 1000.0
+        finally:
+            limiter.release()
+            connection.close() # Conexión propia de este hilo del pool (caché de predicciones)
+
+    def _in_memory_copy(self, image_file_object):
+        image_copy = ContentFile(self._read_upload_bytes(image_file_object) or b"", name=getattr(image_file_object, 'name', None))
+        # La decodificación hecha al validar el formulario se comparte (solo lectura)
+        image_copy.model_input_image = getattr(image_file_object, 'model_input_image', None)
+        return image_copy
+
+    def _predict_with_probabilities(self, image_file_object):
+        if not self.model_cnn and self.model_server_client is None: # Verificar si el modelo se cargó correctamente
+            print("--- CNN ERROR: Modelo no cargado. No se puede realizar la predicción.")
+            return None, 0.0, None
 
-        print(f"--- CNN DEBUG: Iniciando predicción para: {getattr(image_file_object, 'name', 'archivo_desconocido')} ---")
+        entry = self._predict_entries([image_file_object])[0]
+        if entry is None:
+            return None, 0.0, None
+        index_prediction, confidence, probabilities = entry
+        predicted_desease_object = self._get_desease_for_index(index_prediction)
+        if predicted_desease_object is not None:
+            print(f"--- CNN DEBUG: Predicción - Índice: {index_prediction}, Confianza: {confidence:.2f}%, Enfermedad: {predicted_desease_object.name_desease}")
+        return predicted_desease_object, confidence, probabilities
+
+    def _read_upload_bytes(self, image_file_object):
         try:
             # Asegurarse de que el puntero del archivo esté al inicio si ya fue leído
             if hasattr(image_file_object, 'seek') and callable(image_file_object.seek):
                 image_file_object.seek(0)
-            img_pil = Image.open(image_file_object)
+            image_bytes = image_file_object.read()
+            if hasattr(image_file_object, 'seek') and callable(image_file_object.seek):
+                image_file_object.seek(0) # Dejarlo listo para que Django guarde el archivo
+            return image_bytes
         except Exception as e:
-            print(f"--- CNN ERROR: No se pudo abrir la imagen con PIL: {e}")
-            return None, 0.0
+            print(f"--- CNN ERROR: No se pudo leer el archivo de imagen: {e}")
+            return None
 
-        processed_image_array = self._preprocess_image(img_pil)
-        if processed_image_array is None:
-            return None, 0.0
-        
-        try:
-            predictions_array = self.model_cnn.predict(processed_image_array)
-            # print(f"--- CNN DEBUG: Array de predicciones crudas: {predictions_array}")
-        except Exception as e:
-            print(f"--- CNN ERROR: Falló la predicción del modelo Keras (self.model_cnn.predict): {e}")
-            return None, 0.0
+    def _predict_entries(self, image_file_objects, admitted=False):
+        """
+        Para cada archivo devuelve (índice, confianza %, probabilidades) o None si falló.
+        Las imágenes que no están en la caché de predicciones se infieren juntas en un solo lote.
+        """
+        prediction_cache = self.get_prediction_cache()
+        entries = [None] * len(image_file_objects)
+        pending = [] # (posición, hash, array preprocesado)
+
+        timers = [StageTimer(f"CNN {getattr(f, 'name', 'archivo_desconocido')}") for f in image_file_objects]
+
+        for position, image_file_object in enumerate(image_file_objects):
+            print(f"--- CNN DEBUG: Iniciando predicción para: {getattr(image_file_object, 'name', 'archivo_desconocido')} ---")
+            timer = timers[position]
+            with timer.stage("read"):
+                image_bytes = self._read_upload_bytes(image_file_object)
+            if image_bytes is None:
+                continue
+
+            # Caché por contenido: se hashean los bytes crudos ANTES de decodificar
+            image_hash = None
+            if prediction_cache is not None:
+                with timer.stage("cache"):
+                    image_hash = hash_image_bytes(image_bytes)
+                    cached_entry = prediction_cache.get(image_hash)
+                if cached_entry is not None:
+                    print(f"--- CNN DEBUG: Caché HIT para imagen {image_hash[:12]} (índice {cached_entry[0]}, {cached_entry[1]:.2f}%) ---")
+                    entries[position] = cached_entry
+                    timer.log()
+                    continue
+
+            # Reutilizar la decodificación hecha al validar el formulario (ver image_pipeline.py)
+            img_pil = getattr(image_file_object, 'model_input_image', None)
+            if img_pil is None:
+                try:
+                    with timer.stage("decode"):
+                        img_pil = decode_for_model(image_bytes)
+                except Exception as e:
+                    print(f"--- CNN ERROR: No se pudo abrir la imagen con PIL: {e}")
+                    continue
+
+            with timer.stage("preprocess"):
+                processed_image_array = self._preprocess_image(img_pil)
+            if processed_image_array is not None:
+                pending.append((position, image_hash, processed_image_array))
 
-        index_prediction = np.argmax(predictions_array[0])
-        confidence = float(np.max(predictions_array[0]) * 100) # Convertir a float de Python
+        if not pending:
+            return entries
 
+        # Tope global de peticiones en vuelo (los aciertos de caché no cuentan), incluida la espera en el
+        # CNNBatchScheduler; si no hay lugar, AdmissionRejected sube al llamador. Con admitted=True el lugar
+        # ya lo tomó submit_prediction antes de que la vista guardara el mensaje.
+        with (nullcontext() if admitted else get_cnn_limiter().slot()):
+            try:
+                inference_started = time.perf_counter()
+                predictions_array = self._run_inference(np.concatenate([array for _, _, array in pending], axis=0))
+                inference_ms = (time.perf_counter() - inference_started) * 1000.0
+                # print(f"--- CNN DEBUG: Array de predicciones crudas: {predictions_array}")
+            except Exception as e:
+                print(f"--- CNN ERROR: Falló la predicción del backend CNN: {e}")
+                return entries
+
+        for (position, image_hash, _), probabilities in zip(pending, predictions_array):
+            entry = (int(np.argmax(probabilities)), float(np.max(probabilities) * 100), [float(p) for p in probabilities])
+            if prediction_cache is not None:
+                prediction_cache.set(image_hash, entry[0], entry[1], probabilities=entry[2])
+            entries[position] = entry
+            timers[position].stages["inference (lote)"] = inference_ms
+            timers[position].log()
+        return entries
+
+    def get_prediction_cache(self):
+        """
+        Devuelve la PredictionCache del proceso, o None si está deshabilitada
+        o si no hay versión de modelo (modelo no cargado).
+        """
+        if not getattr(settings, 'CNN_PREDICTION_CACHE_ENABLED', True) or CNNProcessor._model_version is None:
+            return None
+        if CNNProcessor._prediction_cache is None:
+            with CNNProcessor._prediction_cache_lock:
+                if CNNProcessor._prediction_cache is None:
+                    CNNProcessor._prediction_cache = PredictionCache(
+                        CNNProcessor._model_version,
+                        max_memory_entries=getattr(settings, 'CNN_PREDICTION_CACHE_MAX_ENTRIES', 1024),
+                        persist_to_db=getattr(settings, 'CNN_PREDICTION_CACHE_PERSIST', True),
+                    )
+        return CNNProcessor._prediction_cache
+
+    def get_batch_scheduler(self):
+        """
+        Devuelve el CNNBatchScheduler del proceso (creándolo la primera vez),
+        o None si el micro-batching está deshabilitado en settings.
+        """
+        if not getattr(settings, 'CNN_BATCHING_ENABLED', True):
+            return None
+        if CNNProcessor._batch_scheduler is None:
+            with CNNProcessor._batch_scheduler_lock:
+                if CNNProcessor._batch_scheduler is None:
+                    CNNProcessor._batch_scheduler = CNNBatchScheduler(
+                        self._predict_batch,
+                        max_batch_size=cnn_batch_max_size(),
+                        max_wait_ms=getattr(settings, 'CNN_BATCH_MAX_WAIT_MS', 5.0),
+                    )
+        return CNNProcessor._batch_scheduler
+
+    def get_prediction_executor(self):
+        if CNNProcessor._prediction_executor is None:
+            with CNNProcessor._prediction_executor_lock:
+                if CNNProcessor._prediction_executor is None:
+                    CNNProcessor._prediction_executor = ThreadPoolExecutor(
+                        max_workers=getattr(settings, 'CHATBOT_CNN_OVERLAP_WORKERS', 8),
+                        thread_name_prefix='cnn-overlap',
+                    )
+        return CNNProcessor._prediction_executor
+
+    def _predict_batch(self, batch_array):
+        if self.model_server_client is not None:
+            try:
+                return self.model_server_client.predict(batch_array)
+            except (OSError, CNNModelServerError) as e:
+                print(f"--- CNN ADVERTENCIA: Falló el servidor de modelo ({e}). Usando inferencia en este proceso. ---")
+        if self.model_cnn is None:
+            self.model_cnn = self._load_local_backend()
+            if self.model_cnn is None:
+                raise RuntimeError("Modelo CNN no disponible ni en el servidor ni en este proceso.")
+        return self.model_cnn.predict(batch_array)
+
+    def _run_inference(self, batch_array):
+        """Corre la inferencia de un array (N, H, W, C), agrupando con otras peticiones si hay scheduler."""
+        scheduler = self.get_batch_scheduler()
+        if scheduler is None:
+            return self._predict_batch(batch_array)
+        return scheduler.predict(batch_array, timeout=getattr(settings, 'CNN_INFERENCE_TIMEOUT_SECONDS', 30))
+
+    def _resolve_prediction(self, probabilities):
+        """Convierte un vector de probabilidades en (Desease o None, confianza en %)."""
+        index_prediction = int(np.argmax(probabilities))
+        confidence = float(np.max(probabilities) * 100) # Convertir a float de Python
+        predicted_desease_object = self._get_desease_for_index(index_prediction)
+        if predicted_desease_object is not None:
+            print(f"--- CNN DEBUG: Predicción - Índice: {index_prediction}, Confianza: {confidence:.2f}%, Enfermedad: {predicted_desease_object.name_desease}")
+        return predicted_desease_object, confidence
+
+    def _get_desease_for_index(self, index_prediction):
         predicted_desease_object = None
         try:
-            # Asumiendo que cnn_prediction_index es único en tu modelo Desease
-            predicted_desease_object = Desease.objects.get(cnn_prediction_index=index_prediction)
-            print(f"--- CNN DEBUG: Predicción - Índice: {index_prediction}, Confianza: {confidence:.2f}%, Enfermedad: {predicted_desease_object.name_desease}")
-        except Desease.DoesNotExist:
-            print(f"--- CNN ADVERTENCIA: No se encontró Desease en BD para cnn_prediction_index: {index_prediction}")
-        except Desease.MultipleObjectsReturned:
-             print(f"--- CNN ADVERTENCIA: Múltiples Desease para cnn_prediction_index: {index_prediction}. Usando la primera.")
-             predicted_desease_object = Desease.objects.filter(cnn_prediction_index=index_prediction).first()
+            # Índice en memoria (sin consulta a la BD por imagen); se invalida al cambiar Desease
+            predicted_desease_object = desease_index.get(index_prediction)
+            if predicted_desease_object is None:
+                print(f"--- CNN ADVERTENCIA: No se encontró Desease en BD para cnn_prediction_index: {index_prediction}")
         except Exception as e:
             print(f"--- CNN ERROR al buscar Desease por índice ({index_prediction}): {e}")
-
-        return predicted_desease_object, confidence
+        return predicted_desease_object
 
     def convert_pil_to_django_image_file(self, pil_image, original_filename="processed_image.jpg"):
         # Este método podría no ser necesario aquí si predict_from_image_file toma el objeto archivo de Django
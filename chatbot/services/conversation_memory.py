@@ -0,0 +1,294 @@
+# chatbot/services/conversation_memory.py
+"""
+Memoria de conversación acotada para el grafo de LangGraph.
+
+MemorySaver guarda todos los checkpoints de todos los hilos para siempre y solo en el proceso
+actual. BoundedMemorySaver:
+- guarda solo el último checkpoint de cada hilo (el historial completo ya está en ese checkpoint);
+- mantiene los hilos en un LRU acotado por cantidad, por TTL y por un techo de memoria
+  (bytes serializados aproximados);
+- ante un miss (hilo desalojado, reinicio o conversación que cae en otro worker) reconstruye el
+  estado desde las filas Message de la Conversation, partiendo del resumen rodante guardado en
+  Conversation.history_summary (los mensajes que ya cubre no se vuelven a cargar);
+- valida el checkpoint en memoria contra la cantidad de mensajes del usuario en la BD: si hay más
+  de un turno nuevo desde la última vez que este proceso vio el hilo (p. ej. A -> B -> A entre
+  workers), otro proceso respondió turnos que este checkpoint no tiene y se reconstruye.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from asgiref.sync import sync_to_async
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.memory import MemorySaver
+
+from ..models import ChatJob, Conversation, Message
+from .turn_input import NO_USER_INPUT_TEXT
+
+
+def _conversation_uuid(thread_id):
+    try:
+        return uuid.UUID(str(thread_id))
+    except ValueError:
+        return None
+
+
+def load_thread_messages(thread_id):
+    """
+    Historial de la conversación como mensajes de LangChain, desde la BD.
+    Se descartan los mensajes de usuario al final: son el turno en curso (la vista guarda el
+    mensaje antes de llamar al agente) y el grafo los agrega al invocarse.
+    """
+    conversation_uuid = _conversation_uuid(thread_id)
+    if conversation_uuid is None:
+        return []
+
+    rows = list(
+        Message.objects.filter(conversation_id=conversation_uuid)
+        .exclude(chat_job__status__in=[ChatJob.STATUS_PENDING, ChatJob.STATUS_RUNNING]) # Respuestas que aún procesa la cola
+        .select_related('cnn_predicted_desease')
+        .order_by('timestamp')
+    )
+    while rows and not rows[-1].is_bot:
+        rows.pop()
+
+    history = []
+    for row in rows:
+        content = row.content or ""
+        message_id = f"db-{row.id}" # Los mensajes necesitan id para poder quitarlos al compactar el historial
+        if row.is_bot:
+            history.append(AIMessage(content=content, id=message_id))
+            continue
+        if row.cnn_predicted_desease:
+            # Mismo tipo de contexto que arma ChatWindowView para el LLM (aproximado)
+            image_context = (
+                f"Contexto de imagen: El análisis preliminar de la imagen subida por el usuario sugiere "
+                f"que podría estar relacionado con '{row.cnn_predicted_desease.name_desease}' "
+                f"(confianza de la CNN: {row.cnn_confidence or 0.0:.1f}%)."
+            )
+            content = f"{image_context} El usuario también comentó: '{content}'" if content else image_context
+        history.append(HumanMessage(content=content or NO_USER_INPUT_TEXT, id=message_id))
+    return history
+
+
+def load_thread_state(thread_id):
+    """
+    Valores de canal para reconstruir el hilo: mensajes de la BD más el resumen rodante guardado.
+    Los primeros history_summary_messages mensajes ya están en el resumen y no se cargan.
+    """
+    history = load_thread_messages(thread_id)
+    if not history:
+        return {}
+    summary, summarized_messages = (
+        Conversation.objects.filter(id=_conversation_uuid(thread_id))
+        .values_list('history_summary', 'history_summary_messages')
+        .first()
+    ) or ("", 0)
+    if not summary or summarized_messages >= len(history):
+        return {"messages": history} # Sin resumen, o no coincide con la BD (mensajes borrados): historial completo
+    return {
+        "messages": history[summarized_messages:],
+        "conversation_summary": summary,
+        "summarized_messages": summarized_messages,
+    }
+
+
+def save_thread_summary(thread_id, summary, summarized_messages):
+    """Guarda el resumen rodante del hilo para que otro worker lo reconstruya sin volver a resumir."""
+    conversation_uuid = _conversation_uuid(thread_id)
+    if conversation_uuid is None:
+        return
+    Conversation.objects.filter(id=conversation_uuid).update(history_summary=summary, history_summary_messages=summarized_messages)
+
+
+def count_user_messages(thread_id):
+    """Mensajes del usuario guardados en la conversación (uno por turno, incluido el que está en curso)."""
+    conversation_uuid = _conversation_uuid(thread_id)
+    if conversation_uuid is None:
+        return None
+    return Message.objects.filter(conversation_id=conversation_uuid, is_bot=False).count()
+
+
+class BoundedMemorySaver(MemorySaver):
+
+    def __init__(self, max_threads=1000, ttl_seconds=3600, max_bytes=256 * 1024 * 1024,
+                 history_loader=load_thread_state, turn_counter=count_user_messages):
+        super().__init__()
+        self.max_threads = max_threads
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.history_loader = history_loader
+        self.turn_counter = turn_counter
+        self._synced_turns = {} # thread_id -> mensajes del usuario en la BD la última vez que se usó el checkpoint
+        self._lock = threading.RLock()
+        self._last_access = OrderedDict() # thread_id -> time.monotonic() del último uso (orden LRU)
+        self._thread_bytes = {}
+        self._blob_keys = defaultdict(set) # thread_id -> claves de self.blobs (evita recorrer todo al borrar)
+        self.hits = 0
+        self.misses = 0
+        self.rehydrations = 0
+        self.stale_rebuilds = 0
+        self.evictions = 0
+
+    # --- API de BaseCheckpointSaver ---
+
+    def get_tuple(self, config):
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        is_latest_lookup = not configurable.get("checkpoint_id") and not configurable.get("checkpoint_ns")
+        # Consulta a la BD fuera del lock: no frena a los demás hilos
+        persisted_turns = self.turn_counter(thread_id) if is_latest_lookup and self.turn_counter is not None else None
+        with self._lock:
+            self._evict_expired()
+            checkpoint_tuple = super().get_tuple(config)
+            if not is_latest_lookup:
+                return checkpoint_tuple
+            if checkpoint_tuple is not None:
+                if not self._is_behind_database(thread_id, persisted_turns):
+                    self.hits += 1
+                    self._touch(thread_id)
+                    self._record_synced_turns(thread_id, persisted_turns)
+                    return checkpoint_tuple
+                self.stale_rebuilds += 1
+                print(f"--- DEBUG AGENT: Memoria - hilo {thread_id} desactualizado (otro proceso respondió turnos): se reconstruye desde la BD ---")
+                self.delete_thread(thread_id)
+
+            self.misses += 1
+            rehydrated = self._rehydrate(thread_id)
+            # También sin historial: el checkpoint que cree este turno queda asociado a esta cantidad
+            self._record_synced_turns(thread_id, persisted_turns)
+            return super().get_tuple(config) if rehydrated else None
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self._lock:
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            self._blob_keys[thread_id].update((thread_id, checkpoint_ns, channel, version) for channel, version in new_versions.items())
+            self._keep_only_latest(thread_id, checkpoint_ns, checkpoint)
+            self._touch(thread_id)
+            self._enforce_limits(keep_thread_id=thread_id)
+        return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        with self._lock:
+            super().put_writes(config, writes, task_id, task_path)
+
+    async def aget_tuple(self, config):
+        # MemorySaver.aget_tuple llama a get_tuple en el event loop; acá un miss rehidrata con el ORM
+        # (prohibido en contexto async), así que se delega a un hilo. aput/aput_writes no tocan la BD.
+        return await sync_to_async(self.get_tuple)(config)
+
+    def delete_thread(self, thread_id):
+        with self._lock:
+            self.storage.pop(thread_id, None)
+            for key in [key for key in self.writes if key[0] == thread_id]:
+                del self.writes[key]
+            for key in self._blob_keys.pop(thread_id, ()):
+                self.blobs.pop(key, None)
+            self._last_access.pop(thread_id, None)
+            self._thread_bytes.pop(thread_id, None)
+            self._synced_turns.pop(thread_id, None)
+
+    # --- Validación contra la BD ---
+
+    def _is_behind_database(self, thread_id, persisted_turns):
+        """
+        True si la BD tiene turnos que el checkpoint no. Entre dos usos seguidos del hilo en este proceso
+        la cuenta avanza a lo sumo en uno (el mensaje del turno en curso); más que eso es un turno ajeno.
+        """
+        synced_turns = self._synced_turns.get(thread_id)
+        return persisted_turns is not None and synced_turns is not None and persisted_turns > synced_turns + 1
+
+    def _record_synced_turns(self, thread_id, persisted_turns):
+        if persisted_turns is not None:
+            self._synced_turns[thread_id] = max(persisted_turns, self._synced_turns.get(thread_id, 0))
+
+    # --- Acotamiento ---
+
+    def _touch(self, thread_id):
+        self._last_access[thread_id] = time.monotonic()
+        self._last_access.move_to_end(thread_id)
+
+    def _keep_only_latest(self, thread_id, checkpoint_ns, latest_checkpoint):
+        """Borra checkpoints anteriores del hilo y los blobs que ya no referencia ninguno."""
+        saved = self.storage[thread_id][checkpoint_ns]
+        for checkpoint_id in [checkpoint_id for checkpoint_id in saved if checkpoint_id != latest_checkpoint["id"]]:
+            del saved[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+        live_keys = {(thread_id, checkpoint_ns, channel, version) for channel, version in latest_checkpoint["channel_versions"].items()}
+        blob_keys = self._blob_keys[thread_id]
+        for key in [key for key in blob_keys if key[1] == checkpoint_ns and key not in live_keys]:
+            self.blobs.pop(key, None)
+            blob_keys.discard(key)
+
+        size = sum(len(self.blobs[key][1]) for key in blob_keys if key in self.blobs)
+        for namespace_saved in self.storage[thread_id].values():
+            size += sum(len(checkpoint[1]) + len(metadata[1]) for checkpoint, metadata, _ in namespace_saved.values())
+        self._thread_bytes[thread_id] = size
+
+    def _evict(self, thread_id, reason):
+        self.delete_thread(thread_id)
+        self.evictions += 1
+        print(f"--- DEBUG AGENT: Memoria - hilo {thread_id} desalojado ({reason}). Hilos en memoria: {len(self._last_access)} ---")
+
+    def _evict_expired(self):
+        if not self.ttl_seconds:
+            return
+        deadline = time.monotonic() - self.ttl_seconds
+        while self._last_access:
+            oldest_thread_id, last_access = next(iter(self._last_access.items()))
+            if last_access > deadline:
+                break
+            self._evict(oldest_thread_id, "TTL vencido")
+
+    def _enforce_limits(self, keep_thread_id):
+        self._evict_expired()
+        while len(self._last_access) > 1 and (
+            (self.max_threads and len(self._last_access) > self.max_threads)
+            or (self.max_bytes and sum(self._thread_bytes.values()) > self.max_bytes)
+        ):
+            oldest_thread_id = next(iter(self._last_access))
+            if oldest_thread_id == keep_thread_id:
+                break
+            self._evict(oldest_thread_id, "límite de hilos o de memoria")
+
+    def _rehydrate(self, thread_id):
+        """Reconstruye el estado del hilo desde la BD. Devuelve True si había historial."""
+        if self.history_loader is None:
+            return False
+        channel_values = self.history_loader(thread_id)
+        if not channel_values.get("messages"):
+            return False
+
+        checkpoint = empty_checkpoint()
+        version = self.get_next_version(None, None)
+        channel_versions = {channel: version for channel in channel_values}
+        checkpoint["channel_values"] = dict(channel_values)
+        checkpoint["channel_versions"] = channel_versions
+        self.put(
+            {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}},
+            checkpoint,
+            {"source": "update", "step": -1, "parents": {}},
+            dict(channel_versions),
+        )
+        self.rehydrations += 1
+        summary_note = f", resumen de {channel_values['summarized_messages']} mensajes previos" if channel_values.get("conversation_summary") else ""
+        print(f"--- DEBUG AGENT: Memoria - hilo {thread_id} reconstruido desde la BD ({len(channel_values['messages'])} mensajes{summary_note}) ---")
+        return True
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'threads': len(self._last_access),
+                'approx_bytes': sum(self._thread_bytes.values()),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'rehydrations': self.rehydrations,
+                'stale_rebuilds': self.stale_rebuilds,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,88 @@
+# chatbot/services/desease_index.py
+"""
+Índice en memoria cnn_prediction_index -> Desease.
+
+La tabla tiene ~7 filas y casi nunca cambia, así que no vale la pena un round trip a la BD
+por cada inferencia. El índice se reconstruye cuando:
+- llega post_save/post_delete de Desease en este proceso (ver chatbot/signals.py);
+- cambia el sello de versión en el caché de Django (compartido entre procesos si el
+  caché configurado lo es, p. ej. Redis/Memcached/BD);
+- vence DESEASE_INDEX_TTL_SECONDS (respaldo para cachés locales por proceso).
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..models import Desease
+
+VERSION_CACHE_KEY = 'chatbot:desease_index:version'
+
+
+class DeseaseIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_index = None
+        self._version = None
+        self._built_at = 0.0
+
+    def _current_version(self):
+        return cache.get(VERSION_CACHE_KEY, 0)
+
+    def _is_stale(self, mapping, version):
+        ttl_seconds = getattr(settings, 'DESEASE_INDEX_TTL_SECONDS', 300)
+        return (
+            mapping is None
+            or version != self._version
+            or (ttl_seconds and time.monotonic() - self._built_at > ttl_seconds)
+        )
+
+    def _get_mapping(self):
+        # Se trabaja sobre una referencia local: invalidate() puede poner _by_index en None desde otro hilo
+        version = self._current_version()
+        mapping = self._by_index
+        if self._is_stale(mapping, version):
+            with self._lock:
+                mapping = self._by_index
+                if self._is_stale(mapping, version):
+                    mapping = {}
+                    for desease in Desease.objects.exclude(cnn_prediction_index__isnull=True):
+                        # Con duplicados (no debería haber: el campo es unique) gana el primero, como .first()
+                        mapping.setdefault(desease.cnn_prediction_index, desease)
+                    self._by_index = mapping
+                    self._version = version
+                    self._built_at = time.monotonic()
+                    print(f"--- CNN DEBUG: Índice de Desease reconstruido ({len(mapping)} entradas, versión {version}) ---")
+        return mapping
+
+    def get(self, cnn_prediction_index):
+        """Desease para el índice de clase de la CNN, o None si no hay ninguna configurada."""
+        return self._get_mapping().get(int(cnn_prediction_index))
+
+    def probabilities_by_name(self, probabilities):
+        """
+        Mapea el vector completo de probabilidades de la CNN a {nombre de enfermedad: %},
+        ordenado de mayor a menor, sin consultas extra a la BD.
+        """
+        mapping = self._get_mapping()
+        named = {}
+        for index, probability in enumerate(probabilities):
+            desease = mapping.get(index)
+            name = desease.name_desease if desease else f"Clase {index} (sin Desease asociada)"
+            named[name] = float(probability) * 100
+        return dict(sorted(named.items(), key=lambda item: item[1], reverse=True))
+
+    def invalidate(self):
+        """Descarta el índice local y avanza el sello de versión compartido."""
+        with self._lock:
+            self._by_index = None
+        try:
+            cache.add(VERSION_CACHE_KEY, 0, timeout=None)
+            cache.incr(VERSION_CACHE_KEY)
+        except Exception as e:
+            print(f"--- CNN ADVERTENCIA: No se pudo actualizar la versión del índice de Desease en el caché: {e}")
+
+
+desease_index = DeseaseIndex()
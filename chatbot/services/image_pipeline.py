@@ -0,0 +1,89 @@
+# chatbot/services/image_pipeline.py
+"""
+Pipeline de subida de imágenes: una sola decodificación, directo a (casi) el tamaño del modelo.
+
+El formulario (MultipleImageField) valida la subida decodificándola con decode_for_model() y
+deja la imagen reducida en el archivo subido (atributo model_input_image); CNNProcessor la
+reutiliza en vez de volver a abrir el archivo. Para JPEG se usa el modo draft (el decodificador
+escala 1/2, 1/4 o 1/8 en el dominio DCT) y para el resto Image.reduce. Antes de decodificar
+se aplica un techo de píxeles leyendo solo la cabecera.
+"""
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image
+
+MODEL_INPUT_SIZE = (224, 224) # (ancho, alto) de entrada de la CNN
+# Parte de la clave de la caché de predicciones: subirla al cambiar cómo se decodifica o redimensiona,
+# porque los mismos bytes dan otra entrada al modelo (y otras probabilidades)
+PREPROCESSING_VERSION = 'draft-reduce-1'
+
+
+class ImageTooLargeError(ValueError):
+    """La imagen supera CHATBOT_MAX_IMAGE_PIXELS (se detecta solo con la cabecera)."""
+
+
+class StageTimer:
+    """Acumula la duración de cada etapa (ms) y la imprime en una sola línea de log."""
+
+    def __init__(self, label):
+        self.label = label
+        self.stages = {}
+        self.overlapped = {} # Etapas que corrieron en otro hilo en paralelo: (ms totales, ms que igual se esperaron)
+
+    @contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - started_at) * 1000.0
+
+    def record_overlapped(self, name, elapsed_ms, waited_ms):
+        """Etapa que corrió en paralelo con las demás; no suma al total, solo lo que hubo que esperarla."""
+        self.overlapped[name] = (elapsed_ms, waited_ms)
+
+    @property
+    def total_ms(self):
+        return sum(self.stages.values())
+
+    @property
+    def overlap_saved_ms(self):
+        return sum(max(0.0, elapsed_ms - waited_ms) for elapsed_ms, waited_ms in self.overlapped.values())
+
+    def log(self):
+        stages_text = ", ".join(f"{name}={ms:.1f} ms" for name, ms in self.stages.items())
+        if self.overlapped:
+            overlapped_text = ", ".join(
+                f"{name}={elapsed_ms:.1f} ms (esperados {waited_ms:.1f} ms)" for name, (elapsed_ms, waited_ms) in self.overlapped.items()
+            )
+            stages_text += f"; en paralelo: {overlapped_text}, ahorrados {self.overlap_saved_ms:.1f} ms"
+        print(f"--- PIPELINE DEBUG: {self.label} - {stages_text} (total {self.total_ms:.1f} ms) ---")
+
+
+def decode_for_model(source, target_size=MODEL_INPUT_SIZE):
+    """
+    Decodifica bytes (o un archivo) a una imagen RGB de tamaño cercano -y nunca menor- a target_size.
+    Lanza ImageTooLargeError si la cabecera declara más píxeles que CHATBOT_MAX_IMAGE_PIXELS.
+    """
+    image = Image.open(BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    width, height = image.size # Solo se leyó la cabecera: todavía no hubo decodificación
+    max_pixels = getattr(settings, 'CHATBOT_MAX_IMAGE_PIXELS', 40_000_000)
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLargeError(
+            f"La imagen tiene {width}x{height} píxeles; el máximo permitido es {max_pixels:,} píxeles."
+        )
+
+    use_draft = image.format == 'JPEG' and getattr(settings, 'CHATBOT_IMAGE_DRAFT_DECODE', True)
+    if use_draft:
+        image.draft('RGB', target_size)
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if not use_draft:
+        reduce_factor = min(image.width // target_size[0], image.height // target_size[1])
+        if reduce_factor >= 2:
+            image = image.reduce(reduce_factor)
+    return image
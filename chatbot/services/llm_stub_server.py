@@ -0,0 +1,189 @@
+# chatbot/services/llm_stub_server.py
+"""
+Servidor HTTP local que imita POST /v1/chat/completions de OpenAI, con una latencia fija y, si se
+pide, fallas inyectadas (una fracción de respuestas muy lentas y otra de errores 5xx).
+
+Sirve para pruebas de carga y de integración sin gastar tokens ni depender de la red: se apunta
+ChatOpenAI a base_url del stub (OPENAI_BASE_URL). Cuenta las peticiones y el máximo de llamadas
+en vuelo al mismo tiempo, que es lo que mide cuánta concurrencia real logra el servidor Django.
+"""
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = (
+    "Entendido. ¿Desde cuándo tienes esta afección o estos síntomas? "
+    "¿Aparecieron de repente o de forma gradual?"
+)
+
+
+class StubLLMServer:
+
+    def __init__(self, host='127.0.0.1', port=0, delay_seconds=1.0, reply_text=DEFAULT_REPLY,
+                 slow_rate=0.0, slow_delay_seconds=10.0, error_rate=0.0, error_status=503, seed=None):
+        self.delay_seconds = delay_seconds
+        self.reply_text = reply_text
+        self.slow_rate = slow_rate # Fracción de peticiones que tardan slow_delay_seconds (cola de latencia)
+        self.slow_delay_seconds = slow_delay_seconds
+        self.error_rate = error_rate # Fracción de peticiones que responden error_status
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.slow_injected = 0
+        self.errors_injected = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cached_tokens_total = 0
+        self._previous_prompt = ""
+        self._server = ThreadingHTTPServer((host, port), self._build_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _build_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args): # Sin log por petición
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                request_data = json.loads(body or b'{}')
+                with stub._lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    fault = stub._pick_fault()
+                    if fault == 'error':
+                        time.sleep(stub.delay_seconds / 10.0)
+                        self._write_error()
+                        return
+                    time.sleep(stub.slow_delay_seconds if fault == 'slow' else stub.delay_seconds) # "Generación" del modelo
+                    reply_text = stub._reply_for(request_data)
+                    prompt_text = "".join(str(message.get('content', '')) for message in request_data.get('messages', []))
+                    prompt_chars = len(prompt_text)
+                    cached_tokens = stub._cached_prompt_tokens(prompt_text)
+                    usage = {
+                        "prompt_tokens": prompt_chars // 4,
+                        "completion_tokens": len(reply_text) // 4,
+                        "total_tokens": (prompt_chars + len(reply_text)) // 4,
+                        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                    }
+                    if request_data.get('stream'):
+                        self._write_stream(request_data, reply_text, usage)
+                        return
+                    payload = {
+                        "id": f"chatcmpl-stub-{stub.requests}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request_data.get('model', 'gpt-4o-mini'),
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": reply_text},
+                            "finish_reason": "stop",
+                        }],
+                        "usage": usage,
+                    }
+                    encoded = json.dumps(payload).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(encoded)))
+                    self.end_headers()
+                    self.wfile.write(encoded)
+                except (BrokenPipeError, ConnectionResetError): # El cliente abandonó la petición (p. ej. réplica perdedora)
+                    pass
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+            def _write_error(self):
+                encoded = json.dumps({"error": {"message": "Falla inyectada por el stub", "type": "server_error", "code": None}}).encode('utf-8')
+                self.send_response(stub.error_status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def _write_stream(self, request_data, reply_text, usage):
+                """Respuesta con stream=True: chunks SSE palabra por palabra, más el de usage si se pidió."""
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                base_chunk = {"id": f"chatcmpl-stub-{stub.requests}", "object": "chat.completion.chunk", "created": int(time.time()), "model": request_data.get('model', 'gpt-4o-mini')}
+                words = reply_text.split(' ')
+                for position, word in enumerate(words):
+                    text = word if position == len(words) - 1 else f"{word} "
+                    chunk = {**base_chunk, "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                final_chunk = {**base_chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+                self.wfile.write(f"data: {json.dumps(final_chunk)}\n\n".encode('utf-8'))
+                if (request_data.get('stream_options') or {}).get('include_usage'):
+                    self.wfile.write(f"data: {json.dumps({**base_chunk, 'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+        return Handler
+
+    def _pick_fault(self):
+        """None, 'slow' o 'error' según las fracciones configuradas."""
+        with self._lock:
+            draw = self._random.random()
+            if draw < self.error_rate:
+                self.errors_injected += 1
+                return 'error'
+            if draw < self.error_rate + self.slow_rate:
+                self.slow_injected += 1
+                return 'slow'
+        return None
+
+    def _reply_for(self, request_data):
+        """Texto fijo, o un JSON que cumple el esquema si se pidió salida estructurada (response_format json_schema)."""
+        response_format = request_data.get('response_format') or {}
+        if response_format.get('type') != 'json_schema':
+            return self.reply_text
+        properties = response_format.get('json_schema', {}).get('schema', {}).get('properties', {})
+        return json.dumps({name: f"(stub) {name}" for name in properties}, ensure_ascii=False)
+
+    def _cached_prompt_tokens(self, prompt_text):
+        """
+        Imita la caché de prefijo de OpenAI: tokens del prefijo común con el prompt anterior,
+        en bloques de 128 y solo a partir de 1024 (aprox. 4 caracteres por token).
+        """
+        with self._lock:
+            previous_prompt, self._previous_prompt = self._previous_prompt, prompt_text
+            common_tokens = len(os.path.commonprefix([previous_prompt, prompt_text])) // 4
+            cached_tokens = (common_tokens // 128) * 128 if common_tokens >= 1024 else 0
+            self.cached_tokens_total += cached_tokens
+        return cached_tokens
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='llm-stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.max_in_flight = 0
+            self.cached_tokens_total = 0
+            self.slow_injected = 0
+            self.errors_injected = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
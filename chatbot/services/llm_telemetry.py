@@ -0,0 +1,139 @@
+# chatbot/services/llm_telemetry.py
+"""
+Telemetría por llamada al LLM (modelo LLMTurnTelemetry).
+
+El agente guarda una fila por turno con los tokens (prompt, respuesta y los servidos desde la
+caché de prefijo del proveedor), el modelo, la duración, el tiempo al primer token (solo en
+stream) y la clase de error si la hubo. La vista, o el worker de la cola, enlaza esas filas con
+el Message del bot cuando lo guarda. El admin muestra percentiles diarios calculados en una sola
+consulta agregada (percentile_cont en PostgreSQL; en otros motores, una sola consulta de valores
+y los percentiles en Python).
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+from django.db import connection
+from django.db.models import Aggregate, Avg, Count, FloatField, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from ..models import LLMTurnTelemetry
+
+DAILY_PERCENTILES = (50, 95, 99)
+
+
+def usage_from_response(response):
+    """Tokens y nombre de modelo de un AIMessage (usage_metadata / response_metadata de langchain)."""
+    usage = getattr(response, 'usage_metadata', None) or {}
+    response_metadata = getattr(response, 'response_metadata', None) or {}
+    return {
+        'prompt_tokens': usage.get('input_tokens', 0) or 0,
+        'completion_tokens': usage.get('output_tokens', 0) or 0,
+        'cached_tokens': (usage.get('input_token_details') or {}).get('cache_read', 0) or 0,
+        'model_name': response_metadata.get('model_name', ''),
+    }
+
+
+def save_turn(conversation_id, call_mode, telemetry):
+    return LLMTurnTelemetry.objects.create(
+        conversation_id=conversation_id,
+        call_mode=call_mode,
+        model_name=(telemetry.get('model_name') or '')[:64],
+        prompt_tokens=telemetry.get('prompt_tokens', 0),
+        completion_tokens=telemetry.get('completion_tokens', 0),
+        cached_tokens=telemetry.get('cached_tokens', 0),
+        wall_ms=int(round(telemetry['wall_ms'])),
+        ttft_ms=int(round(telemetry['ttft_ms'])) if telemetry.get('ttft_ms') is not None else None,
+        error_class=(telemetry.get('error_class') or '')[:64],
+    )
+
+
+def attach_to_message(conversation_id, message_id, telemetry_ids):
+    """
+    Enlaza con el mensaje del bot las filas que guardó ESTE turno (los ids que el agente dejó en telemetry_ids).
+    No se filtra solo por conversación: otro turno concurrente del mismo hilo tiene sus propias filas sin mensaje.
+    """
+    if not telemetry_ids:
+        return 0
+    return LLMTurnTelemetry.objects.filter(
+        id__in=telemetry_ids, conversation_id=conversation_id, message__isnull=True
+    ).update(message_id=message_id)
+
+
+async def aattach_to_message(conversation_id, message_id, telemetry_ids):
+    if not telemetry_ids:
+        return 0
+    return await LLMTurnTelemetry.objects.filter(
+        id__in=telemetry_ids, conversation_id=conversation_id, message__isnull=True
+    ).aupdate(message_id=message_id)
+
+
+class PercentileCont(Aggregate):
+    """percentile_cont(p) WITHIN GROUP (ORDER BY ...) de PostgreSQL."""
+    function = 'percentile_cont'
+    template = '%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, percentile=float(percentile) / 100.0, **extra)
+
+
+def daily_percentiles(queryset=None, days=14):
+    """
+    Una fila por día (más reciente primero): llamadas, errores, percentiles de duración y de primer
+    token (sin contar las llamadas con error), tokens promedio y fracción de prompt en caché.
+    """
+    queryset = LLMTurnTelemetry.objects.all() if queryset is None else queryset
+    queryset = queryset.filter(created_at__gte=timezone.now() - timedelta(days=days)).annotate(day=TruncDate('created_at'))
+    if connection.vendor == 'postgresql':
+        return _daily_percentiles_in_db(queryset)
+    return _daily_percentiles_in_python(queryset)
+
+
+def _daily_percentiles_in_db(queryset):
+    succeeded = Q(error_class='')
+    aggregates = {
+        'calls': Count('id'),
+        'errors': Count('id', filter=~succeeded),
+        'prompt_tokens_avg': Avg('prompt_tokens'),
+        'completion_tokens_avg': Avg('completion_tokens'),
+        'prompt_tokens_sum': Sum('prompt_tokens'),
+        'cached_tokens_sum': Sum('cached_tokens'),
+    }
+    for percentile in DAILY_PERCENTILES:
+        aggregates[f'wall_p{percentile}'] = PercentileCont('wall_ms', percentile, filter=succeeded)
+        aggregates[f'ttft_p{percentile}'] = PercentileCont('ttft_ms', percentile, filter=succeeded)
+    rows = list(queryset.values('day').annotate(**aggregates).order_by('-day'))
+    for row in rows:
+        row['cached_ratio'] = (row.pop('cached_tokens_sum') or 0) / row['prompt_tokens_sum'] if row['prompt_tokens_sum'] else 0.0
+        del row['prompt_tokens_sum']
+    return rows
+
+
+def _daily_percentiles_in_python(queryset):
+    # SQLite no tiene percentile_cont: una sola consulta trae los valores y se agregan aquí
+    values_by_day = defaultdict(list)
+    for values in queryset.values_list('day', 'wall_ms', 'ttft_ms', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'error_class'):
+        values_by_day[values[0]].append(values[1:])
+
+    rows = []
+    for day in sorted(values_by_day, reverse=True):
+        calls = values_by_day[day]
+        succeeded = [call for call in calls if not call[5]]
+        wall_values = [call[0] for call in succeeded]
+        ttft_values = [call[1] for call in succeeded if call[1] is not None]
+        prompt_tokens_sum = sum(call[2] for call in calls)
+        row = {
+            'day': day,
+            'calls': len(calls),
+            'errors': len(calls) - len(succeeded),
+            'prompt_tokens_avg': prompt_tokens_sum / len(calls),
+            'completion_tokens_avg': sum(call[3] for call in calls) / len(calls),
+            'cached_ratio': sum(call[4] for call in calls) / prompt_tokens_sum if prompt_tokens_sum else 0.0,
+        }
+        for percentile in DAILY_PERCENTILES:
+            row[f'wall_p{percentile}'] = float(np.percentile(wall_values, percentile)) if wall_values else None
+            row[f'ttft_p{percentile}'] = float(np.percentile(ttft_values, percentile)) if ttft_values else None
+        rows.append(row)
+    return rows
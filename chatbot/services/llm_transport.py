@@ -0,0 +1,375 @@
+# chatbot/services/llm_transport.py
+"""
+Transporte HTTP compartido para las llamadas al LLM (ChatOpenAI).
+
+Cada ChatOpenAI creaba su propio cliente httpx con los valores por defecto de la librería: sin
+tamaño de pool explícito y con un timeout de varios minutos, así que una respuesta lenta del
+proveedor retenía un hilo del worker casi indefinidamente. Aquí hay un solo par de clientes
+(sync y async) con pool acotado que usan todas las llamadas del agente, y un transporte que
+envuelve al de httpx con:
+- plazo por llamada: cada petición al LLM (con sus reintentos y su réplica) termina antes de
+  deadline_seconds; el timeout de cada intento se recorta a lo que queda del plazo;
+- reintentos con backoff exponencial y jitter completo ante errores de conexión, timeouts y
+  respuestas 429/5xx (se respeta Retry-After si entra en el plazo);
+- réplica opcional (hedging): si una petición sin stream tarda más que el p95 observado, se
+  lanza una segunda igual y se usa la que termine primero.
+Los reintentos propios de la librería openai se desactivan (max_retries=0) para no multiplicarlos.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+from django.conf import settings
+
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+RETRYABLE_EXCEPTIONS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+class LLMTransportPolicy:
+    """Plazo, reintentos y réplica de las peticiones al LLM, más las latencias que usa el hedging."""
+
+    def __init__(self, deadline_seconds=30.0, max_retries=2, retry_backoff_seconds=0.5, retry_backoff_max_seconds=4.0,
+                 hedging_enabled=False, hedge_percentile=95.0, hedge_min_samples=20, latency_window=500):
+        self.deadline_seconds = deadline_seconds
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.retry_backoff_max_seconds = retry_backoff_max_seconds
+        self.hedging_enabled = hedging_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies = deque(maxlen=latency_window) # Segundos de las últimas peticiones exitosas
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+        self.failures = 0
+
+    # --- Latencias ---
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _percentile(self, latencies, percentile):
+        ordered = sorted(latencies)
+        position = min(len(ordered) - 1, max(0, int(round(percentile / 100.0 * len(ordered))) - 1))
+        return ordered[position]
+
+    def hedge_delay(self):
+        """Segundos tras los que conviene lanzar la réplica (p95 observado), o None si no aplica."""
+        if not self.hedging_enabled:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.hedge_min_samples:
+                return None
+            return self._percentile(self._latencies, self.hedge_percentile)
+
+    # --- Reintentos ---
+
+    def backoff_seconds(self, retry_number, response=None):
+        """Espera antes del reintento N (desde 1): Retry-After si el servidor lo indica, si no jitter completo."""
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.retry_backoff_max_seconds)
+                except ValueError:
+                    pass
+        ceiling = min(self.retry_backoff_max_seconds, self.retry_backoff_seconds * (2 ** (retry_number - 1)))
+        return random.uniform(0, ceiling)
+
+    def attempt_timeout(self, request, deadline):
+        """Copia los timeouts de la petición recortados a lo que queda del plazo."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        timeouts = dict(request.extensions.get('timeout') or {})
+        for key in ('connect', 'read', 'write', 'pool'):
+            current = timeouts.get(key)
+            timeouts[key] = remaining if current is None else min(current, remaining)
+        return timeouts
+
+    def can_hedge(self, request):
+        """Solo peticiones sin stream: la respuesta se lee completa antes de elegir la ganadora."""
+        try:
+            return not json.loads(request.content or b'{}').get('stream')
+        except (ValueError, httpx.RequestNotRead):
+            return False
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get_metrics(self):
+        with self._lock:
+            latencies = list(self._latencies)
+        return {
+            'calls': self.calls,
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'deadline_exceeded': self.deadline_exceeded,
+            'failures': self.failures,
+            'latency_p50_s': self._percentile(latencies, 50) if latencies else None,
+            'latency_p95_s': self._percentile(latencies, 95) if latencies else None,
+            'latency_p99_s': self._percentile(latencies, 99) if latencies else None,
+        }
+
+
+def _deadline_error(request):
+    return httpx.ReadTimeout("Plazo de la llamada al LLM agotado", request=request)
+
+
+class ResilientTransport(httpx.BaseTransport):
+    """Transporte sync: plazo, reintentos y réplica alrededor de httpx.HTTPTransport (pool compartido)."""
+
+    def __init__(self, policy, limits):
+        self.policy = policy
+        self._transport = httpx.HTTPTransport(limits=limits)
+        self._hedge_pool = ThreadPoolExecutor(max_workers=limits.max_connections or 20, thread_name_prefix='dermabot-llm-hedge')
+
+    def handle_request(self, request):
+        policy = self.policy
+        policy.count('calls')
+        deadline = time.monotonic() + policy.deadline_seconds
+        last_error = None
+        for attempt_number in range(policy.max_retries + 1):
+            if attempt_number:
+                sleep_seconds = policy.backoff_seconds(attempt_number, getattr(last_error, 'response', None))
+                if time.monotonic() + sleep_seconds >= deadline:
+                    break
+                policy.count('retries')
+                time.sleep(sleep_seconds)
+            try:
+                response = self._attempt(request, deadline)
+            except RETRYABLE_EXCEPTIONS as e:
+                last_error = e
+                print(f"--- DEBUG LLM HTTP: intento {attempt_number + 1} falló ({type(e).__name__}) ---")
+                continue
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt_number < policy.max_retries:
+                print(f"--- DEBUG LLM HTTP: intento {attempt_number + 1} respondió {response.status_code}, se reintenta ---")
+                response.read()
+                response.close()
+                last_error = httpx.HTTPStatusError("Estado reintentable", request=request, response=response)
+                continue
+            return response
+
+        if time.monotonic() >= deadline or isinstance(last_error, httpx.TimeoutException):
+            policy.count('deadline_exceeded')
+        policy.count('failures')
+        if isinstance(last_error, httpx.HTTPStatusError):
+            return last_error.response # Se agotó el plazo esperando para reintentar: la librería ve el 429/5xx
+        raise last_error if last_error is not None else _deadline_error(request)
+
+    def _send_once(self, request, timeouts):
+        attempt_request = httpx.Request(
+            request.method, request.url, headers=request.headers, content=request.content,
+            extensions={**request.extensions, 'timeout': timeouts},
+        )
+        self.policy.count('attempts')
+        return self._transport.handle_request(attempt_request)
+
+    def _send_and_read(self, request, timeouts):
+        response = self._send_once(request, timeouts)
+        response.read()
+        return response
+
+    def _attempt(self, request, deadline):
+        timeouts = self.policy.attempt_timeout(request, deadline)
+        if timeouts is None:
+            raise _deadline_error(request)
+        started_at = time.monotonic()
+        hedge_delay = self.policy.hedge_delay() if self.policy.can_hedge(request) else None
+        if hedge_delay is None:
+            response = self._send_once(request, timeouts)
+        else:
+            response = self._hedged_attempt(request, deadline, timeouts, hedge_delay)
+        # Latencia del intento tal como la ve el agente (con réplica, la de la ganadora): base del p95
+        if response.status_code < 400:
+            self.policy.record_latency(time.monotonic() - started_at)
+        return response
+
+    def _hedged_attempt(self, request, deadline, timeouts, hedge_delay):
+        primary = self._hedge_pool.submit(self._send_and_read, request, timeouts)
+        done, _ = wait([primary], timeout=min(hedge_delay, max(0.0, deadline - time.monotonic())))
+        if done:
+            return primary.result()
+
+        hedge_timeouts = self.policy.attempt_timeout(request, deadline)
+        if hedge_timeouts is None:
+            return primary.result()
+        self.policy.count('hedges')
+        hedge = self._hedge_pool.submit(self._send_and_read, request, hedge_timeouts)
+        pending = {primary, hedge}
+        last_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if future is hedge:
+                    self.policy.count('hedge_wins')
+                for loser in pending: # La perdedora termina sola; su respuesta se descarta al llegar
+                    loser.add_done_callback(_close_future_response)
+                return response
+        raise last_error
+
+    def close(self):
+        self._hedge_pool.shutdown(wait=False)
+        self._transport.close()
+
+
+def _close_future_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class AsyncResilientTransport(httpx.AsyncBaseTransport):
+    """Transporte async (aget_response): la misma política, con la réplica como tarea de asyncio."""
+
+    def __init__(self, policy, limits):
+        self.policy = policy
+        self._transport = httpx.AsyncHTTPTransport(limits=limits)
+
+    async def handle_async_request(self, request):
+        policy = self.policy
+        policy.count('calls')
+        deadline = time.monotonic() + policy.deadline_seconds
+        last_error = None
+        for attempt_number in range(policy.max_retries + 1):
+            if attempt_number:
+                sleep_seconds = policy.backoff_seconds(attempt_number, getattr(last_error, 'response', None))
+                if time.monotonic() + sleep_seconds >= deadline:
+                    break
+                policy.count('retries')
+                await asyncio.sleep(sleep_seconds)
+            try:
+                response = await self._attempt(request, deadline)
+            except RETRYABLE_EXCEPTIONS as e:
+                last_error = e
+                print(f"--- DEBUG LLM HTTP: intento {attempt_number + 1} falló ({type(e).__name__}) ---")
+                continue
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt_number < policy.max_retries:
+                print(f"--- DEBUG LLM HTTP: intento {attempt_number + 1} respondió {response.status_code}, se reintenta ---")
+                await response.aread()
+                await response.aclose()
+                last_error = httpx.HTTPStatusError("Estado reintentable", request=request, response=response)
+                continue
+            return response
+
+        if time.monotonic() >= deadline or isinstance(last_error, httpx.TimeoutException):
+            policy.count('deadline_exceeded')
+        policy.count('failures')
+        if isinstance(last_error, httpx.HTTPStatusError):
+            return last_error.response
+        raise last_error if last_error is not None else _deadline_error(request)
+
+    async def _send_once(self, request, timeouts, read_body):
+        attempt_request = httpx.Request(
+            request.method, request.url, headers=request.headers, content=request.content,
+            extensions={**request.extensions, 'timeout': timeouts},
+        )
+        self.policy.count('attempts')
+        response = await self._transport.handle_async_request(attempt_request)
+        if read_body:
+            await response.aread()
+        return response
+
+    async def _attempt(self, request, deadline):
+        timeouts = self.policy.attempt_timeout(request, deadline)
+        if timeouts is None:
+            raise _deadline_error(request)
+        started_at = time.monotonic()
+        hedge_delay = self.policy.hedge_delay() if self.policy.can_hedge(request) else None
+        if hedge_delay is None:
+            response = await self._send_once(request, timeouts, read_body=False)
+        else:
+            response = await self._hedged_attempt(request, deadline, timeouts, hedge_delay)
+        if response.status_code < 400:
+            self.policy.record_latency(time.monotonic() - started_at)
+        return response
+
+    async def _hedged_attempt(self, request, deadline, timeouts, hedge_delay):
+        primary = asyncio.ensure_future(self._send_once(request, timeouts, read_body=True))
+        done, _ = await asyncio.wait({primary}, timeout=min(hedge_delay, max(0.0, deadline - time.monotonic())))
+        hedge_timeouts = self.policy.attempt_timeout(request, deadline)
+        if done or hedge_timeouts is None:
+            return await primary
+
+        self.policy.count('hedges')
+        hedge = asyncio.ensure_future(self._send_once(request, hedge_timeouts, read_body=True))
+        pending = {primary, hedge}
+        last_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    continue
+                if task is hedge:
+                    self.policy.count('hedge_wins')
+                for loser in pending:
+                    loser.cancel()
+                return task.result()
+        raise last_error
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+_shared_clients = None
+_shared_clients_lock = threading.Lock()
+
+
+def get_shared_clients():
+    """(policy, cliente httpx sync, cliente httpx async) únicos del proceso, configurados desde settings."""
+    global _shared_clients
+    if _shared_clients is None:
+        with _shared_clients_lock:
+            if _shared_clients is None:
+                _shared_clients = build_clients(
+                    LLMTransportPolicy(
+                        deadline_seconds=getattr(settings, 'CHATBOT_LLM_DEADLINE_SECONDS', 30.0),
+                        max_retries=getattr(settings, 'CHATBOT_LLM_MAX_RETRIES', 2),
+                        retry_backoff_seconds=getattr(settings, 'CHATBOT_LLM_RETRY_BACKOFF_SECONDS', 0.5),
+                        hedging_enabled=getattr(settings, 'CHATBOT_LLM_HEDGING_ENABLED', False),
+                        hedge_percentile=getattr(settings, 'CHATBOT_LLM_HEDGE_PERCENTILE', 95.0),
+                        hedge_min_samples=getattr(settings, 'CHATBOT_LLM_HEDGE_MIN_SAMPLES', 20),
+                    ),
+                    max_connections=getattr(settings, 'CHATBOT_LLM_MAX_CONNECTIONS', 20),
+                    max_keepalive_connections=getattr(settings, 'CHATBOT_LLM_MAX_KEEPALIVE_CONNECTIONS', 10),
+                    connect_timeout_seconds=getattr(settings, 'CHATBOT_LLM_CONNECT_TIMEOUT_SECONDS', 5.0),
+                )
+    return _shared_clients
+
+
+def build_clients(policy, max_connections=20, max_keepalive_connections=10, connect_timeout_seconds=5.0):
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+    timeout = httpx.Timeout(policy.deadline_seconds, connect=connect_timeout_seconds)
+    sync_client = httpx.Client(transport=ResilientTransport(policy, limits), timeout=timeout)
+    async_client = httpx.AsyncClient(transport=AsyncResilientTransport(policy, limits), timeout=timeout)
+    print(f"--- DEBUG LLM HTTP: Clientes compartidos creados (pool={max_connections}, plazo={policy.deadline_seconds} s, reintentos={policy.max_retries}, hedging={'sí' if policy.hedging_enabled else 'no'}) ---")
+    return policy, sync_client, async_client
+
+
+def chat_model_transport_kwargs():
+    """Argumentos para ChatOpenAI: clientes compartidos, plazo y sin los reintentos de la librería."""
+    policy, sync_client, async_client = get_shared_clients()
+    return {
+        'http_client': sync_client,
+        'http_async_client': async_client,
+        'timeout': policy.deadline_seconds,
+        'max_retries': 0,
+    }
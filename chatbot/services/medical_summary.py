@@ -0,0 +1,156 @@
+# chatbot/services/medical_summary.py
+"""
+Ficha médica preliminar (MedicalSummary) generada en segundo plano.
+
+Antes el LLM escribía un bloque ###INICIO_RESUMEN_MEDICO### dentro de la respuesta al usuario: eran
+tokens que el usuario esperaba sin verlos, dentro del mismo max_tokens, y después se parseaban
+partiendo strings. Ahora la respuesta interactiva es solo la orientación, y cuando la conversación
+llega a esa etapa se encola una llamada aparte con salida estructurada (esquema pydantic) que
+completa los campos de MedicalSummary directamente, en un pool de hilos chico.
+"""
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from django.db import connection
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from pydantic import BaseModel, Field
+
+from ..models import Conversation, MedicalSummary
+
+# Frase con la que arranca la "Advertencia Médica Obligatoria": marca la respuesta de orientación final
+ORIENTATION_WARNING_MARKER = "recuerda, esta es solo una orientación"
+
+EXTRACTION_INSTRUCTIONS = (
+    "Eres un asistente que arma una ficha médica preliminar a partir de una conversación entre un "
+    "usuario y DermaBot (asistente de orientación dermatológica). Completa cada campo SOLO con lo que "
+    "el usuario dijo o con el resultado del análisis de imagen (CNN) si aparece. Si un dato no se "
+    "mencionó, deja el campo vacío (null). Sé conciso y escribe en español."
+)
+
+
+class MedicalSummaryExtraction(BaseModel):
+    """Campos de MedicalSummary que se extraen de la conversación."""
+    main_complaint: Optional[str] = Field(default=None, description="Motivo principal de consulta, en una frase.")
+    symptoms_reported: Optional[str] = Field(default=None, description="Síntomas reportados, separados por comas.")
+    location_of_symptoms: Optional[str] = Field(default=None, description="Partes del cuerpo afectadas.")
+    duration_of_symptoms: Optional[str] = Field(default=None, description="Tiempo desde el inicio de los síntomas.")
+    aggravating_factors: Optional[str] = Field(default=None, description="Qué empeora los síntomas.")
+    alleviating_factors: Optional[str] = Field(default=None, description="Qué mejora los síntomas.")
+    previous_history: Optional[str] = Field(default=None, description="Antecedentes personales o familiares, diagnósticos previos.")
+    image_analysis_summary_from_cnn: Optional[str] = Field(default=None, description="Qué sugirió el análisis de imagen (CNN), con su confianza.")
+
+
+# Etiquetas del texto completo (summary_text_generated_by_llm), en el mismo formato que el bloque anterior
+SUMMARY_TEXT_LABELS = (
+    ('main_complaint', "Motivo Principal"),
+    ('symptoms_reported', "Síntomas Reportados"),
+    ('location_of_symptoms', "Localización"),
+    ('duration_of_symptoms', "Duración"),
+    ('aggravating_factors', "Factores Agravantes"),
+    ('alleviating_factors', "Factores de Alivio"),
+    ('previous_history', "Antecedentes Relevantes"),
+    ('image_analysis_summary_from_cnn', "Análisis de Imagen (CNN)"),
+)
+
+
+def is_orientation_reply(text):
+    return ORIENTATION_WARNING_MARKER in (text or "").lower()
+
+
+def build_transcript(messages, conversation_summary=""):
+    """Texto plano de la conversación para la extracción (incluye el resumen rodante si lo hay)."""
+    lines = []
+    if conversation_summary:
+        lines.append(f"(Resumen de turnos anteriores: {conversation_summary})")
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            lines.append(f"Usuario: {message.content}")
+        elif isinstance(message, AIMessage):
+            lines.append(f"DermaBot: {message.content}")
+    return "\n".join(lines)
+
+
+class MedicalSummaryExtractor:
+
+    def __init__(self, summary_model, max_workers=2):
+        self.structured_model = summary_model.with_structured_output(MedicalSummaryExtraction)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dermabot-summary')
+        self._lock = threading.Lock()
+        self._in_flight = set() # Conversaciones con extracción en curso (no se duplica la llamada)
+        self._dirty = {} # Conversación -> (transcripción, orientación) más recientes llegadas durante la extracción
+        self.scheduled = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+
+    def schedule(self, conversation_id, transcript, orientation_text):
+        """
+        Encola la extracción y devuelve el Future. Si ya hay una en curso para la conversación devuelve None:
+        la conversación queda marcada y, al terminar la actual, se extrae una vez más con la transcripción
+        más reciente (varias llamadas en el medio se juntan en esa sola).
+        """
+        with self._lock:
+            if conversation_id in self._in_flight:
+                self._dirty[conversation_id] = (transcript, orientation_text)
+                self.coalesced += 1
+                return None
+            self._in_flight.add(conversation_id)
+            self.scheduled += 1
+        print(f"--- DEBUG AGENT: Ficha médica - extracción encolada en segundo plano para {conversation_id} ---")
+        return self._executor.submit(self._extract_and_save, conversation_id, transcript, orientation_text)
+
+    def _extract_and_save(self, conversation_id, transcript, orientation_text):
+        try:
+            extraction = self.structured_model.invoke([
+                SystemMessage(content=EXTRACTION_INSTRUCTIONS),
+                HumanMessage(content=transcript),
+            ])
+            fields = extraction.model_dump()
+            summary_text = "\n".join(f"{label}: {fields[field] or 'No mencionado'}" for field, label in SUMMARY_TEXT_LABELS)
+            conversation_obj = Conversation.objects.get(id=uuid.UUID(str(conversation_id)))
+            _, created = MedicalSummary.objects.update_or_create(
+                conversation=conversation_obj,
+                defaults={
+                    **fields,
+                    'summary_text_generated_by_llm': summary_text,
+                    'tentative_orientation_by_llm': orientation_text,
+                },
+            )
+            with self._lock:
+                self.completed += 1
+            print(f"--- DEBUG AGENT: Ficha médica {'creada' if created else 'actualizada'} para {conversation_id} ---")
+            return fields
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            print(f"!!!!!!!! DEBUG AGENT: ERROR al extraer la ficha médica de {conversation_id}: {e} !!!!!!!!")
+            return None
+        finally:
+            connection.close() # Conexión propia de este hilo del pool
+            self._rerun_if_dirty(conversation_id)
+
+    def _rerun_if_dirty(self, conversation_id):
+        with self._lock:
+            pending = self._dirty.pop(conversation_id, None)
+            if pending is None:
+                self._in_flight.discard(conversation_id)
+                return
+            self.scheduled += 1
+        print(f"--- DEBUG AGENT: Ficha médica - la conversación {conversation_id} avanzó durante la extracción: se vuelve a extraer ---")
+        try:
+            self._executor.submit(self._extract_and_save, conversation_id, *pending)
+        except RuntimeError: # Pool cerrado (apagado del proceso)
+            with self._lock:
+                self._in_flight.discard(conversation_id)
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'scheduled': self.scheduled,
+                'completed': self.completed,
+                'failed': self.failed,
+                'in_flight': len(self._in_flight),
+                'coalesced': self.coalesced,
+            }
@@ -0,0 +1,123 @@
+# chatbot/services/model_lifecycle.py
+"""
+Ciclo de vida de los modelos (CNN + agente LLM) dentro de cada worker.
+
+En vez de construirlos al importar chatbot/views.py, se cargan en un hilo de fondo
+cuando arranca un servidor (preload_models desde config/wsgi.py y config/asgi.py) y se
+calienta la CNN con una imagen sintética. El endpoint /dermabot/health/ready expone el
+estado para el balanceador.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+
+class ModelLifecycle:
+    NOT_STARTED = 'not_started'
+    LOADING = 'loading'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_event = threading.Event()
+        self.state = self.NOT_STARTED
+        self.cnn_processor = None
+        self.derma_agent = None
+        self.started_at = None
+        self.load_seconds = None
+        self.cnn_load_seconds = None
+        self.agent_load_seconds = None
+        self.warmup_ms = None
+        self.errors = {}
+
+    def start_background_load(self):
+        """Lanza la carga en un hilo de fondo (solo la primera vez)."""
+        with self._lock:
+            if self.state != self.NOT_STARTED:
+                return
+            self.state = self.LOADING
+            self.started_at = time.time()
+        threading.Thread(target=self._load, name='dermabot-model-loader', daemon=True).start()
+
+    def _load(self):
+        # Imports diferidos: no cargar TensorFlow/LangChain al importar este módulo
+        from .cnn_service import CNNProcessor
+        from .openai_agent_service import DermaBotAgent
+
+        load_started = time.perf_counter()
+        try:
+            agent_started = time.perf_counter()
+            self.derma_agent = DermaBotAgent.get_instance()
+            self.agent_load_seconds = time.perf_counter() - agent_started
+        except Exception as e:
+            print(f"!!!!!!!! ERROR CRÍTICO al instanciar DermaBotAgent: {e} !!!!!!!!")
+            self.errors['agent'] = str(e)
+
+        try:
+            cnn_started = time.perf_counter()
+            processor = CNNProcessor.get_instance()
+            if processor.model_cnn is None and processor.model_server_client is None:
+                self.errors['cnn'] = "Modelo CNN no cargado."
+            else:
+                self.warmup_ms = processor.warm_up()
+                self.cnn_processor = processor
+            self.cnn_load_seconds = time.perf_counter() - cnn_started
+        except Exception as e:
+            print(f"!!!!!!!! ERROR CRÍTICO al instanciar CNNProcessor: {e} !!!!!!!!")
+            self.errors['cnn'] = str(e)
+
+        self.load_seconds = time.perf_counter() - load_started
+        self.state = self.FAILED if self.errors else self.READY
+        print(f"--- LIFECYCLE DEBUG: Carga de modelos terminada en {self.load_seconds:.2f} s - estado: {self.state} ---")
+        self._loaded_event.set()
+
+    def use_models(self, derma_agent=None, cnn_processor=None):
+        """Instala modelos ya construidos (pruebas de carga, benchmarks) y marca la carga como terminada."""
+        with self._lock:
+            self.derma_agent = derma_agent
+            self.cnn_processor = cnn_processor
+            self.state = self.READY
+        self._loaded_event.set()
+
+    def wait_until_loaded(self, timeout=None):
+        """Arranca la carga si nadie lo hizo (carga perezosa) y espera a que termine."""
+        self.start_background_load()
+        if timeout is None:
+            timeout = getattr(settings, 'DERMABOT_MODEL_LOAD_WAIT_SECONDS', 60.0)
+        return self._loaded_event.wait(timeout)
+
+    def get_cnn_processor(self):
+        self.wait_until_loaded()
+        return self.cnn_processor
+
+    def get_agent(self):
+        self.wait_until_loaded()
+        return self.derma_agent
+
+    @property
+    def is_ready(self):
+        return self.state == self.READY
+
+    def status(self):
+        return {
+            'ready': self.is_ready,
+            'state': self.state,
+            'cnn_loaded': self.cnn_processor is not None,
+            'agent_loaded': self.derma_agent is not None,
+            'load_seconds': self.load_seconds,
+            'cnn_load_seconds': self.cnn_load_seconds,
+            'agent_load_seconds': self.agent_load_seconds,
+            'warmup_ms': self.warmup_ms,
+            'errors': self.errors,
+        }
+
+
+model_lifecycle = ModelLifecycle()
+
+
+def preload_models():
+    """Arranca la carga de fondo si DERMABOT_PRELOAD_MODELS. Solo la llaman los puntos de entrada de los servidores."""
+    if getattr(settings, 'DERMABOT_PRELOAD_MODELS', True):
+        model_lifecycle.start_background_load()
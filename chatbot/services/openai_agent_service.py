@@ -2,19 +2,34 @@
 # (o chatbot/services/openai_agent_service.py)
 
 import os
-import uuid 
+import threading
+import time
+import uuid
+from functools import lru_cache
+import tiktoken
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langgraph.checkpoint.memory import MemorySaver # Usando MemorySaver como en tu funcional
 from langgraph.graph import START, MessagesState, StateGraph
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, RemoveMessage
+from langchain_core.runnables import RunnableLambda
+from langgraph.constants import TAG_NOSTREAM
 # Ajusta la ruta de importación de modelos según la ubicación de este archivo
 # Si este archivo está en Detection/services/ y los modelos en Detection/models.py:
-from ..models import Desease as KnownDesease, Conversation, MedicalSummary 
+from ..models import Desease as KnownDesease, LLMTurnTelemetry
+from . import llm_telemetry
+from .admission import AdmissionRejected, BUSY_BOT_MESSAGE, get_llm_limiter
+from .system_prompt import SystemPromptCache
+from .conversation_memory import BoundedMemorySaver, save_thread_summary
+from .medical_summary import MedicalSummaryExtractor, build_transcript, is_orientation_reply
+from .response_cache import GeneralQuestionCache
+from .trivial_turns import TrivialTurnResponder
+from .turn_input import IMAGE_CONTEXT_PREFIX
+from .llm_transport import chat_model_transport_kwargs, get_shared_clients
 # Si este archivo estuviera en chatbot/services/ y modelos en chatbot/models.py:
 # from ..models import Desease as KnownDesease, Conversation, MedicalSummary
 
-# LANGGRAPH_SQLITE_DB_PATH ya no es necesario con MemorySaver
+# LANGGRAPH_SQLITE_DB_PATH ya no es necesario: la memoria es BoundedMemorySaver (se reconstruye desde la BD)
 
 def get_deseases_prompt_text():
     deseases = KnownDesease.objects.all() # KnownDesease es un alias para Desease
@@ -30,6 +45,159 @@ def get_deseases_prompt_text():
         text += f"- {name}: {desc}\n"
     return text
 
+SUMMARY_START_TAG = "###INICIO_RESUMEN_MEDICO###"
+SUMMARY_END_TAG = "###FIN_RESUMEN_MEDICO###"
+
+# Respuestas fijas cuando falla la llamada al LLM (el worker de la cola las trata como error reintentable)
+LLM_TECHNICAL_ERROR_MESSAGE = "Hubo un problema técnico al procesar tu consulta con el asistente. Por favor, intenta de nuevo más tarde."
+AGENT_CATASTROPHIC_ERROR_MESSAGE = "Lo siento, ocurrió un error catastrófico al procesar su solicitud."
+
+
+class HiddenSummaryStreamFilter:
+    """
+    Filtra el bloque ###INICIO_RESUMEN_MEDICO### ... ###FIN_RESUMEN_MEDICO### de un stream de texto.
+    Retiene el final de cada fragmento mientras pueda ser el comienzo de una etiqueta partida entre
+    fragmentos, así ningún pedazo del bloque oculto llega al cliente.
+    """
+
+    def __init__(self, start_tag=SUMMARY_START_TAG, end_tag=SUMMARY_END_TAG):
+        self.start_tag = start_tag
+        self.end_tag = end_tag
+        self._pending = ""
+        self._inside_block = False
+
+    @staticmethod
+    def _partial_tag_length(text, tag):
+        """Largo del sufijo más largo de text que es prefijo de tag."""
+        for length in range(min(len(text), len(tag) - 1), 0, -1):
+            if text.endswith(tag[:length]):
+                return length
+        return 0
+
+    def feed(self, text):
+        """Agrega un fragmento y devuelve el texto que ya se puede mostrar (puede ser "")."""
+        self._pending += text
+        visible = ""
+        while self._pending:
+            tag = self.end_tag if self._inside_block else self.start_tag
+            tag_index = self._pending.find(tag)
+            if tag_index != -1:
+                if not self._inside_block:
+                    visible += self._pending[:tag_index]
+                self._pending = self._pending[tag_index + len(tag):]
+                self._inside_block = not self._inside_block
+                continue
+            keep = self._partial_tag_length(self._pending, tag)
+            if not self._inside_block:
+                visible += self._pending[:len(self._pending) - keep]
+            self._pending = self._pending[len(self._pending) - keep:]
+            break
+        return visible
+
+    def flush(self):
+        """Texto retenido al terminar el stream (nada si quedó un bloque oculto sin cerrar)."""
+        remaining = "" if self._inside_block else self._pending
+        self._pending = ""
+        return remaining
+
+
+class DermaBotState(MessagesState):
+    # Resumen rodante de los turnos viejos que ya se sacaron de "messages" (ver ConversationContextManager)
+    conversation_summary: str
+    # Cuántos mensajes de la conversación (en orden) ya están plegados en el resumen; se guarda en la BD con él
+    summarized_messages: int
+
+
+@lru_cache(maxsize=1)
+def _get_token_encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except Exception as e:
+        # Sin el archivo BPE en caché (p. ej. servidor sin salida a internet) se estima ~4 caracteres por token
+        print(f"--- DEBUG AGENT: ADVERTENCIA - tiktoken no disponible para '{model_name}' ({e}); se estiman los tokens.")
+        return None
+
+
+class ConversationContextManager:
+    """
+    Mantiene el historial que se manda al LLM dentro de un presupuesto de tokens.
+    Cuando el historial pasa de history_token_budget, los turnos más viejos se pliegan en un
+    resumen rodante (una llamada corta al LLM) y solo quedan los recientes, hasta la mitad del
+    presupuesto: así el prompt queda aproximadamente plano y no se resume en cada turno.
+    """
+    TOKENS_PER_MESSAGE = 4 # Sobrecarga de formato por mensaje (rol, separadores) en la API de chat
+
+    def __init__(self, summary_model, model_name, history_token_budget, summary_max_tokens):
+        self.summary_model = summary_model
+        self.model_name = model_name
+        self.history_token_budget = history_token_budget
+        self.summary_max_tokens = summary_max_tokens
+
+    @staticmethod
+    @lru_cache(maxsize=512) # El prompt de sistema y los mensajes viejos se repiten en cada turno
+    def _count_text_tokens(model_name, text):
+        encoding = _get_token_encoding(model_name)
+        if encoding is None:
+            return len(text) // 4 + 1
+        return len(encoding.encode(text))
+
+    def count_tokens(self, text):
+        return self._count_text_tokens(self.model_name, text or "")
+
+    def count_messages(self, messages):
+        return sum(self.count_tokens(str(message.content)) + self.TOKENS_PER_MESSAGE for message in messages)
+
+    def build_summary_message(self, summary):
+        return SystemMessage(content=f"Resumen de la conversación anterior con este usuario (turnos ya compactados):\n{summary}")
+
+    def _split_recent(self, messages):
+        """Separa (viejos, recientes) con los recientes dentro de la mitad del presupuesto, empezando en un turno del usuario."""
+        target_tokens = self.history_token_budget // 2
+        kept_tokens = 0
+        split_index = len(messages)
+        while split_index > 0:
+            message_tokens = self.count_messages([messages[split_index - 1]])
+            if split_index < len(messages) and kept_tokens + message_tokens > target_tokens:
+                break
+            kept_tokens += message_tokens
+            split_index -= 1
+        while split_index < len(messages) - 1 and not isinstance(messages[split_index], HumanMessage):
+            split_index += 1
+        return messages[:split_index], messages[split_index:]
+
+    def _summarize(self, previous_summary, old_messages):
+        transcript = "\n".join(
+            f"{'DermaBot' if isinstance(message, AIMessage) else 'Usuario'}: {message.content}" for message in old_messages
+        )
+        instructions = (
+            "Resume en español, en forma compacta (viñetas cortas, máximo "
+            f"{self.summary_max_tokens} tokens), la conversación entre un usuario y DermaBot. Conserva: problema de piel, "
+            "síntomas, localización, duración, factores agravantes/de alivio, antecedentes, resultados del análisis de "
+            "imagen (CNN), qué preguntas ya se hicieron y respondieron, y si ya se dio una orientación. No inventes datos."
+        )
+        content = f"Resumen previo:\n{previous_summary}\n\nTurnos nuevos a incorporar:\n{transcript}" if previous_summary else transcript
+        response = self.summary_model.invoke([SystemMessage(content=instructions), HumanMessage(content=content)])
+        return str(response.content).strip()
+
+    def compact(self, messages, summary):
+        """
+        Devuelve (mensajes_a_enviar, resumen, mensajes_a_quitar_del_estado).
+        Si resumir falla, se manda el historial completo (mejor lento que sin contexto).
+        """
+        if self.count_messages(messages) <= self.history_token_budget:
+            return messages, summary, []
+        old_messages, recent_messages = self._split_recent(messages)
+        if not old_messages:
+            return messages, summary, []
+        try:
+            new_summary = self._summarize(summary, old_messages)
+        except Exception as e:
+            print(f"!!!!!!!! DEBUG AGENT: ERROR al compactar el historial (se envía completo): {e} !!!!!!!!!")
+            return messages, summary, []
+        print(f"--- DEBUG AGENT: Historial compactado - {len(old_messages)} mensajes plegados en el resumen rodante, {len(recent_messages)} recientes se mantienen ---")
+        return recent_messages, new_summary, old_messages
+
+
 class DermaBotAgent:
     _instance = None
 
@@ -52,18 +220,36 @@ class DermaBotAgent:
             print("--- DEBUG AGENT: ERROR FATAL - OPENAI_API_KEY no está configurada ni en settings.py ni como variable de entorno.")
             raise ValueError("OPENAI_API_KEY no está configurada.")
 
-        self.max_output_tokens = 450 # Espacio para resumen + orientación + posible respuesta general
+        self.max_output_tokens = 300 # Orientación o respuesta general; la ficha médica se genera aparte (MedicalSummaryExtractor)
+        openai_base_url = getattr(settings, 'OPENAI_BASE_URL', None) # None = API de OpenAI
+        # Pool httpx compartido por todas las llamadas del agente, con plazo, reintentos y hedging (llm_transport)
+        transport_kwargs = chat_model_transport_kwargs()
         self.model = ChatOpenAI(
             model="gpt-4o-mini", 
             temperature=0.6, 
             max_tokens=self.max_output_tokens,
-            api_key=openai_api_key_val
+            api_key=openai_api_key_val,
+            base_url=openai_base_url,
+            stream_usage=True, # usage_metadata (con cached_tokens) también en stream_response
+            **transport_kwargs
         )
+        self._usage_lock = threading.Lock()
+        self.llm_calls = 0
+        self.prompt_tokens_total = 0
+        self.cached_prompt_tokens_total = 0
+        # Telemetría de la llamada al LLM por turn_id (uno por invocación): la deja el nodo y la guarda get_response/aget_response/stream_response
+        self.telemetry_enabled = getattr(settings, 'CHATBOT_LLM_TELEMETRY_ENABLED', True)
+        self._pending_telemetry = {}
         
-        self.checkpointer = MemorySaver() # Usando MemorySaver como en tu proyecto funcional
+        # Memoria acotada (LRU/TTL/techo de MB); un hilo desalojado se reconstruye desde los Message de la BD
+        self.checkpointer = BoundedMemorySaver(
+            max_threads=getattr(settings, 'CHATBOT_MEMORY_MAX_THREADS', 1000),
+            ttl_seconds=getattr(settings, 'CHATBOT_MEMORY_TTL_SECONDS', 3600),
+            max_bytes=getattr(settings, 'CHATBOT_MEMORY_MAX_MB', 256) * 1024 * 1024,
+        )
 
         self.base_system_prompt_content = """Eres DermaBot, un asistente virtual en español para orientación dermatológica preliminar y para responder preguntas generales sobre dermatología.
-Tu nombre es DermaBot. El usuario es '{user_identifier}', conversación ID '{conversation_id_thread}'.
+Tu nombre es DermaBot.
 NO DIAGNOSTICAS. Tu objetivo es guiar, educar MUY generalmente y responder preguntas informativas. No des tratamientos.
 
 {deseases_info_placeholder} <!-- Lista de afecciones de referencia para orientación específica -->
@@ -80,19 +266,10 @@ NO DIAGNOSTICAS. Tu objetivo es guiar, educar MUY generalmente y responder pregu
 2.  **MANEJO DE INFORMACIÓN DE IMAGEN (CNN):** Si el mensaje del usuario indica que se ha subido una imagen y se proporciona una sugerencia de un análisis visual previo (CNN) (ej: "Contexto de imagen: El análisis preliminar..."), **ACUSA RECIBO** de esta información. Ejemplo: "Entendido, gracias por la imagen. El análisis visual sugiere que podría ser [Enfermedad de CNN]." Luego, **continúa con UNA pregunta de la "LISTA DE PREGUNTAS GENERALES"** para obtener más contexto.
 3.  **UNA PREGUNTA A LA VEZ:** Formula SOLAMENTE UNA pregunta de la "LISTA DE PREGUNTAS GENERALES". Elige la más relevante no respondida. Intenta seguir el orden de la lista si es lógico.
 4.  **ADAPTACIÓN INTELIGENTE:** Omite preguntas si la información ya fue dada por el usuario o por el análisis de imagen. No repitas.
-5.  **GENERACIÓN DE RESUMEN, ORIENTACIÓN Y ADVERTENCIA FINAL:** 
-    *   Cuando tengas suficiente información (usualmente después de 2-4 respuestas clave del usuario), **SOLO SI ESTÁS SIGUIENDO ESTE PROTOCOLO ESTRICTO para un problema de piel personal,** en tu respuesta final al usuario, primero incluye un bloque de resumen ESTRUCTURADO y OCULTO para procesamiento interno. Este bloque debe empezar con `###INICIO_RESUMEN_MEDICO###` y terminar con `###FIN_RESUMEN_MEDICO###`.
-    *   **Formato del Resumen (entre las etiquetas):**
-        Motivo Principal: [Descripción concisa del problema principal del usuario]
-        Síntomas Reportados: [Lista de síntomas clave como: "manchas rojas", "picazón intensa", "ampollas pequeñas", etc.]
-        Localización: [Partes del cuerpo afectadas, ej: "antebrazo derecho", "codos y rodillas"]
-        Duración: [Tiempo desde el inicio de los síntomas, ej: "dos semanas", "varios años de forma intermitente"]
-        Factores Agravantes: [Qué empeora los síntomas, si se mencionó, ej: "estrés", "chocolate"]
-        Factores de Alivio: [Qué mejora los síntomas, si se mencionó, ej: "cremas hidratantes", "sol moderado"]
-        Antecedentes Relevantes: [Cualquier antecedente médico o familiar, o diagnóstico previo, ej: "padre con psoriasis", "diagnóstico tentativo previo de psoriasis"]
-        Análisis de Imagen (CNN): [Si se proporcionó, resume aquí lo que la CNN sugirió. Ej: "CNN sugiere: Melanoma (Confianza: 85%)" o "CNN: Sin resultado específico para la imagen."]
-    *   **DESPUÉS de las etiquetas y el resumen oculto (si lo generaste), en la MISMA respuesta al usuario**, ofrece una orientación TENTATIVA sobre 1 o MÁXIMO 2 posibles afecciones de tu lista de referencia {deseases_info_placeholder}. Explica brevemente por qué.
+5.  **ORIENTACIÓN Y ADVERTENCIA FINAL:** 
+    *   Cuando tengas suficiente información (usualmente después de 2-4 respuestas clave del usuario), ofrece una orientación TENTATIVA sobre 1 o MÁXIMO 2 posibles afecciones de tu lista de referencia {deseases_info_placeholder}. Explica brevemente por qué.
     *   INMEDIATAMENTE DESPUÉS de la orientación, concluye con la "Advertencia Médica ObligatorIA" completa. Tu turno termina aquí; no hagas más preguntas después de la advertencia.
+    *   NO escribas un resumen de la conversación: la ficha médica se genera aparte.
 6.  **RESPUESTAS CONCISAS.**
 
 **LISTA DE PREGUNTAS GENERALES (Para el protocolo estricto, haz UNA por turno si no ha sido respondida):**
@@ -111,126 +288,474 @@ NO DIAGNOSTICAS. Tu objetivo es guiar, educar MUY generalmente y responder pregu
 
 Si el usuario pide diagnóstico/tratamiento, reitera limitaciones amablemente.
 Si el usuario hace una pregunta muy específica sobre una enfermedad rara o un tratamiento complejo que excede la orientación general, indica que esa pregunta debe ser consultada con un profesional.
+
+**DATOS DE ESTA CONVERSACIÓN:** El usuario es '{user_identifier}', conversación ID '{conversation_id_thread}'.
 """
-        workflow = StateGraph(MessagesState)
-        workflow.add_node("model", self.call_model_node)
+        # Todo lo anterior a "DATOS DE ESTA CONVERSACIÓN" es idéntico byte a byte en todos los hilos: así el
+        # proveedor reutiliza su caché de prefijo. Los datos por hilo van siempre al final.
+        # Parte estática + lista de enfermedades se arman una vez; se rehacen solo si cambia Desease
+        self.system_prompt_cache = SystemPromptCache(self.base_system_prompt_content, get_deseases_prompt_text)
+
+        summary_max_tokens = getattr(settings, 'CHATBOT_HISTORY_SUMMARY_MAX_TOKENS', 300)
+        self.context_manager = ConversationContextManager(
+            # TAG_NOSTREAM: los tokens del resumen no se mezclan con la respuesta en stream_response()
+            summary_model=ChatOpenAI(model="gpt-4o-mini", temperature=0, max_tokens=summary_max_tokens, api_key=openai_api_key_val, base_url=openai_base_url, tags=[TAG_NOSTREAM], **transport_kwargs),
+            model_name="gpt-4o-mini",
+            history_token_budget=getattr(settings, 'CHATBOT_HISTORY_TOKEN_BUDGET', 2000),
+            summary_max_tokens=summary_max_tokens,
+        )
+
+        # Saludos, agradecimientos, despedidas y turnos vacíos se contestan con plantillas, sin LLM
+        self.trivial_turns = None
+        if getattr(settings, 'CHATBOT_TRIVIAL_TURNS_ENABLED', True):
+            self.trivial_turns = TrivialTurnResponder(max_chars=getattr(settings, 'CHATBOT_TRIVIAL_TURNS_MAX_CHARS', 60))
+
+        # Respuestas a preguntas generales (modo 2) reutilizables entre conversaciones
+        self.response_cache = None
+        if getattr(settings, 'CHATBOT_RESPONSE_CACHE_ENABLED', True):
+            self.response_cache = GeneralQuestionCache(
+                similarity_threshold=getattr(settings, 'CHATBOT_RESPONSE_CACHE_SIMILARITY', 0.85),
+                ttl_seconds=getattr(settings, 'CHATBOT_RESPONSE_CACHE_TTL_SECONDS', 86400),
+                max_entries=getattr(settings, 'CHATBOT_RESPONSE_CACHE_MAX_ENTRIES', 500),
+            )
+
+        # Ficha médica (MedicalSummary) con salida estructurada, en segundo plano al llegar a la orientación
+        self.summary_extractor = MedicalSummaryExtractor(
+            ChatOpenAI(model="gpt-4o-mini", temperature=0, max_tokens=400, api_key=openai_api_key_val, base_url=openai_base_url, **transport_kwargs),
+            max_workers=getattr(settings, 'CHATBOT_SUMMARY_WORKERS', 2),
+        )
+
+        workflow = StateGraph(DermaBotState)
+        # Versión sync (invoke/stream) y async (ainvoke, ver aget_response) del mismo nodo
+        workflow.add_node("model", RunnableLambda(self.call_model_node, afunc=self.acall_model_node, name="model"))
         workflow.add_edge(START, "model")
         self.graph_app = workflow.compile(checkpointer=self.checkpointer)
         print(f"--- DEBUG AGENT: DermaBotAgent (OpenAI) inicializado. max_tokens={self.max_output_tokens}. Checkpointer: {type(self.checkpointer).__name__} ---")
 
-    def call_model_node(self, state: MessagesState, config: dict):
+    def call_model_node(self, state: DermaBotState, config: dict):
         print("\n--- DEBUG AGENT: Entrando a call_model_node ---")
+        llm_messages, state_update, removals = self._prepare_model_call(state, config)
+        
+        llm_started_at = time.perf_counter()
+        try:
+            response = self.model.invoke(llm_messages) 
+            self._record_prompt_cache_usage(response)
+            self._stash_turn_telemetry(config, llm_started_at, response=response)
+            print(f"--- DEBUG AGENT: call_model_node - Respuesta CRUDA del LLM (primeros 200 chars): {str(response.content)[:200]}...")
+            return {**state_update, "messages": removals + [response]} 
+        except Exception as e:
+            self._stash_turn_telemetry(config, llm_started_at, error=e)
+            print(f"!!!!!!!! DEBUG AGENT: ERROR al invocar el LLM en call_model_node: {e} !!!!!!!!!")
+            error_ai_message = AIMessage(content=LLM_TECHNICAL_ERROR_MESSAGE)
+            return {**state_update, "messages": removals + [error_ai_message]}
+
+    async def acall_model_node(self, state: DermaBotState, config: dict):
+        print("\n--- DEBUG AGENT: Entrando a acall_model_node ---")
+        # El armado puede tocar la BD (lista de enfermedades) y resumir historial: va a un hilo
+        llm_messages, state_update, removals = await sync_to_async(self._prepare_model_call)(state, config)
+        
+        llm_started_at = time.perf_counter()
+        try:
+            response = await self.model.ainvoke(llm_messages) # No ocupa un hilo mientras espera a la API
+            self._record_prompt_cache_usage(response)
+            self._stash_turn_telemetry(config, llm_started_at, response=response)
+            print(f"--- DEBUG AGENT: acall_model_node - Respuesta CRUDA del LLM (primeros 200 chars): {str(response.content)[:200]}...")
+            return {**state_update, "messages": removals + [response]} 
+        except Exception as e:
+            self._stash_turn_telemetry(config, llm_started_at, error=e)
+            print(f"!!!!!!!! DEBUG AGENT: ERROR al invocar el LLM en acall_model_node: {e} !!!!!!!!!")
+            error_ai_message = AIMessage(content=LLM_TECHNICAL_ERROR_MESSAGE)
+            return {**state_update, "messages": removals + [error_ai_message]}
+
+    def _record_prompt_cache_usage(self, response):
+        """Acumula los tokens de prompt y los que el proveedor sirvió desde su caché de prefijo (usage_metadata)."""
+        usage = getattr(response, 'usage_metadata', None) or {}
+        prompt_tokens = usage.get('input_tokens', 0)
+        cached_tokens = (usage.get('input_token_details') or {}).get('cache_read', 0) or 0
+        with self._usage_lock:
+            self.llm_calls += 1
+            self.prompt_tokens_total += prompt_tokens
+            self.cached_prompt_tokens_total += cached_tokens
+        cached_percent = 100.0 * cached_tokens / prompt_tokens if prompt_tokens else 0.0
+        print(f"--- DEBUG AGENT: Uso del LLM - tokens de prompt={prompt_tokens}, cacheados por el proveedor={cached_tokens} ({cached_percent:.0f}%) ---")
+        return cached_tokens
+
+    def _stash_turn_telemetry(self, config, llm_started_at, response=None, error=None):
+        """Deja tokens, modelo y duración de la llamada para que el método del turno los guarde en la BD."""
+        if not self.telemetry_enabled:
+            return
+        turn_id = config.get("configurable", {}).get("turn_id")
+        telemetry = llm_telemetry.usage_from_response(response)
+        telemetry['model_name'] = telemetry['model_name'] or getattr(self.model, 'model_name', '')
+        telemetry['started_at'] = llm_started_at
+        telemetry['wall_ms'] = (time.perf_counter() - llm_started_at) * 1000.0
+        telemetry['error_class'] = type(error).__name__ if error is not None else ''
+        with self._usage_lock:
+            self._pending_telemetry[turn_id] = telemetry
+
+    def _save_turn_telemetry(self, langgraph_config, call_mode, turn_started_at, telemetry_ids=None, error=None, first_token_at=None):
+        """
+        Guarda la fila de LLMTurnTelemetry del turno. Si el grafo falló antes de llamar al LLM, registra solo el error.
+        La llamada pendiente se busca por el turn_id de esta invocación (dos turnos del mismo hilo no se pisan) y el
+        id de la fila guardada se agrega a telemetry_ids para que el llamador la enlace con su mensaje.
+        """
+        if not self.telemetry_enabled:
+            return
+        cfg_configurable = langgraph_config["configurable"]
+        with self._usage_lock:
+            telemetry = self._pending_telemetry.pop(cfg_configurable["turn_id"], None)
+        if telemetry is None:
+            if error is None:
+                return
+            telemetry = {
+                'model_name': getattr(self.model, 'model_name', ''),
+                'wall_ms': (time.perf_counter() - turn_started_at) * 1000.0,
+                'error_class': type(error).__name__,
+            }
+        if first_token_at is not None and 'started_at' in telemetry:
+            telemetry['ttft_ms'] = max(0.0, (first_token_at - telemetry['started_at']) * 1000.0)
+        try:
+            telemetry_row = llm_telemetry.save_turn(cfg_configurable["thread_id"], call_mode, telemetry)
+        except Exception as e: # La telemetría nunca debe tumbar un turno
+            print(f"!!!!!!!! DEBUG AGENT: ERROR al guardar la telemetría del LLM: {e} !!!!!!!!")
+            return
+        if telemetry_ids is not None:
+            telemetry_ids.append(telemetry_row.id)
+
+    def get_prompt_cache_metrics(self):
+        with self._usage_lock:
+            return {
+                'llm_calls': self.llm_calls,
+                'prompt_tokens': self.prompt_tokens_total,
+                'cached_tokens': self.cached_prompt_tokens_total,
+                'cached_ratio': self.cached_prompt_tokens_total / self.prompt_tokens_total if self.prompt_tokens_total else 0.0,
+                'static_prefix_chars': self.system_prompt_cache.get_metrics()['static_prefix_chars'],
+            }
+
+    def get_transport_metrics(self):
+        """Reintentos, réplicas (hedging) y latencias de las peticiones HTTP al LLM."""
+        policy, _, _ = get_shared_clients()
+        return policy.get_metrics()
+
+    def _prepare_model_call(self, state: DermaBotState, config: dict):
+        """Arma los mensajes para el LLM. Devuelve (mensajes, actualización de estado, RemoveMessage de lo compactado)."""
         cfg_configurable = config.get("configurable", {})
         user_identifier = cfg_configurable.get("user_name", "Usuario Anónimo") # Default si no se pasa
         thread_id = cfg_configurable.get("thread_id", "default_thread_id_error") # Default para detectar errores
         
-        current_deseases_info = get_deseases_prompt_text()
-        
-        system_prompt_formatted = self.base_system_prompt_content.replace(
-            "{user_identifier}", str(user_identifier)
-        ).replace(
-            "{conversation_id_thread}", str(thread_id)
-        ).replace(
-            "{deseases_info_placeholder}", current_deseases_info
-        )
+        system_prompt_formatted, prompt_build_ms = self.system_prompt_cache.render(user_identifier, thread_id)
+        print(f"--- DEBUG AGENT: call_model_node - Prompt de sistema armado en {prompt_build_ms:.3f} ms ---")
         
         # Descomentar para depuración extensa del historial
         # print(f"--- DEBUG AGENT: call_model_node - Historial para LLM: {state['messages']}")
 
-        current_prompt = ChatPromptTemplate.from_messages(
-            [
-                SystemMessage(content=system_prompt_formatted),
-                MessagesPlaceholder(variable_name="messages"),
-            ]
-        )
-        
-        chain = current_prompt | self.model
-        
-        try:
-            response = chain.invoke({"messages": state["messages"]}) 
-            print(f"--- DEBUG AGENT: call_model_node - Respuesta CRUDA del LLM (primeros 200 chars): {str(response.content)[:200]}...")
-            return {"messages": [response]} 
-        except Exception as e:
-            print(f"!!!!!!!! DEBUG AGENT: ERROR al invocar el LLM en call_model_node: {e} !!!!!!!!!")
-            error_ai_message = AIMessage(content="Hubo un problema técnico al procesar tu consulta con el asistente. Por favor, intenta de nuevo más tarde.")
-            return {"messages": [error_ai_message]}
-
-    def _extract_and_save_medical_summary(self, llm_response_content: str, conversation_obj: Conversation):
-        start_tag = "###INICIO_RESUMEN_MEDICO###"
-        end_tag = "###FIN_RESUMEN_MEDICO###"
-        user_facing_response = llm_response_content
-        raw_summary_text = ""
-        start_index = llm_response_content.find(start_tag)
-        end_index = llm_response_content.find(end_tag)
-
-        if start_index != -1 and end_index != -1 and start_index < end_index:
-            raw_summary_text = llm_response_content[start_index + len(start_tag) : end_index].strip()
-            
-            # La parte para el usuario es lo que viene DESPUÉS del bloque de resumen
-            user_facing_response = llm_response_content[end_index + len(end_tag) :].strip()
-            # Si no hay nada después (el LLM se detuvo justo después del tag), 
-            # o si el bloque de resumen estaba al final de todo y la parte del usuario antes.
-            if not user_facing_response.strip():
-                user_facing_response = llm_response_content[:start_index].strip()
-
-            print(f"--- DEBUG AGENT: Resumen Médico Crudo Extraído:\n{raw_summary_text}\n---------------------------------")
-            print(f"--- DEBUG AGENT: Respuesta para el Usuario (post-extracción resumen):\n{user_facing_response}\n---------------------------------")
-
-            summary_data = {"summary_text_generated_by_llm": raw_summary_text}
-            lines = raw_summary_text.split('\n')
-            for line in lines:
-                if ":" in line:
-                    key_raw, value = line.split(":", 1)
-                    # Normalizar la clave para que coincida con los nombres de campo del modelo MedicalSummary
-                    key = key_raw.strip().lower().replace(" ", "_").replace("(", "").replace(")", "").replace("í", "i").replace("ó", "o").replace("á", "a").replace("é", "e").replace("ú", "u")
-                    value = value.strip()
-                    
-                    # Mapeo explícito a los campos del modelo
-                    if key == "motivo_principal": summary_data["main_complaint"] = value
-                    elif key == "sintomas_reportados": summary_data["symptoms_reported"] = value # 'í' a 'i'
-                    elif key == "localizacion": summary_data["location_of_symptoms"] = value
-                    elif key == "duracion": summary_data["duration_of_symptoms"] = value
-                    elif key == "factores_agravantes": summary_data["aggravating_factors"] = value
-                    elif key == "factores_de_alivio": summary_data["alleviating_factors"] = value
-                    elif key == "antecedentes_relevantes": summary_data["previous_history"] = value
-                    elif key == "analisis_de_imagen_cnn": summary_data["image_analysis_summary_from_cnn"] = value
-            
-            # La orientación tentativa es la parte que el LLM dirige al usuario y que NO es el bloque de resumen
-            summary_data["tentative_orientation_by_llm"] = user_facing_response.strip()
-            
-            summary_obj, created = MedicalSummary.objects.update_or_create(
-                conversation=conversation_obj,
-                defaults=summary_data
-            )
-            action = "Creado" if created else "Actualizado"
-            print(f"--- DEBUG AGENT: {action} MedicalSummary para conversación {conversation_obj.id}")
-        else:
-            print("--- DEBUG AGENT: No se encontraron etiquetas de resumen médico completas en la respuesta del LLM.")
-            advertencia_inicio_lower = "recuerda, esta es solo una orientación general"
-            if advertencia_inicio_lower in user_facing_response.lower(): # Comparación insensible a mayúsculas
-                summary_obj, created = MedicalSummary.objects.get_or_create(conversation=conversation_obj)
-                # Solo guardar si no hay ya una orientación o si es la primera vez que se crea el resumen
-                if not summary_obj.tentative_orientation_by_llm or created: 
-                    summary_obj.tentative_orientation_by_llm = user_facing_response.strip()
-                    summary_obj.save()
-                    print(f"--- DEBUG AGENT: Guardada orientación final (sin bloque de resumen explícito) en MedicalSummary para {conversation_obj.id}")
-
-        return user_facing_response.strip() if user_facing_response.strip() else llm_response_content 
-
-    def get_response(self, user_input: str, conversation_id: str, user_identifier: str = "Usuario Anónimo"):
+        # Presupuesto de tokens: los turnos viejos se pliegan en el resumen rodante
+        history = state["messages"]
+        summary = state.get("conversation_summary", "")
+        system_tokens = self.context_manager.count_tokens(system_prompt_formatted) + ConversationContextManager.TOKENS_PER_MESSAGE
+        summary_tokens_before = self.context_manager.count_messages([self.context_manager.build_summary_message(summary)]) if summary else 0
+        tokens_before = system_tokens + summary_tokens_before + self.context_manager.count_messages(history)
+
+        history, summary, removed_messages = self.context_manager.compact(history, summary)
+        summarized_messages = state.get("summarized_messages", 0) + len(removed_messages)
+        if removed_messages:
+            # Otro worker que reconstruya el hilo parte de este resumen en vez de volver a resumir todo
+            save_thread_summary(thread_id, summary, summarized_messages)
+        summary_messages = [self.context_manager.build_summary_message(summary)] if summary else []
+        tokens_after = system_tokens + self.context_manager.count_messages(summary_messages + history)
+        print(f"--- DEBUG AGENT: call_model_node - Tokens de prompt: antes de compactar={tokens_before}, después={tokens_after} (presupuesto de historial: {self.context_manager.history_token_budget}) ---")
+
+        # Mismo resultado que ChatPromptTemplate([SystemMessage, MessagesPlaceholder]) sin armar un chain por turno
+        llm_messages = [SystemMessage(content=system_prompt_formatted), *summary_messages, *history]
+        # Los mensajes plegados salen del estado del hilo; el resumen queda en su propio canal
+        state_update = {"conversation_summary": summary, "summarized_messages": summarized_messages}
+        removals = [RemoveMessage(id=message.id) for message in removed_messages]
+        return llm_messages, state_update, removals
+
+    def _strip_hidden_summary_block(self, llm_response_content: str):
+        """
+        El prompt ya no pide el bloque ###INICIO_RESUMEN_MEDICO###, pero hilos viejos pueden tenerlo en el
+        historial y el modelo imitarlo: si aparece, se quita de la respuesta (la ficha la arma MedicalSummaryExtractor).
+        """
+        start_index = llm_response_content.find(SUMMARY_START_TAG)
+        end_index = llm_response_content.find(SUMMARY_END_TAG)
+        if start_index == -1 or end_index == -1 or start_index > end_index:
+            return llm_response_content.strip()
+        print("--- DEBUG AGENT: Se quitó un bloque de resumen oculto de la respuesta del LLM ---")
+        before_block = llm_response_content[:start_index]
+        after_block = llm_response_content[end_index + len(SUMMARY_END_TAG):]
+        return f"{before_block.strip()}\n{after_block.strip()}".strip()
+
+    @staticmethod
+    def _turn_config(thread_id, user_identifier):
+        # turn_id identifica esta invocación: la telemetría pendiente no se mezcla con otro turno del mismo hilo
+        return { "configurable": { "thread_id": thread_id, "user_name": str(user_identifier), "turn_id": uuid.uuid4().hex, } }
+
+    def get_response(self, user_input: str, conversation_id: str, user_identifier: str = "Usuario Anónimo", telemetry_ids=None):
         print(f"\n--- DEBUG AGENT: Entrando a get_response ---")
         print(f"--- DEBUG AGENT: get_response - User Input: '{user_input}', Conv ID: '{conversation_id}', User: '{user_identifier}'")
         
         langgraph_thread_id = str(conversation_id)
-        langgraph_config = { "configurable": { "thread_id": langgraph_thread_id, "user_name": str(user_identifier), } }
+        langgraph_config = self._turn_config(langgraph_thread_id, user_identifier)
         current_input_message = HumanMessage(content=user_input)
+
+        trivial_reply = self._answer_trivial_turn(user_input, langgraph_config)
+        if trivial_reply is not None:
+            return trivial_reply
+
+        cacheable_question = self._cacheable_question(user_input, langgraph_config)
+        if cacheable_question:
+            cached_answer = self._answer_from_cache(cacheable_question, user_input, langgraph_config)
+            if cached_answer is not None:
+                return cached_answer
         
+        # Tope global de llamadas al LLM en vuelo; si no hay lugar, AdmissionRejected sube al llamador
+        with get_llm_limiter().slot():
+            llm_started_at = time.perf_counter()
+            try:
+                response_state = self.graph_app.invoke({"messages": [current_input_message]}, config=langgraph_config)
+            except Exception as e:
+                print(f"!!!!!!!! DEBUG AGENT: ERROR durante graph_app.invoke: {e} !!!!!!!!!")
+                self._save_turn_telemetry(langgraph_config, LLMTurnTelemetry.MODE_SYNC, llm_started_at, telemetry_ids, error=e)
+                return AGENT_CATASTROPHIC_ERROR_MESSAGE
+        self._save_turn_telemetry(langgraph_config, LLMTurnTelemetry.MODE_SYNC, llm_started_at, telemetry_ids)
+
+        user_facing_response = self._build_user_facing_response(response_state, langgraph_thread_id)
+        if cacheable_question:
+            self._store_in_cache(cacheable_question, user_facing_response, llm_started_at, user_identifier)
+        return user_facing_response
+
+    async def aget_response(self, user_input: str, conversation_id: str, user_identifier: str = "Usuario Anónimo", telemetry_ids=None):
+        """Versión async de get_response (vistas ASGI): el turno del LLM no bloquea un hilo del worker."""
+        print(f"\n--- DEBUG AGENT: Entrando a aget_response ---")
+        print(f"--- DEBUG AGENT: aget_response - User Input: '{user_input}', Conv ID: '{conversation_id}', User: '{user_identifier}'")
+        
+        langgraph_thread_id = str(conversation_id)
+        langgraph_config = self._turn_config(langgraph_thread_id, user_identifier)
+        
+        # Leer el estado del hilo puede reconstruirlo desde la BD: fuera del event loop
+        trivial_reply = await sync_to_async(self._answer_trivial_turn)(user_input, langgraph_config)
+        if trivial_reply is not None:
+            return trivial_reply
+
+        cacheable_question = await sync_to_async(self._cacheable_question)(user_input, langgraph_config)
+        if cacheable_question:
+            cached_answer = await sync_to_async(self._answer_from_cache)(cacheable_question, user_input, langgraph_config)
+            if cached_answer is not None:
+                return cached_answer
+
+        async with get_llm_limiter().aslot():
+            llm_started_at = time.perf_counter()
+            try:
+                response_state = await self.graph_app.ainvoke({"messages": [HumanMessage(content=user_input)]}, config=langgraph_config)
+            except Exception as e:
+                print(f"!!!!!!!! DEBUG AGENT: ERROR durante graph_app.ainvoke: {e} !!!!!!!!!")
+                await sync_to_async(self._save_turn_telemetry)(langgraph_config, LLMTurnTelemetry.MODE_ASYNC, llm_started_at, telemetry_ids, error=e)
+                return AGENT_CATASTROPHIC_ERROR_MESSAGE
+        await sync_to_async(self._save_turn_telemetry)(langgraph_config, LLMTurnTelemetry.MODE_ASYNC, llm_started_at, telemetry_ids)
+
+        # Leer el resumen rodante y encolar la ficha médica usa el ORM síncrono
+        user_facing_response = await sync_to_async(self._build_user_facing_response)(response_state, langgraph_thread_id)
+        if cacheable_question:
+            self._store_in_cache(cacheable_question, user_facing_response, llm_started_at, user_identifier)
+        return user_facing_response
+
+    def stream_response(self, user_input: str, conversation_id: str, user_identifier: str = "Usuario Anónimo", telemetry_ids=None):
+        """
+        Igual que get_response, pero va entregando el texto a medida que lo genera el LLM.
+        Produce tuplas ("token", texto_visible) y, al final, una ("done", contenido_final) con el
+        mismo contenido que devolvería get_response (la ficha médica se encola en segundo plano).
+        """
+        print(f"\n--- DEBUG AGENT: Entrando a stream_response ---")
+        langgraph_thread_id = str(conversation_id)
+        langgraph_config = self._turn_config(langgraph_thread_id, user_identifier)
+        hidden_summary_filter = HiddenSummaryStreamFilter()
+
+        trivial_reply = self._answer_trivial_turn(user_input, langgraph_config)
+        if trivial_reply is not None:
+            yield "token", trivial_reply
+            yield "done", trivial_reply
+            return
+
+        cacheable_question = self._cacheable_question(user_input, langgraph_config)
+        if cacheable_question:
+            cached_answer = self._answer_from_cache(cacheable_question, user_input, langgraph_config)
+            if cached_answer is not None:
+                yield "token", cached_answer
+                yield "done", cached_answer
+                return
+
+        llm_limiter = get_llm_limiter()
+        try:
+            llm_limiter.acquire()
+        except AdmissionRejected as e:
+            # Los encabezados del stream ya salieron: el rechazo llega como respuesta del bot
+            print(f"--- DEBUG AGENT: stream_response - Turno rechazado por admisión: {e} ---")
+            yield "done", BUSY_BOT_MESSAGE
+            return
+        llm_started_at = time.perf_counter()
+        first_token_at = None
         try:
-            response_state = self.graph_app.invoke({"messages": [current_input_message]}, config=langgraph_config)
+            for message_chunk, metadata in self.graph_app.stream(
+                {"messages": [HumanMessage(content=user_input)]}, config=langgraph_config, stream_mode="messages"
+            ):
+                if metadata.get("langgraph_node") != "model" or not isinstance(message_chunk, AIMessage):
+                    continue
+                if first_token_at is None and message_chunk.content:
+                    first_token_at = time.perf_counter()
+                visible_text = hidden_summary_filter.feed(str(message_chunk.content))
+                if visible_text:
+                    yield "token", visible_text
         except Exception as e:
-            print(f"!!!!!!!! DEBUG AGENT: ERROR durante graph_app.invoke: {e} !!!!!!!!!")
-            return "Lo siento, ocurrió un error catastrófico al procesar su solicitud."
+            print(f"!!!!!!!! DEBUG AGENT: ERROR durante graph_app.stream: {e} !!!!!!!!!")
+            self._save_turn_telemetry(langgraph_config, LLMTurnTelemetry.MODE_STREAM, llm_started_at, telemetry_ids, error=e, first_token_at=first_token_at)
+            yield "done", AGENT_CATASTROPHIC_ERROR_MESSAGE
+            return
+        finally:
+            llm_limiter.release()
+        self._save_turn_telemetry(langgraph_config, LLMTurnTelemetry.MODE_STREAM, llm_started_at, telemetry_ids, first_token_at=first_token_at)
+
+        remaining_text = hidden_summary_filter.flush()
+        if remaining_text:
+            yield "token", remaining_text
+        response_state = self.graph_app.get_state(langgraph_config).values
+        user_facing_response = self._build_user_facing_response(response_state, langgraph_thread_id)
+        if cacheable_question:
+            self._store_in_cache(cacheable_question, user_facing_response, llm_started_at, user_identifier)
+        yield "done", user_facing_response
 
+    async def astream_response(self, user_input: str, conversation_id: str, user_identifier: str = "Usuario Anónimo", telemetry_ids=None):
+        """Versión async de stream_response (vistas ASGI): mismas tuplas, con graph_app.astream."""
+        print(f"\n--- DEBUG AGENT: Entrando a astream_response ---")
+        langgraph_thread_id = str(conversation_id)
+        langgraph_config = self._turn_config(langgraph_thread_id, user_identifier)
+        hidden_summary_filter = HiddenSummaryStreamFilter()
+
+        # Leer el estado del hilo puede reconstruirlo desde la BD: fuera del event loop
+        trivial_reply = await sync_to_async(self._answer_trivial_turn)(user_input, langgraph_config)
+        if trivial_reply is not None:
+            yield "token", trivial_reply
+            yield "done", trivial_reply
+            return
+
+        cacheable_question = await sync_to_async(self._cacheable_question)(user_input, langgraph_config)
+        if cacheable_question:
+            cached_answer = await sync_to_async(self._answer_from_cache)(cacheable_question, user_input, langgraph_config)
+            if cached_answer is not None:
+                yield "token", cached_answer
+                yield "done", cached_answer
+                return
+
+        llm_limiter = get_llm_limiter()
+        try:
+            await sync_to_async(llm_limiter.acquire, thread_sensitive=False)()
+        except AdmissionRejected as e:
+            print(f"--- DEBUG AGENT: astream_response - Turno rechazado por admisión: {e} ---")
+            yield "done", BUSY_BOT_MESSAGE
+            return
+        llm_started_at = time.perf_counter()
+        first_token_at = None
+        try:
+            async for message_chunk, metadata in self.graph_app.astream(
+                {"messages": [HumanMessage(content=user_input)]}, config=langgraph_config, stream_mode="messages"
+            ):
+                if metadata.get("langgraph_node") != "model" or not isinstance(message_chunk, AIMessage):
+                    continue
+                if first_token_at is None and message_chunk.content:
+                    first_token_at = time.perf_counter()
+                visible_text = hidden_summary_filter.feed(str(message_chunk.content))
+                if visible_text:
+                    yield "token", visible_text
+        except Exception as e:
+            print(f"!!!!!!!! DEBUG AGENT: ERROR durante graph_app.astream: {e} !!!!!!!!!")
+            await sync_to_async(self._save_turn_telemetry)(langgraph_config, LLMTurnTelemetry.MODE_STREAM, llm_started_at, telemetry_ids, error=e, first_token_at=first_token_at)
+            yield "done", AGENT_CATASTROPHIC_ERROR_MESSAGE
+            return
+        finally:
+            llm_limiter.release()
+        await sync_to_async(self._save_turn_telemetry)(langgraph_config, LLMTurnTelemetry.MODE_STREAM, llm_started_at, telemetry_ids, first_token_at=first_token_at)
+
+        remaining_text = hidden_summary_filter.flush()
+        if remaining_text:
+            yield "token", remaining_text
+        response_state = (await sync_to_async(self.graph_app.get_state)(langgraph_config)).values
+        user_facing_response = await sync_to_async(self._build_user_facing_response)(response_state, langgraph_thread_id)
+        if cacheable_question:
+            self._store_in_cache(cacheable_question, user_facing_response, llm_started_at, user_identifier)
+        yield "done", user_facing_response
+
+    def _answer_trivial_turn(self, user_input, langgraph_config):
+        """Respuesta de plantilla si el turno es trivial (saludo, gracias, despedida, vacío); si no, None."""
+        if self.trivial_turns is None:
+            return None
+        intent = self.trivial_turns.classify(user_input) # Los turnos con imagen nunca son triviales (contexto de la CNN)
+        if intent is None:
+            return None
+        is_first_turn = not self.graph_app.get_state(langgraph_config).values.get("messages")
+        reply = self.trivial_turns.reply_for(intent, is_first_turn=is_first_turn)
+        # El turno queda en la memoria del hilo igual que si hubiera respondido el LLM
+        self.graph_app.update_state(
+            langgraph_config,
+            {"messages": [HumanMessage(content=user_input), AIMessage(content=reply)]},
+            as_node="model",
+        )
+        metrics = self.trivial_turns.get_metrics()
+        print(
+            f"--- DEBUG AGENT: Turno trivial ({intent}) respondido sin LLM. "
+            f"Turnos sin LLM: {metrics['skipped']}/{metrics['turns']} ({metrics['skipped_ratio']:.0%}) ---"
+        )
+        return reply
+
+    def get_trivial_turn_metrics(self):
+        """Qué fracción de los turnos se contestó con plantillas, sin llamar al LLM."""
+        if self.trivial_turns is None:
+            return None
+        return self.trivial_turns.get_metrics()
+
+    def _cacheable_question(self, user_input, langgraph_config):
+        """Pregunta normalizada si el turno puede salir de la caché (primer turno, sin imagen, no personal); si no, None."""
+        if self.response_cache is None:
+            return None
+        cacheable_question = None
+        if not user_input.startswith(IMAGE_CONTEXT_PREFIX):
+            cacheable_question = self.response_cache.eligible_question(user_input)
+        if cacheable_question and self.graph_app.get_state(langgraph_config).values.get("messages"):
+            cacheable_question = None # No es el primer turno: la respuesta depende de la conversación
+        if cacheable_question is None:
+            self.response_cache.record_bypass()
+        return cacheable_question
+
+    def _answer_from_cache(self, cacheable_question, user_input, langgraph_config):
+        lookup_started_at = time.perf_counter()
+        cached_answer, similarity = self.response_cache.lookup(cacheable_question, version=self.system_prompt_cache.current_version())
+        if cached_answer is None:
+            print(f"--- DEBUG AGENT: Caché de respuestas - MISS (mejor similitud {similarity:.2f}) ---")
+            return None
+        # El turno queda en la memoria del hilo igual que si hubiera respondido el LLM
+        self.graph_app.update_state(
+            langgraph_config,
+            {"messages": [HumanMessage(content=user_input), AIMessage(content=cached_answer)]},
+            as_node="model",
+        )
+        metrics = self.response_cache.get_metrics()
+        print(
+            f"--- DEBUG AGENT: Caché de respuestas - HIT (similitud {similarity:.2f}) en {(time.perf_counter() - lookup_started_at) * 1000.0:.1f} ms. "
+            f"Tasa de aciertos {metrics['hit_rate']:.0%}, latencia ahorrada acumulada {metrics['latency_saved_ms'] / 1000.0:.1f} s ---"
+        )
+        return cached_answer
+
+    def _store_in_cache(self, cacheable_question, user_facing_response, llm_started_at, user_identifier):
+        llm_ms = (time.perf_counter() - llm_started_at) * 1000.0
+        if (
+            not user_facing_response
+            or user_facing_response in (LLM_TECHNICAL_ERROR_MESSAGE, AGENT_CATASTROPHIC_ERROR_MESSAGE)
+            or str(user_identifier) in user_facing_response # Respuesta personalizada: no sirve para otros
+            or user_facing_response.rstrip().endswith("?") # Terminó en pregunta: arrancó el protocolo de orientación
+        ):
+            return
+        self.response_cache.store(cacheable_question, user_facing_response, llm_ms=llm_ms, version=self.system_prompt_cache.current_version())
+
+    def _build_user_facing_response(self, response_state, langgraph_thread_id):
         llm_full_response_content = ""
         if response_state and response_state.get("messages"):
             all_messages_in_state = response_state.get("messages", [])
@@ -242,7 +767,7 @@ Si el usuario hace una pregunta muy específica sobre una enfermedad rara o un t
             
             llm_full_response_content = last_message_obj.content
             
-            if "Hubo un problema técnico" in llm_full_response_content:
+            if LLM_TECHNICAL_ERROR_MESSAGE in llm_full_response_content:
                 print("--- DEBUG AGENT: get_response - Devolviendo error técnico propagado.")
                 return llm_full_response_content
         else:
@@ -250,21 +775,20 @@ Si el usuario hace una pregunta muy específica sobre una enfermedad rara o un t
             return "Lo siento, no se recibió una respuesta estructurada del asistente."
 
         try:
-            conversation_uuid = uuid.UUID(langgraph_thread_id) 
-            conversation_obj = Conversation.objects.get(id=conversation_uuid)
-            user_facing_content = self._extract_and_save_medical_summary(llm_full_response_content, conversation_obj)
-            
+            user_facing_content = self._strip_hidden_summary_block(llm_full_response_content)
             if not user_facing_content.strip() and llm_full_response_content:
                 print("--- DEBUG AGENT: user_facing_content vacío post-extracción, devolviendo llm_full_response_content.")
                 return llm_full_response_content
 
+            if is_orientation_reply(user_facing_content):
+                # Etapa de orientación: la ficha médica sale de una llamada aparte, sin demorar esta respuesta
+                transcript = build_transcript(response_state["messages"], response_state.get("conversation_summary", ""))
+                self.summary_extractor.schedule(langgraph_thread_id, transcript, user_facing_content.strip())
+
             print(f"--- DEBUG AGENT: get_response - Devolviendo contenido final para el usuario: '{user_facing_content}'")
             return user_facing_content
-        except Conversation.DoesNotExist:
-            print(f"!!!!!!!! DEBUG AGENT: ERROR CRÍTICO - No se encontró Conversation con ID {langgraph_thread_id} para guardar resumen. !!!!!!!!")
-            return llm_full_response_content 
         except Exception as e:
-            print(f"!!!!!!!! DEBUG AGENT: ERROR al procesar/guardar resumen médico: {e} !!!!!!!!")
+            print(f"!!!!!!!! DEBUG AGENT: ERROR al encolar la ficha médica: {e} !!!!!!!!")
             return llm_full_response_content
 
     @classmethod
@@ -0,0 +1,118 @@
+# chatbot/services/prediction_cache.py
+import os
+import threading
+from collections import OrderedDict
+
+import xxhash
+
+from ..models import CNNPredictionCache
+from .image_pipeline import PREPROCESSING_VERSION
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_image_bytes(image_bytes):
+    """Hash de contenido de la imagen subida (bytes crudos, antes de decodificar)."""
+    return xxhash.xxh3_128_hexdigest(image_bytes)
+
+
+def compute_model_version(*file_paths):
+    """
+    Versión del modelo = hash del contenido de los archivos .h5/.keras.
+    Si se reemplazan los archivos, cambia la versión y la caché se invalida sola.
+    """
+    hasher = xxhash.xxh3_128()
+    for path in file_paths:
+        hasher.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as model_file:
+            for chunk in iter(lambda: model_file.read(_HASH_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class PredictionCache:
+    """
+    Caché de predicciones por contenido en dos niveles:
+    un LRU acotado en memoria y, detrás, la tabla CNNPredictionCache en la BD.
+    Las claves incluyen la versión del modelo y la del preprocesamiento de la imagen.
+    """
+
+    def __init__(self, model_version, preprocessing_version=PREPROCESSING_VERSION, max_memory_entries=1024, persist_to_db=True):
+        self.model_version = model_version
+        self.preprocessing_version = preprocessing_version
+        self.max_memory_entries = max(1, int(max_memory_entries))
+        self.persist_to_db = persist_to_db
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, image_hash):
+        """Devuelve (índice, confianza, probabilidades) o None si no está en caché."""
+        key = (self.model_version, self.preprocessing_version, image_hash)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry
+
+        if self.persist_to_db:
+            try:
+                row = CNNPredictionCache.objects.filter(
+                    image_hash=image_hash, model_version=self.model_version, preprocessing_version=self.preprocessing_version
+                ).values_list('predicted_index', 'confidence', 'probabilities').first()
+            except Exception as e:
+                print(f"--- CNN CACHE ERROR: No se pudo leer la caché persistente: {e}")
+                row = None
+            if row is not None:
+                entry = (row[0], row[1], row[2])
+                self._remember(key, entry)
+                with self._lock:
+                    self.db_hits += 1
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, image_hash, predicted_index, confidence, probabilities=None):
+        entry = (int(predicted_index), float(confidence), probabilities)
+        self._remember((self.model_version, self.preprocessing_version, image_hash), entry)
+        if not self.persist_to_db:
+            return
+        try:
+            CNNPredictionCache.objects.update_or_create(
+                image_hash=image_hash,
+                model_version=self.model_version,
+                preprocessing_version=self.preprocessing_version,
+                defaults={
+                    'predicted_index': entry[0],
+                    'confidence': entry[1],
+                    'probabilities': probabilities,
+                },
+            )
+        except Exception as e:
+            print(f"--- CNN CACHE ERROR: No se pudo guardar la predicción en la caché persistente: {e}")
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def get_metrics(self):
+        with self._lock:
+            total = self.memory_hits + self.db_hits + self.misses
+            return {
+                "model_version": self.model_version,
+                "preprocessing_version": self.preprocessing_version,
+                "memory_entries": len(self._memory),
+                "max_memory_entries": self.max_memory_entries,
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": ((self.memory_hits + self.db_hits) / total) if total else 0.0,
+            }
@@ -0,0 +1,241 @@
+# chatbot/services/response_cache.py
+"""
+Caché local de respuestas a preguntas generales de dermatología (modo 2 del prompt de sistema).
+
+Preguntas como "¿Qué es el acné?" no dependen de la conversación: la misma respuesta sirve para
+todos. Solo se usa en el primer turno de una conversación, sin contexto de imagen (CNN) y si la
+pregunta no describe un problema personal. La búsqueda es:
+1. texto normalizado (minúsculas, sin tildes ni signos) exacto;
+2. si no, similitud coseno TF-IDF sobre n-gramas de caracteres contra las preguntas guardadas
+   (índice invertido en memoria, sin dependencias externas), con un umbral.
+Las entradas vencen por TTL, el tamaño está acotado (LRU) y todo se vacía si cambia la lista de
+enfermedades, porque forma parte del prompt. La versión la da SystemPromptCache.content_version, que
+avanza cuando el texto de las enfermedades cambia (por el sello compartido o por su TTL), así que
+también se vacía en procesos que no ven el sello de otro.
+"""
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+
+_NON_WORD_PATTERN = re.compile(r'[^a-z0-9ñ ]+')
+_SPACES_PATTERN = re.compile(r'\s+')
+# Primera persona / problema propio: esas consultas siguen el protocolo de orientación, no se cachean
+_PERSONAL_PATTERN = re.compile(
+    r'\b(tengo|tenia|tuve|me|mi|mis|estoy|siento|sufro|padezco|yo|mio|mia)\b'
+)
+
+# Artículos, preposiciones y cópulas: no distinguen preguntas ("qué es el acné" ~ "qué es la acné"). Los
+# interrogativos (qué, cómo, cuándo...) se conservan porque sí cambian la pregunta.
+_FILLER_WORDS = frozenset('el la los las un una unos unas lo de del al a en y o es son se por favor'.split())
+
+
+def normalize_question(text):
+    """Minúsculas, sin tildes ni signos de puntuación y con espacios simples."""
+    decomposed = unicodedata.normalize('NFKD', (text or '').lower().replace('ñ', '\0'))
+    without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char)).replace('\0', 'ñ')
+    return _SPACES_PATTERN.sub(' ', _NON_WORD_PATTERN.sub(' ', without_accents)).strip()
+
+
+def is_personal_question(normalized_text):
+    return bool(_PERSONAL_PATTERN.search(normalized_text))
+
+
+def char_ngrams(normalized_text, ngram_sizes=(3, 4, 5)):
+    content_text = " ".join(word for word in normalized_text.split() if word not in _FILLER_WORDS) or normalized_text
+    padded = f" {content_text} "
+    return Counter(
+        padded[start:start + size]
+        for size in ngram_sizes
+        for start in range(len(padded) - size + 1)
+    )
+
+
+class _CachedAnswer:
+    __slots__ = ('answer', 'created_at', 'ngrams', 'hits')
+
+    def __init__(self, answer, ngrams):
+        self.answer = answer
+        self.created_at = time.monotonic()
+        self.ngrams = ngrams
+        self.hits = 0
+
+
+class GeneralQuestionCache:
+
+    def __init__(self, similarity_threshold=0.85, ttl_seconds=86400, max_entries=500, max_question_chars=200):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_question_chars = max_question_chars
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # pregunta normalizada -> _CachedAnswer (orden LRU)
+        self._postings = defaultdict(set) # n-grama -> preguntas normalizadas que lo contienen
+        self._document_frequency = Counter()
+        self._norms = {} # Normas TF-IDF por pregunta; se invalidan cuando cambia el IDF
+        self._idf_cache = {}
+        self._version = None
+        self.lookups = 0
+        self.hits = 0
+        self.similar_hits = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+        self.miss_llm_ms_total = 0.0
+        self.miss_llm_calls = 0
+        self.latency_saved_ms = 0.0
+
+    # --- Elegibilidad ---
+
+    def eligible_question(self, user_input):
+        """Pregunta normalizada si el turno puede usar la caché, o None."""
+        normalized = normalize_question(user_input)
+        if not normalized or len(normalized) > self.max_question_chars or is_personal_question(normalized):
+            return None
+        return normalized
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    # --- Búsqueda y guardado ---
+
+    def lookup(self, normalized_question, version=None):
+        """Devuelve (respuesta, similitud) o (None, mejor similitud encontrada)."""
+        started_at = time.perf_counter()
+        with self._lock:
+            self._check_version(version)
+            self._evict_expired()
+            self.lookups += 1
+
+            entry = self._entries.get(normalized_question)
+            similarity = 1.0 if entry is not None else 0.0
+            if entry is None:
+                matched_question, similarity = self._most_similar(normalized_question)
+                if matched_question is not None and similarity >= self.similarity_threshold:
+                    entry = self._entries[matched_question]
+                    normalized_question = matched_question
+                    self.similar_hits += 1
+            if entry is None:
+                return None, similarity
+
+            self._entries.move_to_end(normalized_question)
+            entry.hits += 1
+            self.hits += 1
+            lookup_ms = (time.perf_counter() - started_at) * 1000.0
+            if self.miss_llm_calls:
+                self.latency_saved_ms += max(0.0, self.miss_llm_ms_total / self.miss_llm_calls - lookup_ms)
+            return entry.answer, similarity
+
+    def store(self, normalized_question, answer, llm_ms=None, version=None):
+        with self._lock:
+            self._check_version(version)
+            if llm_ms is not None: # Para estimar cuánto ahorra cada hit
+                self.miss_llm_ms_total += llm_ms
+                self.miss_llm_calls += 1
+            if normalized_question in self._entries:
+                self._remove(normalized_question)
+            ngrams = char_ngrams(normalized_question)
+            self._entries[normalized_question] = _CachedAnswer(answer, ngrams)
+            for ngram in ngrams:
+                self._postings[ngram].add(normalized_question)
+                self._document_frequency[ngram] += 1
+            self._invalidate_weights()
+            self.stores += 1
+            while self.max_entries and len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # --- Índice TF-IDF ---
+
+    def _idf(self, ngram):
+        idf = self._idf_cache.get(ngram)
+        if idf is None:
+            idf = math.log((1 + len(self._entries)) / (1 + self._document_frequency.get(ngram, 0))) + 1.0
+            self._idf_cache[ngram] = idf
+        return idf
+
+    def _invalidate_weights(self):
+        self._norms.clear()
+        self._idf_cache.clear()
+
+    def _norm(self, question):
+        norm = self._norms.get(question)
+        if norm is None:
+            ngrams = self._entries[question].ngrams
+            norm = math.sqrt(sum((count * self._idf(ngram)) ** 2 for ngram, count in ngrams.items()))
+            self._norms[question] = norm
+        return norm
+
+    def _most_similar(self, normalized_question):
+        query_ngrams = char_ngrams(normalized_question)
+        query_weights = {ngram: count * self._idf(ngram) for ngram, count in query_ngrams.items()}
+        query_norm = math.sqrt(sum(weight * weight for weight in query_weights.values()))
+        if not query_norm:
+            return None, 0.0
+
+        dot_products = defaultdict(float)
+        for ngram, query_weight in query_weights.items():
+            postings = self._postings.get(ngram)
+            if not postings:
+                continue
+            weight = query_weight * self._idf(ngram)
+            for question in postings:
+                dot_products[question] += weight * self._entries[question].ngrams[ngram]
+
+        best_question, best_similarity = None, 0.0
+        for question, dot_product in dot_products.items():
+            similarity = dot_product / (query_norm * self._norm(question))
+            if similarity > best_similarity:
+                best_question, best_similarity = question, similarity
+        return best_question, best_similarity
+
+    # --- Mantenimiento ---
+
+    def _remove(self, question):
+        entry = self._entries.pop(question)
+        for ngram in entry.ngrams:
+            postings = self._postings[ngram]
+            postings.discard(question)
+            if not postings:
+                del self._postings[ngram]
+            self._document_frequency[ngram] -= 1
+            if self._document_frequency[ngram] <= 0:
+                del self._document_frequency[ngram]
+        self._invalidate_weights()
+
+    def _evict_expired(self):
+        if not self.ttl_seconds:
+            return
+        deadline = time.monotonic() - self.ttl_seconds
+        expired = [question for question, entry in self._entries.items() if entry.created_at <= deadline]
+        for question in expired:
+            self._remove(question)
+            self.evictions += 1
+
+    def _check_version(self, version):
+        if version is not None and version != self._version:
+            if self._entries:
+                print(f"--- DEBUG AGENT: Caché de respuestas vaciada (versión del prompt {self._version} -> {version}) ---")
+            self._entries.clear()
+            self._postings.clear()
+            self._document_frequency.clear()
+            self._invalidate_weights()
+            self._version = version
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'bypassed': self.bypassed,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'avg_miss_llm_ms': self.miss_llm_ms_total / self.miss_llm_calls if self.miss_llm_calls else None,
+                'latency_saved_ms': round(self.latency_saved_ms, 1),
+            }
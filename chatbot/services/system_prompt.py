@@ -0,0 +1,113 @@
+# chatbot/services/system_prompt.py
+"""
+Prompt de sistema de DermaBot preparado una sola vez.
+
+La parte estática del prompt y el bloque de enfermedades cambian solo cuando cambian las
+filas de Desease, así que se arman una vez y se guardan ya "compilados": el texto queda
+partido en trozos fijos alrededor de las variables por hilo ({user_identifier},
+{conversation_id_thread}) y cada turno solo hace un "".join(). Se reconstruye cuando avanza
+el sello de versión de Desease (el mismo que usa desease_index; lo avanza chatbot/signals.py) o,
+como en desease_index, cuando vence DESEASE_INDEX_TTL_SECONDS: sin un caché compartido (Redis,
+Memcached, BD) el sello de otro proceso no llega a este. content_version solo avanza si el texto
+reconstruido cambió; la caché de respuestas lo usa para vaciarse.
+
+Las variables por hilo van al final del prompt: así todo lo anterior (protocolo + lista de
+enfermedades) es un prefijo idéntico entre conversaciones y el proveedor puede reutilizar su
+caché de prefijo (prompt caching automático de OpenAI, a partir de ~1024 tokens).
+"""
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .desease_index import VERSION_CACHE_KEY
+
+DESEASES_PLACEHOLDER = '{deseases_info_placeholder}'
+PER_THREAD_FIELDS = ('user_identifier', 'conversation_id_thread')
+_PER_THREAD_PATTERN = re.compile(r'\{(' + '|'.join(PER_THREAD_FIELDS) + r')\}')
+
+
+def compile_template(template_text):
+    """Parte el texto en [literal, campo, literal, campo, ..., literal] según las variables por hilo."""
+    return _PER_THREAD_PATTERN.split(template_text)
+
+
+class SystemPromptCache:
+
+    def __init__(self, base_template, deseases_text_builder):
+        self._base_template = base_template
+        self._deseases_text_builder = deseases_text_builder
+        self._lock = threading.Lock()
+        self._parts = None
+        self._static_text = None
+        self._version = None
+        self._built_at = 0.0
+        self.content_version = 0
+        self.rebuilds = 0
+        self.renders = 0
+        self.last_build_ms = None
+        self.total_render_ms = 0.0
+
+    def _rebuild(self, version):
+        started_at = time.perf_counter()
+        static_text = self._base_template.replace(DESEASES_PLACEHOLDER, self._deseases_text_builder())
+        if self._static_text is not None and static_text != self._static_text:
+            self.content_version += 1
+        self._static_text = static_text
+        self._parts = compile_template(static_text)
+        self._version = version
+        self._built_at = time.monotonic()
+        self.rebuilds += 1
+        self.last_build_ms = (time.perf_counter() - started_at) * 1000.0
+        print(f"--- DEBUG AGENT: Prompt de sistema reconstruido ({len(static_text)} caracteres, versión de Desease {version}) en {self.last_build_ms:.1f} ms ---")
+
+    def _is_stale(self, version):
+        ttl_seconds = getattr(settings, 'DESEASE_INDEX_TTL_SECONDS', 300)
+        return (
+            self._parts is None
+            or version != self._version
+            or (ttl_seconds and time.monotonic() - self._built_at > ttl_seconds)
+        )
+
+    def _ensure_current(self):
+        version = cache.get(VERSION_CACHE_KEY, 0)
+        if self._is_stale(version):
+            with self._lock:
+                if self._is_stale(version):
+                    self._rebuild(version)
+
+    def current_version(self):
+        """Versión del contenido del prompt (avanza solo si cambió el texto de las enfermedades)."""
+        self._ensure_current()
+        return self.content_version
+
+    def static_prefix(self):
+        """Texto anterior a la primera variable por hilo: idéntico en todas las conversaciones (caché de prefijo del proveedor)."""
+        self._ensure_current()
+        return self._parts[0]
+
+    def render(self, user_identifier, conversation_id_thread):
+        """Prompt de sistema completo para un hilo. Devuelve (texto, ms que tomó armarlo)."""
+        started_at = time.perf_counter()
+        self._ensure_current()
+
+        values = {'user_identifier': str(user_identifier), 'conversation_id_thread': str(conversation_id_thread)}
+        parts = self._parts
+        # Posiciones impares: nombres de campo (resultado de re.split con un grupo de captura)
+        text = "".join(values[part] if position % 2 else part for position, part in enumerate(parts))
+
+        render_ms = (time.perf_counter() - started_at) * 1000.0
+        self.renders += 1
+        self.total_render_ms += render_ms
+        return text, render_ms
+
+    def get_metrics(self):
+        return {
+            'renders': self.renders,
+            'rebuilds': self.rebuilds,
+            'last_build_ms': self.last_build_ms,
+            'avg_render_ms': self.total_render_ms / self.renders if self.renders else None,
+            'static_prefix_chars': len(self._parts[0]) if self._parts else None,
+        }
@@ -0,0 +1,105 @@
+# chatbot/services/trivial_turns.py
+"""
+Atajo sin LLM para turnos triviales: saludos, agradecimientos, despedidas y mensajes vacíos.
+
+El prompt de sistema ya fija qué se contesta a un saludo solo ("¿Podrías describirme tu problema de
+piel...?"), pero igual se pagaba una llamada completa al LLM con el prompt de varios KB. Aquí se
+reconocen esos turnos con patrones compilados sobre el texto normalizado (el mismo normalize_question
+de la caché de respuestas) y se contestan con plantillas. El mensaje tiene que estar formado SOLO por
+frases triviales: "hola, tengo granos" sigue yendo al LLM. Tampoco se atajan "sí", "no", "ok" o "vale"
+solos, porque pueden ser la respuesta a una pregunta del protocolo.
+"""
+import re
+import threading
+from collections import Counter
+
+from .response_cache import normalize_question
+from .turn_input import NO_USER_INPUT_TEXT
+
+INTENT_EMPTY = 'empty'
+INTENT_GREETING = 'greeting'
+INTENT_THANKS = 'thanks'
+INTENT_FAREWELL = 'farewell'
+
+# Una frase por match; las alternativas largas van primero ("buenas tardes" antes que "buenas")
+_PHRASE_PATTERN = re.compile(
+    r' ?(?:'
+    r'(?P<greeting>buenas tardes|buenas noches|buenos dias|buen dia|buenas|hola+|holis?|hey|saludos|que tal|como estas?|hello|hi)'
+    r'|(?P<thanks>muchisimas gracias|muchas gracias|mil gracias|gracias|te lo agradezco|se agradece|thank you|thanks)'
+    r'|(?P<farewell>hasta luego|hasta pronto|hasta ma[nñ]ana|nos vemos|adios|chau|chao|bye)'
+    r'|(?P<filler>por todo|por la ayuda|por tu ayuda|de nuevo|muy bien|igualmente|dermabot|doctora|doctor|doc|amigo|amiga|'
+    r'okay|okey|ok|vale|genial|perfecto|listo|bueno|excelente|y|bot)'
+    r')\b'
+)
+
+# Si el mensaje mezcla varias, gana la que cierra la charla
+_INTENT_PRIORITY = (INTENT_FAREWELL, INTENT_THANKS, INTENT_GREETING)
+
+_ASK_FOR_PROBLEM = "¿Podrías describirme tu problema de piel y dónde se localiza, o subir una imagen si lo prefieres?"
+FIRST_GREETING_REPLY = f"¡Hola! Soy DermaBot. {_ASK_FOR_PROBLEM}"
+REPEATED_GREETING_REPLY = f"¡Hola de nuevo! {_ASK_FOR_PROBLEM}"
+TRIVIAL_TURN_REPLIES = {
+    INTENT_EMPTY: f"No recibí ningún mensaje. {_ASK_FOR_PROBLEM}",
+    INTENT_THANKS: (
+        "¡De nada! Si tienes otra duda sobre tu piel o quieres contarme algo más, aquí estoy. "
+        "Recuerda que esto no reemplaza la consulta con un dermatólogo."
+    ),
+    INTENT_FAREWELL: (
+        "¡Hasta pronto! Cuídate, y recuerda que para un diagnóstico y un tratamiento adecuados "
+        "es importante que consultes a un dermatólogo."
+    ),
+}
+
+
+def classify(user_input, max_chars=60):
+    """Intención del turno si es trivial (INTENT_*), o None si tiene que responderlo el LLM."""
+    if not user_input or user_input.strip() in ('', NO_USER_INPUT_TEXT):
+        return INTENT_EMPTY
+    normalized = normalize_question(user_input)
+    if not normalized or len(normalized) > max_chars:
+        return None # Solo signos o emojis ("???" tras una pregunta del bot): que responda el LLM
+
+    intents = set()
+    position = 0
+    while position < len(normalized):
+        match = _PHRASE_PATTERN.match(normalized, position)
+        if match is None:
+            return None # Hay algo más que frases triviales
+        intents.add(match.lastgroup)
+        position = match.end()
+    return next((intent for intent in _INTENT_PRIORITY if intent in intents), None)
+
+
+class TrivialTurnResponder:
+
+    def __init__(self, max_chars=60):
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.skipped = 0
+        self.skipped_by_intent = Counter()
+
+    def classify(self, user_input):
+        """Intención si el turno se contesta sin LLM, o None. Cuenta todos los turnos para la métrica."""
+        intent = classify(user_input, max_chars=self.max_chars)
+        with self._lock:
+            self.turns += 1
+            if intent is not None:
+                self.skipped += 1
+                self.skipped_by_intent[intent] += 1
+        return intent
+
+    @staticmethod
+    def reply_for(intent, is_first_turn=True):
+        if intent == INTENT_GREETING:
+            return FIRST_GREETING_REPLY if is_first_turn else REPEATED_GREETING_REPLY
+        return TRIVIAL_TURN_REPLIES[intent]
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'turns': self.turns,
+                'skipped': self.skipped,
+                'skipped_ratio': self.skipped / self.turns if self.turns else 0.0,
+                'skipped_by_intent': dict(self.skipped_by_intent),
+            }
@@ -0,0 +1,48 @@
+# chatbot/services/turn_input.py
+"""
+Armado del input del turno para el LLM a partir del texto del usuario y del resultado de la CNN.
+Lo usan las vistas del chat y el worker de la cola de trabajos (chat_jobs.py).
+"""
+
+IMAGE_CONTEXT_PREFIX = "Contexto de imagen:" # Marca los turnos que traen resultado de la CNN
+NO_USER_INPUT_TEXT = "El usuario no proporcionó entrada." # Turno sin texto ni imagen
+
+
+def cnn_context_for_llm(uploaded_images, predicted_desease_obj, confidence_percent, per_image_results):
+    """Texto de contexto que se le pasa al LLM con el resultado de la CNN."""
+    if predicted_desease_obj:
+        print(f"--- VIEW DEBUG: Predicción CNN: {predicted_desease_obj.name_desease}, Confianza: {confidence_percent:.1f}%")
+        if len(uploaded_images) == 1:
+            return (
+                f"{IMAGE_CONTEXT_PREFIX} El análisis preliminar de la imagen subida por el usuario sugiere "
+                f"que podría estar relacionado con '{predicted_desease_obj.name_desease}' "
+                f"(confianza de la CNN: {confidence_percent:.1f}%). "
+                f"Considera esta información en tu diálogo y orientación."
+            )
+        per_image_text = ", ".join(
+            f"imagen {position}: {desease.name_desease if desease else 'sin resultado'} ({confidence:.1f}%)"
+            for position, (desease, confidence) in enumerate(per_image_results, start=1)
+        )
+        return (
+            f"{IMAGE_CONTEXT_PREFIX} El usuario subió {len(uploaded_images)} imágenes de la misma lesión. "
+            f"El análisis preliminar combinado sugiere que podría estar relacionado con "
+            f"'{predicted_desease_obj.name_desease}' (confianza combinada de la CNN: {confidence_percent:.1f}%; "
+            f"{per_image_text}). Considera esta información en tu diálogo y orientación."
+        )
+    print("--- VIEW DEBUG: Predicción CNN: No se pudo determinar una condición específica.")
+    return (
+        f"{IMAGE_CONTEXT_PREFIX} El usuario subió una imagen, pero el análisis preliminar de la CNN "
+        "no pudo determinar una condición específica de su lista de referencia. "
+        "Procede con preguntas generales sobre la apariencia si es necesario."
+    )
+
+
+def final_input_for_llm(user_input_text, cnn_prediction_info_for_llm):
+    """Mensaje del turno para el LLM: contexto de la CNN + lo que escribió el usuario."""
+    if user_input_text and cnn_prediction_info_for_llm:
+        return f"{cnn_prediction_info_for_llm} El usuario también comentó: '{user_input_text}'"
+    if cnn_prediction_info_for_llm:
+        return cnn_prediction_info_for_llm
+    if user_input_text:
+        return user_input_text
+    return NO_USER_INPUT_TEXT
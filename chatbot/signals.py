@@ -0,0 +1,12 @@
+# chatbot/signals.py
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Desease
+from .services.desease_index import desease_index
+
+
+@receiver([post_save, post_delete], sender=Desease)
+def invalidate_desease_index(sender, **kwargs):
+    # Avanza el sello de versión compartido: también hace que se rearme el prompt de sistema cacheado
+    desease_index.invalidate()
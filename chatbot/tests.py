@@ -1,3 +1,1511 @@
-from django.test import TestCase
+import importlib
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+import httpx
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils.datastructures import MultiValueDict
+from PIL import Image
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from .forms import MessageForm
+from .management.commands import convert_cnn_model
+from .models import ChatJob, CNNPredictionCache, Conversation, Desease, LLMTurnTelemetry, MedicalSummary, Message, MessageImage
+from .services import admission, cnn_model_server, llm_telemetry, llm_transport
+from .services.admission import AdmissionRejected, ConcurrencyLimiter, SessionRateLimiter
+from .services.medical_summary import MedicalSummaryExtraction
+from .services import trivial_turns
+from .services.chat_jobs import FAILED_BOT_MESSAGE, PENDING_BOT_MESSAGE, ChatJobWorker, enqueue_chat_turn
+from .services.cnn_backends import KerasBackend, TFLiteBackend, load_backend
+from .services.cnn_model_server import CNNModelServer, CNNModelServerClient, CNNModelServerError, _RequestHandler, _ThreadingUnixStreamServer
+from .services.cnn_service import CNNBatchScheduler, CNNProcessor
+from .services.desease_index import DeseaseIndex
+from .services.image_pipeline import MODEL_INPUT_SIZE, PREPROCESSING_VERSION, decode_for_model
+from .services.model_lifecycle import ModelLifecycle, model_lifecycle
+from .services.openai_agent_service import ConversationContextManager, DermaBotAgent, HiddenSummaryStreamFilter
+from .services import response_cache
+from .services.response_cache import GeneralQuestionCache
+
+
+class RecordingChatModel:
+    """Cliente de chat stub: guarda los mensajes de cada llamada y devuelve usage_metadata fijo."""
+
+    def __init__(self, cached_tokens=1024, reply_text="Esta es información general y no reemplaza el consejo de un dermatólogo."):
+        self.calls = []
+        self.cached_tokens = cached_tokens
+        self.reply_text = reply_text
+
+    def invoke(self, messages):
+        self.calls.append(messages)
+        return AIMessage(
+            content=self.reply_text,
+            usage_metadata={
+                'input_tokens': 1500,
+                'output_tokens': 20,
+                'total_tokens': 1520,
+                'input_token_details': {'cache_read': self.cached_tokens},
+            },
+        )
+
+    async def ainvoke(self, messages):
+        return self.invoke(messages)
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHATBOT_RESPONSE_CACHE_ENABLED=False)
+class SystemPromptPrefixTests(TestCase):
+
+    def setUp(self):
+        Desease.objects.create(name_desease='Acné', short_description_for_llm='Granos, espinillas. Cara/pecho/espalda.', cnn_prediction_index=0)
+        Desease.objects.create(name_desease='Psoriasis', short_description_for_llm='Placas rojas con escamas. Codos/rodillas.', cnn_prediction_index=1)
+        self.agent = DermaBotAgent()
+        self.chat_model = RecordingChatModel()
+        self.agent.model = self.chat_model
+
+    def _system_prompt_for_new_thread(self, user_identifier):
+        conversation = Conversation.objects.create()
+        self.agent.get_response("Tengo manchas rojas en el codo", str(conversation.id), user_identifier)
+        system_message = self.chat_model.calls[-1][0]
+        self.assertIsInstance(system_message, SystemMessage)
+        return conversation, system_message.content
+
+    def test_static_prefix_is_byte_identical_across_threads(self):
+        first_conversation, first_prompt = self._system_prompt_for_new_thread('Usuario_ana')
+        second_conversation, second_prompt = self._system_prompt_for_new_thread('Usuario_luis')
+
+        static_prefix = self.agent.system_prompt_cache.static_prefix().encode('utf-8')
+        self.assertTrue(first_prompt.encode('utf-8').startswith(static_prefix))
+        self.assertTrue(second_prompt.encode('utf-8').startswith(static_prefix))
+        # Protocolo y lista de enfermedades dentro del prefijo; los datos por hilo, después
+        self.assertIn(b'PROTOCOLO DE INTERACCI', static_prefix)
+        self.assertIn('Psoriasis: Placas rojas'.encode('utf-8'), static_prefix)
+        for per_thread_value in ('Usuario_ana', 'Usuario_luis', str(first_conversation.id), str(second_conversation.id)):
+            self.assertNotIn(per_thread_value.encode('utf-8'), static_prefix)
+        self.assertIn('Usuario_ana', first_prompt[len(self.agent.system_prompt_cache.static_prefix()):])
+        # Todo lo que difiere entre hilos está en el último ~2% del prompt
+        self.assertGreater(len(static_prefix), 0.95 * len(first_prompt.encode('utf-8')))
+
+    def test_cached_tokens_are_recorded_from_usage_metadata(self):
+        self._system_prompt_for_new_thread('Usuario_ana')
+        self._system_prompt_for_new_thread('Usuario_luis')
+
+        metrics = self.agent.get_prompt_cache_metrics()
+        self.assertEqual(metrics['llm_calls'], 2)
+        self.assertEqual(metrics['prompt_tokens'], 3000)
+        self.assertEqual(metrics['cached_tokens'], 2048)
+
+    def test_prompt_is_built_once_and_rebuilt_when_a_desease_changes(self):
+        self._system_prompt_for_new_thread('Usuario_ana')
+        self._system_prompt_for_new_thread('Usuario_luis')
+        self.assertEqual(self.agent.system_prompt_cache.get_metrics()['rebuilds'], 1)
+
+        Desease.objects.create(name_desease='Rosácea', short_description_for_llm='Enrojecimiento facial.', cnn_prediction_index=2)
+        _, prompt = self._system_prompt_for_new_thread('Usuario_ana')
+        self.assertIn('Rosácea: Enrojecimiento facial.', prompt)
+        self.assertEqual(self.agent.system_prompt_cache.get_metrics()['rebuilds'], 2)
+
+    @override_settings(DESEASE_INDEX_TTL_SECONDS=60)
+    def test_desease_change_from_another_process_reaches_prompt_and_response_cache(self):
+        prompt_cache = self.agent.system_prompt_cache
+        version = prompt_cache.current_version()
+        response_cache = GeneralQuestionCache()
+        response_cache.store('que acne', 'El acné es una afección de los folículos.', version=version)
+        # .update() no dispara señales ni avanza el sello: es lo que ve un proceso con LocMemCache
+        Desease.objects.filter(name_desease='Psoriasis').update(short_description_for_llm='Placas plateadas.')
+        self.assertNotIn('Placas plateadas', prompt_cache.static_prefix())
+
+        prompt_cache._built_at -= 61 # Vence el TTL
+        self.assertIn('Placas plateadas', prompt_cache.static_prefix())
+        self.assertEqual(prompt_cache.current_version(), version + 1)
+        cached_answer, _ = response_cache.lookup('que acne', version=prompt_cache.current_version())
+        self.assertIsNone(cached_answer)
+
+        prompt_cache._built_at -= 61 # Otra reconstrucción con el mismo texto no vacía nada
+        self.assertEqual(prompt_cache.current_version(), version + 1)
+
+
+class StructuredSummaryModel:
+    """Modelo stub de with_structured_output: devuelve siempre la misma extracción."""
+
+    def __init__(self, extraction):
+        self.extraction = extraction
+        self.calls = []
+
+    def invoke(self, messages):
+        self.calls.append(messages)
+        return self.extraction
+
+
+class GatedSummaryModel(StructuredSummaryModel):
+    """Como StructuredSummaryModel, pero la primera llamada espera a que el test abra la compuerta."""
+
+    def __init__(self, extraction):
+        super().__init__(extraction)
+        self.gate = threading.Event()
+
+    def invoke(self, messages):
+        if not self.calls:
+            self.gate.wait(timeout=5)
+        return super().invoke(messages)
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHATBOT_RESPONSE_CACHE_ENABLED=False)
+class BackgroundMedicalSummaryTests(TransactionTestCase):
+    # TransactionTestCase: la extracción corre en un hilo del pool, con su propia conexión a la BD
+
+    ORIENTATION_REPLY = (
+        "Por lo que describes, podría tratarse de Psoriasis.\n"
+        "Recuerda, esta es solo una orientación general y no reemplaza el diagnóstico de un dermatólogo."
+    )
+
+    def setUp(self):
+        Desease.objects.create(name_desease='Psoriasis', short_description_for_llm='Placas rojas con escamas. Codos/rodillas.', cnn_prediction_index=0)
+        self.agent = DermaBotAgent()
+        self.agent.model = RecordingChatModel(reply_text=self.ORIENTATION_REPLY)
+        self.summary_model = StructuredSummaryModel(MedicalSummaryExtraction(
+            main_complaint="Manchas rojas con escamas en el codo",
+            location_of_symptoms="Codo derecho",
+            duration_of_symptoms="Dos semanas",
+        ))
+        self.agent.summary_extractor.structured_model = self.summary_model
+
+    def test_orientation_reply_schedules_structured_summary(self):
+        conversation = Conversation.objects.create()
+        reply = self.agent.get_response("Tengo manchas rojas con escamas en el codo hace dos semanas", str(conversation.id), 'Usuario_ana')
+        self.agent.summary_extractor._executor.shutdown(wait=True)
+
+        self.assertEqual(reply, self.ORIENTATION_REPLY) # La respuesta es solo la orientación, sin bloque oculto
+        self.assertEqual(len(self.summary_model.calls), 1)
+        self.assertIn("Usuario: Tengo manchas rojas", self.summary_model.calls[0][1].content)
+
+        summary = MedicalSummary.objects.get(conversation=conversation)
+        self.assertEqual(summary.location_of_symptoms, "Codo derecho")
+        self.assertIsNone(summary.symptoms_reported)
+        self.assertEqual(summary.tentative_orientation_by_llm, self.ORIENTATION_REPLY)
+        self.assertIn("Duración: Dos semanas", summary.summary_text_generated_by_llm)
+        self.assertEqual(self.agent.summary_extractor.get_metrics()['completed'], 1)
+
+    def test_turns_during_extraction_rerun_it_once_with_the_latest_transcript(self):
+        conversation_id = str(Conversation.objects.create().id)
+        extractor = self.agent.summary_extractor
+        gated_model = GatedSummaryModel(self.summary_model.extraction)
+        extractor.structured_model = gated_model
+
+        first_future = extractor.schedule(conversation_id, "Usuario: turno 1", self.ORIENTATION_REPLY)
+        self.assertIsNone(extractor.schedule(conversation_id, "Usuario: turno 2", self.ORIENTATION_REPLY))
+        self.assertIsNone(extractor.schedule(conversation_id, "Usuario: turno 3", self.ORIENTATION_REPLY))
+        gated_model.gate.set()
+        first_future.result(timeout=5)
+        deadline = time.monotonic() + 5
+        while extractor.get_metrics()['in_flight'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual([call[1].content for call in gated_model.calls], ["Usuario: turno 1", "Usuario: turno 3"])
+        metrics = extractor.get_metrics()
+        self.assertEqual((metrics['completed'], metrics['coalesced'], metrics['in_flight']), (2, 2, 0))
+
+    def test_non_orientation_reply_does_not_schedule_summary(self):
+        self.agent.model = RecordingChatModel(reply_text="¿Desde cuándo tienes las manchas?")
+        conversation = Conversation.objects.create()
+        self.agent.get_response("Tengo manchas rojas en el codo", str(conversation.id), 'Usuario_ana')
+        self.agent.summary_extractor._executor.shutdown(wait=True)
+
+        self.assertEqual(self.summary_model.calls, [])
+        self.assertFalse(MedicalSummary.objects.filter(conversation=conversation).exists())
+
+
+class FailingChatModel:
+    model_name = "gpt-4o-mini"
+
+    def invoke(self, messages):
+        raise TimeoutError("El proveedor no respondió a tiempo")
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHATBOT_RESPONSE_CACHE_ENABLED=False, CHATBOT_TRIVIAL_TURNS_ENABLED=False)
+class BoundedMemorySaverTests(TestCase):
+    # Dos agentes = dos workers con su propia memoria y la misma BD
+
+    def setUp(self):
+        Desease.objects.create(name_desease='Acné', short_description_for_llm='Granos, espinillas. Cara/pecho/espalda.', cnn_prediction_index=0)
+        self.worker_a = DermaBotAgent()
+        self.worker_b = DermaBotAgent()
+        self.worker_a.model = RecordingChatModel(reply_text="Entendido. ¿Desde cuándo tienes la lesión?")
+        self.worker_b.model = RecordingChatModel(reply_text="Gracias. ¿Te pica o te duele?")
+        self.conversation = Conversation.objects.create()
+
+    def _turn(self, worker, user_text):
+        # Igual que la vista: el mensaje del usuario se guarda antes de llamar al agente
+        Message.objects.create(conversation=self.conversation, content=user_text, is_bot=False)
+        reply = worker.get_response(user_text, str(self.conversation.id), 'Usuario_ana')
+        Message.objects.create(conversation=self.conversation, content=reply, is_bot=True)
+
+    def _sent_to_llm(self, worker):
+        return [str(message.content) for message in worker.model.calls[-1]]
+
+    def test_checkpoint_left_behind_by_another_worker_is_rebuilt(self):
+        self._turn(self.worker_a, "Tengo granos en la cara")
+        self._turn(self.worker_b, "Desde hace dos semanas")
+        self._turn(self.worker_a, "Me pican un poco")
+
+        self.assertIn("Desde hace dos semanas", self._sent_to_llm(self.worker_a))
+        self.assertEqual(self._sent_to_llm(self.worker_a).count("Tengo granos en la cara"), 1)
+        self.assertEqual(self.worker_a.checkpointer.get_metrics()['stale_rebuilds'], 1)
+
+        self._turn(self.worker_a, "No tengo fiebre") # Turno seguido en el mismo worker: usa la memoria
+        metrics = self.worker_a.checkpointer.get_metrics()
+        self.assertEqual(metrics['stale_rebuilds'], 1)
+        self.assertGreater(metrics['hits'], 0)
+
+    def test_threads_beyond_the_limit_are_evicted_and_rebuilt_from_the_db(self):
+        checkpointer = self.worker_a.checkpointer
+        checkpointer.max_threads = 1
+        other_conversation = Conversation.objects.create()
+        self._turn(self.worker_a, "Tengo granos en la cara")
+        self.worker_a.get_response("Hola, tengo una duda", str(other_conversation.id), 'Usuario_luis')
+
+        metrics = checkpointer.get_metrics()
+        self.assertEqual((metrics['threads'], metrics['evictions']), (1, 1))
+        self.assertGreater(metrics['approx_bytes'], 0)
+
+        self._turn(self.worker_a, "Desde hace dos semanas") # El hilo desalojado vuelve desde los Message
+        self.assertIn("Tengo granos en la cara", self._sent_to_llm(self.worker_a))
+        self.assertEqual(checkpointer.get_metrics()['rehydrations'], 1)
+
+    def test_idle_threads_expire_after_the_ttl(self):
+        checkpointer = self.worker_a.checkpointer
+        self._turn(self.worker_a, "Tengo granos en la cara")
+        thread_id = str(self.conversation.id)
+        checkpointer._last_access[thread_id] -= checkpointer.ttl_seconds + 1
+
+        self._turn(self.worker_a, "Desde hace dos semanas")
+        self.assertEqual(checkpointer.get_metrics()['evictions'], 1)
+        self.assertIn("Tengo granos en la cara", self._sent_to_llm(self.worker_a))
+
+    def test_rebuilt_thread_starts_from_the_saved_summary(self):
+        summary_model = StructuredSummaryModel(AIMessage(content="Granos en la cara desde hace dos semanas."))
+        self.worker_a.context_manager.summary_model = summary_model
+        self.worker_a.context_manager.history_token_budget = 40
+        self._turn(self.worker_a, "Tengo granos en la cara")
+        self._turn(self.worker_a, "Desde hace dos semanas")
+        self._turn(self.worker_a, "Me pican un poco")
+        self.assertTrue(summary_model.calls)
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.history_summary, "Granos en la cara desde hace dos semanas.")
+        self.assertGreater(self.conversation.history_summary_messages, 0)
+
+        self._turn(self.worker_b, "No tengo fiebre")
+        sent = self._sent_to_llm(self.worker_b)
+        self.assertTrue(any("Granos en la cara desde hace dos semanas." in content for content in sent))
+        self.assertNotIn("Tengo granos en la cara", sent) # Ya está en el resumen: no se vuelve a cargar
+        self.assertIn("Me pican un poco", sent)
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHATBOT_RESPONSE_CACHE_ENABLED=False)
+class LLMTurnTelemetryTests(TestCase):
+
+    def setUp(self):
+        Desease.objects.create(name_desease='Acné', short_description_for_llm='Granos, espinillas. Cara/pecho/espalda.', cnn_prediction_index=0)
+        self.agent = DermaBotAgent()
+        self.agent.model = RecordingChatModel(cached_tokens=1024)
+        self.conversation = Conversation.objects.create()
+
+    def test_turn_records_usage_and_links_bot_message(self):
+        telemetry_ids = []
+        reply = self.agent.get_response("Tengo granos en la cara", str(self.conversation.id), 'Usuario_ana', telemetry_ids=telemetry_ids)
+        bot_message = Message.objects.create(conversation=self.conversation, content=reply, is_bot=True)
+        llm_telemetry.attach_to_message(self.conversation.id, bot_message.id, telemetry_ids)
+
+        telemetry = LLMTurnTelemetry.objects.get(conversation=self.conversation)
+        self.assertEqual(telemetry.message, bot_message)
+        self.assertEqual(telemetry.call_mode, LLMTurnTelemetry.MODE_SYNC)
+        self.assertEqual((telemetry.prompt_tokens, telemetry.completion_tokens, telemetry.cached_tokens), (1500, 20, 1024))
+        self.assertEqual(telemetry.error_class, '')
+        self.assertIsNone(telemetry.ttft_ms) # Sin stream no hay primer token aparte
+
+    def test_concurrent_turns_of_a_thread_keep_their_own_telemetry(self):
+        thread_id = str(self.conversation.id)
+        first_config = self.agent._turn_config(thread_id, 'Usuario_ana')
+        second_config = self.agent._turn_config(thread_id, 'Usuario_ana')
+        started_at = time.perf_counter()
+        # Los dos nodos terminan antes de que cualquiera de los turnos guarde su fila
+        self.agent._stash_turn_telemetry(first_config, started_at, response=AIMessage(content="a", usage_metadata={'input_tokens': 100, 'output_tokens': 1, 'total_tokens': 101}))
+        self.agent._stash_turn_telemetry(second_config, started_at, error=TimeoutError())
+        first_ids, second_ids = [], []
+        self.agent._save_turn_telemetry(second_config, LLMTurnTelemetry.MODE_ASYNC, started_at, second_ids)
+        self.agent._save_turn_telemetry(first_config, LLMTurnTelemetry.MODE_SYNC, started_at, first_ids)
+
+        first_row = LLMTurnTelemetry.objects.get(id=first_ids[0])
+        second_row = LLMTurnTelemetry.objects.get(id=second_ids[0])
+        self.assertEqual((first_row.prompt_tokens, first_row.error_class), (100, ''))
+        self.assertEqual(second_row.error_class, 'TimeoutError')
+
+        bot_message = Message.objects.create(conversation=self.conversation, content="a", is_bot=True)
+        self.assertEqual(llm_telemetry.attach_to_message(self.conversation.id, bot_message.id, first_ids), 1)
+        second_row.refresh_from_db()
+        self.assertIsNone(second_row.message) # La fila del otro turno queda para su propio mensaje
+
+    def test_failed_call_records_error_class(self):
+        self.agent.model = FailingChatModel()
+        self.agent.get_response("Tengo granos en la cara", str(self.conversation.id), 'Usuario_ana')
+
+        telemetry = LLMTurnTelemetry.objects.get(conversation=self.conversation)
+        self.assertEqual(telemetry.error_class, 'TimeoutError')
+        self.assertEqual(telemetry.model_name, 'gpt-4o-mini')
+
+    def test_daily_percentiles_exclude_errors_from_latency(self):
+        for wall_ms in range(100, 1100, 100):
+            LLMTurnTelemetry.objects.create(conversation=self.conversation, wall_ms=wall_ms, prompt_tokens=1000, cached_tokens=500)
+        LLMTurnTelemetry.objects.create(conversation=self.conversation, wall_ms=60000, error_class='APITimeoutError')
+
+        with self.assertNumQueries(1):
+            (today,) = llm_telemetry.daily_percentiles(days=1)
+        self.assertEqual(today['calls'], 11)
+        self.assertEqual(today['errors'], 1)
+        self.assertAlmostEqual(today['wall_p50'], 550.0)
+        self.assertLess(today['wall_p99'], 1000.0 + 1e-6)
+        self.assertAlmostEqual(today['cached_ratio'], 0.5)
+        self.assertIsNone(today['ttft_p95'])
+
+
+class AdmissionControlTests(TestCase):
+
+    def test_limiter_sheds_when_queue_is_full(self):
+        limiter = ConcurrencyLimiter('LLM', max_in_flight=1, max_queue=0)
+        with limiter.slot():
+            self.assertTrue(limiter.is_saturated())
+            with self.assertRaises(AdmissionRejected):
+                limiter.acquire()
+        self.assertFalse(limiter.is_saturated())
+        metrics = limiter.get_metrics()
+        self.assertEqual((metrics['in_flight'], metrics['admitted'], metrics['shed_queue_full']), (0, 1, 1))
+
+    def test_limiter_times_out_in_queue(self):
+        limiter = ConcurrencyLimiter('CNN', max_in_flight=1, max_queue=1, queue_timeout_seconds=0.05)
+        limiter.acquire()
+        with self.assertRaises(AdmissionRejected):
+            limiter.acquire() # Entra a la cola y se vence la espera
+        self.assertEqual(limiter.get_metrics()['shed_timeout'], 1)
+
+    @override_settings(CHATBOT_CNN_MAX_IN_FLIGHT=4, CNN_BATCH_MAX_SIZE=16, CNN_BATCHING_ENABLED=True)
+    def test_small_cnn_cap_is_kept_and_batches_are_clamped_to_it(self):
+        admission._limiters.pop('cnn', None)
+        self.addCleanup(admission._limiters.pop, 'cnn', None)
+        self.assertEqual(admission.get_cnn_limiter().max_in_flight, 4) # El tope que eligió el operador
+        self.assertEqual(admission.cnn_batch_max_size(), 4)
+        with override_settings(CHATBOT_CNN_MAX_IN_FLIGHT=0):
+            self.assertEqual(admission.cnn_batch_max_size(), 16) # Sin tope
+
+    def test_session_bucket_allows_burst_then_limits(self):
+        rate_limiter = SessionRateLimiter(rate_per_minute=6, burst=2)
+        self.assertEqual([rate_limiter.allow('sesion-a')[0] for _ in range(3)], [True, True, False])
+        allowed, retry_after_seconds = rate_limiter.allow('sesion-a')
+        self.assertFalse(allowed)
+        self.assertGreater(retry_after_seconds, 0)
+        self.assertTrue(rate_limiter.allow('sesion-b')[0]) # Cada sesión tiene su propio bucket
+
+    def test_session_less_turns_are_keyed_by_the_client_ip_behind_a_trusted_proxy(self):
+        request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='6.6.6.6, 203.0.113.7')
+        request.session = mock.Mock(session_key=None)
+        self.assertEqual(admission.session_key_for(request), 'ip:10.0.0.2')
+        with override_settings(CHATBOT_TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(admission.session_key_for(request), 'ip:203.0.113.7') # La primera la escribió el cliente
+        with override_settings(CHATBOT_TRUSTED_PROXY_COUNT=3):
+            self.assertEqual(admission.session_key_for(request), 'ip:10.0.0.2') # Cabecera incompleta: no se confía
+        request.session = mock.Mock(session_key='abc123')
+        self.assertEqual(admission.session_key_for(request), 'abc123')
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHATBOT_RESPONSE_CACHE_ENABLED=False)
+class TrivialTurnFastPathTests(TestCase):
+
+    def setUp(self):
+        Desease.objects.create(name_desease='Acné', short_description_for_llm='Granos, espinillas. Cara/pecho/espalda.', cnn_prediction_index=0)
+        self.agent = DermaBotAgent()
+        self.chat_model = RecordingChatModel()
+        self.agent.model = self.chat_model
+        self.conversation = Conversation.objects.create()
+
+    def test_classifies_only_fully_trivial_messages(self):
+        self.assertEqual(trivial_turns.classify("¡Hola! 👋"), trivial_turns.INTENT_GREETING)
+        self.assertEqual(trivial_turns.classify("Muchas gracias por la ayuda"), trivial_turns.INTENT_THANKS)
+        self.assertEqual(trivial_turns.classify("ok gracias, chau"), trivial_turns.INTENT_FAREWELL)
+        self.assertEqual(trivial_turns.classify("Hasta mañana"), trivial_turns.INTENT_FAREWELL)
+        self.assertEqual(trivial_turns.classify("El usuario no proporcionó entrada."), trivial_turns.INTENT_EMPTY)
+        self.assertEqual(trivial_turns.classify("   "), trivial_turns.INTENT_EMPTY)
+        for message in ("hola, tengo granos en la cara", "sí", "ok", "no gracias", "holanda", "???"):
+            self.assertIsNone(trivial_turns.classify(message), message)
+
+    def test_greeting_skips_llm_and_stays_in_thread_memory(self):
+        thread_id = str(self.conversation.id)
+        reply = self.agent.get_response("Hola", thread_id, 'Usuario_ana')
+        self.assertEqual(reply, trivial_turns.FIRST_GREETING_REPLY)
+        self.assertEqual(self.chat_model.calls, [])
+
+        self.agent.get_response("Tengo granos en la cara", thread_id, 'Usuario_ana')
+        (llm_messages,) = self.chat_model.calls
+        self.assertEqual([message.content for message in llm_messages[1:]], ["Hola", trivial_turns.FIRST_GREETING_REPLY, "Tengo granos en la cara"])
+
+        self.assertEqual(self.agent.get_response("hola de nuevo", thread_id, 'Usuario_ana'), trivial_turns.REPEATED_GREETING_REPLY)
+        metrics = self.agent.get_trivial_turn_metrics()
+        self.assertEqual((metrics['turns'], metrics['skipped']), (3, 2))
+        self.assertAlmostEqual(metrics['skipped_ratio'], 2 / 3)
+
+
+class FakeCNNBackend:
+    """Backend de inferencia stub: clase 1 si la imagen es clara (media > 100), si no clase 0; guarda el tamaño de cada lote."""
+    name = 'fake'
+    model_version = 'f' * 32
+    input_shape = (None, 224, 224, 3)
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, batch_array):
+        self.batch_sizes.append(len(batch_array))
+        probabilities = np.zeros((len(batch_array), 7), dtype=np.float32)
+        is_light = batch_array.reshape(len(batch_array), -1).mean(axis=1) > 100
+        probabilities[:, 1] = is_light * 0.8 + 0.1
+        probabilities[:, 0] = 1.0 - probabilities[:, 1]
+        return probabilities
+
+
+def jpeg_bytes(color, size=(64, 64)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+class FakeCNNMixin:
+    """Instala FakeCNNBackend como modelo del proceso y MEDIA_ROOT temporal; restaura todo al terminar."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        media_override = override_settings(MEDIA_ROOT=self.media_root, CNN_PREDICTION_CACHE_ENABLED=False, CNN_MODEL_SERVER_SOCKET=None)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        saved_attributes = {name: getattr(CNNProcessor, name) for name in ('_instance', '_model_cnn_internal_instance', '_model_version', '_batch_scheduler', '_prediction_cache')}
+        self.addCleanup(lambda: [setattr(CNNProcessor, name, value) for name, value in saved_attributes.items()])
+        self.cnn_backend = FakeCNNBackend()
+        CNNProcessor._instance = None
+        CNNProcessor._batch_scheduler = None
+        CNNProcessor._prediction_cache = None
+        CNNProcessor._model_cnn_internal_instance = self.cnn_backend
+        CNNProcessor._model_version = self.cnn_backend.model_version
+        Desease.objects.get_or_create(name_desease='Melanoma', defaults={'short_description_for_llm': 'Lunar irregular.', 'cnn_prediction_index': 0})
+        Desease.objects.get_or_create(name_desease='Nevus', defaults={'short_description_for_llm': 'Lunar común.', 'cnn_prediction_index': 1})
+
+
+@override_settings(CNN_BATCHING_ENABLED=False)
+class RescoreImagesCommandTests(FakeCNNMixin, TestCase):
+
+    def test_rescores_each_image_and_recomputes_message_aggregate(self):
+        conversation = Conversation.objects.create()
+        message = Message.objects.create(conversation=conversation, content='', image=ContentFile(jpeg_bytes((255, 255, 255)), name='clara.jpg'))
+        MessageImage.objects.create(message=message, position=0, image=message.image.name)
+        MessageImage.objects.create(message=message, position=1, image=ContentFile(jpeg_bytes((0, 0, 0)), name='oscura.jpg'))
+        MessageImage.objects.create(message=message, position=2, image=ContentFile(jpeg_bytes((250, 250, 250)), name='clara2.jpg'))
+        legacy_message = Message.objects.create(conversation=conversation, content='', image=message.image.name) # Sin filas MessageImage
+
+        call_command('rescore_images', checkpoint=f"{self.media_root}/checkpoint.json", batch_size=2, stdout=StringIO())
+
+        message.refresh_from_db()
+        legacy_message.refresh_from_db()
+        self.assertEqual(
+            [(image.cnn_predicted_desease.name_desease, round(image.cnn_confidence)) for image in message.images.order_by('position')],
+            [('Nevus', 90), ('Melanoma', 90), ('Nevus', 90)],
+        )
+        # Agregado = promedio de probabilidades (como en el chat), no la predicción de la primera imagen
+        self.assertEqual(message.cnn_predicted_desease.name_desease, 'Nevus')
+        self.assertAlmostEqual(message.cnn_confidence, (0.9 + 0.1 + 0.9) / 3 * 100, places=3)
+        self.assertEqual((legacy_message.cnn_predicted_desease.name_desease, round(legacy_message.cnn_confidence)), ('Nevus', 90))
+
+    def _messages_with_one_image(self, count):
+        conversation = Conversation.objects.create()
+        return [
+            Message.objects.create(conversation=conversation, content='', image=ContentFile(jpeg_bytes((255, 255, 255)), name=f'clara{number}.jpg'))
+            for number in range(count)
+        ]
+
+    def test_resume_continues_after_the_checkpoint_of_the_same_model(self):
+        first, second, third = self._messages_with_one_image(3)
+        checkpoint_path = f"{self.media_root}/checkpoint.json"
+        with open(checkpoint_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump({'model_version': self.cnn_backend.model_version, 'last_id': first.id, 'processed': 1}, checkpoint_file)
+
+        call_command('rescore_images', checkpoint=checkpoint_path, resume=True, batch_size=1, stdout=StringIO())
+
+        self.assertEqual(self.cnn_backend.batch_sizes, [1, 1]) # Solo second y third
+        first.refresh_from_db()
+        third.refresh_from_db()
+        self.assertIsNone(first.cnn_predicted_desease)
+        self.assertEqual(third.cnn_predicted_desease.name_desease, 'Nevus')
+        with open(checkpoint_path, encoding='utf-8') as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file), {'model_version': self.cnn_backend.model_version, 'last_id': third.id, 'processed': 3})
+
+    def test_checkpoint_of_another_model_restarts_and_dry_run_writes_nothing(self):
+        messages = self._messages_with_one_image(2)
+        checkpoint_path = f"{self.media_root}/checkpoint.json"
+        with open(checkpoint_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump({'model_version': 'otro-modelo', 'last_id': messages[-1].id, 'processed': 2}, checkpoint_file)
+
+        call_command('rescore_images', checkpoint=checkpoint_path, resume=True, dry_run=True, stdout=StringIO())
+
+        self.assertEqual(self.cnn_backend.batch_sizes, [2]) # Desde cero, en un solo lote
+        self.assertFalse(Message.objects.filter(cnn_predicted_desease__isnull=False).exists())
+        with open(checkpoint_path, encoding='utf-8') as checkpoint_file:
+            self.assertEqual(json.load(checkpoint_file)['model_version'], 'otro-modelo')
+
+
+class RecordingAgent:
+    """Agente stub para las vistas: devuelve una respuesta fija y guarda el input de cada turno."""
+
+    def __init__(self):
+        self.inputs = []
+
+    def get_response(self, user_input, conversation_id, user_identifier="Usuario Anónimo", telemetry_ids=None):
+        self.inputs.append(user_input)
+        return "Entendido. ¿Desde cuándo tienes la lesión?"
+
+
+@override_settings(CNN_BATCHING_ENABLED=False, CHATBOT_BACKGROUND_JOBS=False, CHATBOT_SESSION_TURNS_PER_MINUTE=0)
+class OverlappedCNNTurnTests(FakeCNNMixin, TransactionTestCase):
+    # TransactionTestCase: la CNN corre en un hilo del pool con su propia conexión a la BD
+
+    def setUp(self):
+        super().setUp()
+        saved_models = (model_lifecycle.state, model_lifecycle.derma_agent, model_lifecycle.cnn_processor)
+        self.addCleanup(lambda: setattr(model_lifecycle, 'state', saved_models[0]))
+        self.addCleanup(model_lifecycle.use_models, saved_models[1], saved_models[2])
+        self.agent = RecordingAgent()
+        model_lifecycle.use_models(derma_agent=self.agent, cnn_processor=CNNProcessor.get_instance())
+        admission._limiters.clear()
+        self.addCleanup(admission._limiters.clear)
+        self.conversation = Conversation.objects.create()
+
+    def _post_images(self, *colors):
+        uploads = [SimpleUploadedFile(f'lesion{position}.jpg', jpeg_bytes(color), content_type='image/jpeg') for position, color in enumerate(colors)]
+        return self.client.post(f'/dermabot/session/{self.conversation.id}/', {'user_input': 'mira', 'image_upload': uploads})
+
+    def test_predictions_are_joined_before_the_llm_call(self):
+        response = self._post_images((255, 255, 255), (0, 0, 0))
+
+        self.assertEqual(response.status_code, 302)
+        user_message = Message.objects.get(conversation=self.conversation, is_bot=False)
+        self.assertEqual(user_message.cnn_predicted_desease.name_desease, 'Melanoma') # Promedio 0.5/0.5: gana el índice 0
+        self.assertEqual(
+            [(image.cnn_predicted_desease.name_desease, round(image.cnn_confidence)) for image in user_message.images.order_by('position')],
+            [('Nevus', 90), ('Melanoma', 90)],
+        )
+        (llm_input,) = self.agent.inputs
+        self.assertIn("imagen 1: Nevus (90.0%), imagen 2: Melanoma (90.0%)", llm_input)
+        self.assertEqual(admission.get_cnn_limiter().get_metrics()['in_flight'], 0)
+
+    @override_settings(CHATBOT_CNN_MAX_IN_FLIGHT=1, CHATBOT_CNN_MAX_QUEUE=0)
+    def test_rejected_cnn_turn_writes_nothing(self):
+        cnn_limiter = admission.get_cnn_limiter()
+        cnn_limiter.acquire() # Otra petición ocupa el único lugar
+        self.addCleanup(cnn_limiter.release)
+
+        response = self._post_images((255, 255, 255), (0, 0, 0))
+
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(Message.objects.filter(conversation=self.conversation).exists())
+        self.assertFalse(MessageImage.objects.exists())
+        self.assertEqual(self.agent.inputs, [])
+        self.assertEqual([name for _, _, names in os.walk(self.media_root) for name in names], []) # Ni la imagen se escribió
+        self.assertEqual(cnn_limiter.get_metrics()['shed_queue_full'], 1)
+
+
+class CNNBatchSchedulerTests(TestCase):
+
+    @staticmethod
+    def _row(value):
+        return np.full((1, 1, 1, 1), value, dtype=np.float32)
+
+    def _scheduler(self, predict_batch_fn, max_batch_size, max_wait_ms):
+        self.batch_sizes = []
+
+        def recording_predict(inputs):
+            self.batch_sizes.append(len(inputs))
+            return predict_batch_fn(inputs)
+
+        return CNNBatchScheduler(recording_predict, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def test_full_batch_flushes_without_waiting_for_the_window(self):
+        scheduler = self._scheduler(lambda inputs: inputs.reshape(-1, 1) * 10, max_batch_size=4, max_wait_ms=5000)
+        started_at = time.perf_counter()
+        futures = [scheduler.submit(self._row(value)) for value in range(4)]
+
+        results = [future.result(timeout=2) for future in futures]
+        self.assertLess(time.perf_counter() - started_at, 2.0) # No esperó la ventana de 5 s
+        self.assertEqual(self.batch_sizes, [4]) # Un solo forward pass
+        self.assertEqual([result.tolist() for result in results], [[[0.0]], [[10.0]], [[20.0]], [[30.0]]]) # Cada uno recibe sus filas
+        self.assertEqual(scheduler.get_metrics()['total_images'], 4)
+
+    def test_partial_batch_flushes_when_the_window_expires(self):
+        scheduler = self._scheduler(lambda inputs: inputs.reshape(-1, 1), max_batch_size=16, max_wait_ms=50)
+        started_at = time.perf_counter()
+        result = scheduler.predict(np.concatenate([self._row(1), self._row(2)]), timeout=2)
+
+        self.assertGreaterEqual(time.perf_counter() - started_at, 0.04)
+        self.assertEqual(result.tolist(), [[1.0], [2.0]])
+        self.assertEqual(self.batch_sizes, [2])
+
+    def test_forward_pass_error_reaches_every_caller_of_the_batch(self):
+        def failing_predict(inputs):
+            raise ValueError("forma de entrada inválida")
+
+        scheduler = self._scheduler(failing_predict, max_batch_size=2, max_wait_ms=5000)
+        futures = [scheduler.submit(self._row(value)) for value in range(2)]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                future.result(timeout=2)
+        self.assertEqual(scheduler.get_metrics()['total_errors'], 1)
+
+
+@override_settings(CNN_BATCHING_ENABLED=False)
+class PredictionCacheTests(FakeCNNMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache_override = override_settings(CNN_PREDICTION_CACHE_ENABLED=True, CNN_PREDICTION_CACHE_PERSIST=True)
+        cache_override.enable()
+        self.addCleanup(cache_override.disable)
+        self.processor = CNNProcessor()
+
+    def _predict(self, color):
+        _, confidence, per_image_results = self.processor.predict_from_image_files([ContentFile(jpeg_bytes(color), name='lesion.jpg')])
+        return per_image_results[0][0].name_desease, round(confidence)
+
+    def test_same_bytes_skip_inference_from_memory_then_from_db(self):
+        self.assertEqual(self._predict((255, 255, 255)), ('Nevus', 90))
+        self.assertEqual(self._predict((255, 255, 255)), ('Nevus', 90))
+        self.assertEqual(self.cnn_backend.batch_sizes, [1])
+        self.assertEqual(self.processor.get_prediction_cache().get_metrics()['memory_hits'], 1)
+
+        CNNProcessor._prediction_cache = None # Otro proceso: LRU vacío, misma tabla CNNPredictionCache
+        self.assertEqual(self._predict((255, 255, 255)), ('Nevus', 90))
+        self.assertEqual(self.cnn_backend.batch_sizes, [1])
+        self.assertEqual(self.processor.get_prediction_cache().get_metrics()['db_hits'], 1)
+
+        self.assertEqual(self._predict((0, 0, 0)), ('Melanoma', 90)) # Otro contenido: se infiere
+        self.assertEqual(self.cnn_backend.batch_sizes, [1, 1])
+
+    def test_new_model_version_does_not_reuse_old_predictions(self):
+        self._predict((255, 255, 255))
+        CNNProcessor._model_version = 'e' * 32
+        CNNProcessor._prediction_cache = None
+        self._predict((255, 255, 255))
+        self.assertEqual(self.cnn_backend.batch_sizes, [1, 1])
+
+    def test_rows_from_an_older_preprocessing_pipeline_are_not_served(self):
+        self._predict((255, 255, 255))
+        CNNPredictionCache.objects.update(preprocessing_version='', predicted_index=0) # Fila del pipeline anterior
+        CNNProcessor._prediction_cache = None
+
+        self.assertEqual(self._predict((255, 255, 255)), ('Nevus', 90))
+        self.assertEqual(self.cnn_backend.batch_sizes, [1, 1])
+        self.assertEqual(CNNPredictionCache.objects.filter(preprocessing_version=PREPROCESSING_VERSION).count(), 1)
+
+
+@skipUnless(importlib.util.find_spec('tensorflow'), "Requiere TensorFlow")
+class KerasServingFunctionTests(TestCase):
+
+    def setUp(self):
+        import tensorflow as tf
+
+        self.model = tf.keras.Sequential([
+            tf.keras.Input(shape=(8, 8, 3)),
+            tf.keras.layers.GlobalAveragePooling2D(),
+            tf.keras.layers.Dense(7, activation='softmax'),
+        ])
+        # Sin archivos .h5/.keras: solo interesa el camino de inferencia
+        self.backend = KerasBackend.__new__(KerasBackend)
+        self.backend.model = self.model
+        self.backend.input_shape = tuple(self.model.input_shape)
+        self.backend.serving_function = None
+
+    def test_traced_function_matches_model_predict_for_any_batch_size(self):
+        self.backend._prepare_serving_function()
+        self.assertIsNotNone(self.backend.serving_function)
+        for batch_size in (1, 3):
+            batch = np.random.default_rng(batch_size).random((batch_size, 8, 8, 3), dtype=np.float32)
+            np.testing.assert_allclose(self.backend.predict(batch), self.model.predict(batch, verbose=0), rtol=1e-5, atol=1e-6)
+
+    def test_falls_back_to_model_predict_without_serving_function(self):
+        batch = np.ones((2, 8, 8, 3), dtype=np.float32)
+        self.assertEqual(self.backend.predict(batch).shape, (2, 7))
+
+
+class FakeInt8Interpreter:
+    """Intérprete TFLite stub con entrada y salida int8: devuelve los dos primeros valores cuantizados de cada imagen."""
+
+    def __init__(self):
+        self.input_shape = [1, 2, 2, 1]
+        self.resizes = []
+        self.received = None
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.input_shape), 'dtype': np.int8, 'quantization': (0.5, 10)}]
+
+    def get_output_details(self):
+        return [{'index': 1, 'dtype': np.int8, 'quantization': (0.25, -2)}]
+
+    def resize_tensor_input(self, index, shape):
+        self.input_shape = list(shape)
+        self.resizes.append(list(shape))
+
+    def allocate_tensors(self):
+        pass
+
+    def set_tensor(self, index, tensor):
+        self.received = tensor
+
+    def invoke(self):
+        pass
+
+    def get_tensor(self, index):
+        return self.received.reshape(len(self.received), -1)[:, :2]
+
+
+class InferenceBackendTests(TestCase):
+
+    def _int8_backend(self):
+        backend = TFLiteBackend.__new__(TFLiteBackend) # Sin archivo .tflite: el intérprete es el stub
+        backend._interpreter = FakeInt8Interpreter()
+        backend._lock = threading.Lock()
+        backend._allocated_batch_size = 1
+        return backend
+
+    def test_int8_model_quantizes_inputs_and_dequantizes_outputs(self):
+        backend = self._int8_backend()
+        batch = np.array([[[[1.0], [2.0]], [[0.0], [0.0]]]], dtype=np.float32)
+
+        output = backend.predict(batch)
+        self.assertEqual(backend._interpreter.received.dtype, np.int8)
+        self.assertEqual(backend._interpreter.received.reshape(-1).tolist(), [12, 14, 10, 10]) # round(x / 0.5 + 10)
+        np.testing.assert_allclose(output, [[3.5, 4.0]]) # (q + 2) * 0.25
+        self.assertEqual(output.dtype, np.float32)
+
+    def test_interpreter_is_resized_only_when_the_batch_size_changes(self):
+        backend = self._int8_backend()
+        backend.predict(np.zeros((3, 2, 2, 1), dtype=np.float32))
+        backend.predict(np.zeros((3, 2, 2, 1), dtype=np.float32))
+        self.assertEqual(backend._interpreter.resizes, [[3, 2, 2, 1]])
+
+    def test_unknown_backend_and_missing_converted_model_fail_clearly(self):
+        with self.assertRaises(ValueError):
+            load_backend('pytorch')
+        with override_settings(CNN_BACKEND_MODEL_PATH='/no/existe/modelo.onnx'):
+            with self.assertRaises(FileNotFoundError): # Antes de importar onnxruntime
+                load_backend('onnx')
+
+
+class CNNModelServerTests(TestCase):
+
+    def setUp(self):
+        socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, socket_dir, ignore_errors=True)
+        socket_path = os.path.join(socket_dir, 'cnn.sock')
+        self.backend = FakeCNNBackend()
+        # Lo mismo que serve_forever, pero con un servidor que el test puede apagar
+        # Cliente y servidor en el mismo proceso comparten resource_tracker: el unregister del servidor es para otro proceso
+        tracker_patch = mock.patch.object(cnn_model_server, 'resource_tracker')
+        tracker_patch.start()
+        self.addCleanup(tracker_patch.stop)
+        server = _ThreadingUnixStreamServer(socket_path, _RequestHandler)
+        server.model_server = CNNModelServer(socket_path, backend=self.backend, max_batch_size=4, max_wait_ms=1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server_client = CNNModelServerClient(socket_path, timeout=5)
+
+    def test_predictions_travel_through_shared_memory(self):
+        batch = np.stack([np.full((224, 224, 3), 255.0), np.zeros((224, 224, 3))]).astype(np.float32)
+
+        predictions = self.server_client.predict(batch)
+        np.testing.assert_allclose(predictions, self.backend.predict(batch))
+        self.assertEqual(predictions.argmax(axis=1).tolist(), [1, 0])
+
+    def test_info_and_errors(self):
+        info = self.server_client.get_info()
+        self.assertEqual((info['backend'], info['model_version'], info['input_shape']), ('fake', 'f' * 32, [None, 224, 224, 3]))
+        with self.assertRaises(CNNModelServerError):
+            self.server_client._request({"op": "reiniciar"})
+
+
+class ModelLifecycleTests(TestCase):
+
+    def test_background_load_warms_up_the_cnn_and_reports_partial_failures(self):
+        lifecycle = ModelLifecycle()
+        cnn_processor = mock.Mock(model_cnn=object(), model_server_client=None)
+        cnn_processor.warm_up.return_value = 12.5
+        with mock.patch.object(DermaBotAgent, 'get_instance', side_effect=ValueError("OPENAI_API_KEY no está configurada.")), \
+                mock.patch.object(CNNProcessor, 'get_instance', return_value=cnn_processor):
+            self.assertTrue(lifecycle.wait_until_loaded(timeout=5))
+
+        status = lifecycle.status()
+        self.assertEqual((status['state'], status['ready'], status['cnn_loaded'], status['agent_loaded']), (ModelLifecycle.FAILED, False, True, False))
+        self.assertEqual(status['warmup_ms'], 12.5)
+        self.assertIn('agent', status['errors'])
+        lifecycle.start_background_load() # Solo la primera vez
+        cnn_processor.warm_up.assert_called_once()
+
+    def test_readiness_endpoint_answers_503_until_models_are_loaded(self):
+        lifecycle = ModelLifecycle()
+        lifecycle.state = ModelLifecycle.LOADING # Carga en curso: no se lanza otra
+        with mock.patch('chatbot.views.model_lifecycle', lifecycle):
+            loading_response = self.client.get('/dermabot/health/ready')
+            lifecycle.use_models(derma_agent=object(), cnn_processor=object())
+            ready_response = self.client.get('/dermabot/health/ready')
+
+        self.assertEqual(loading_response.status_code, 503)
+        self.assertEqual(loading_response.json()['state'], ModelLifecycle.LOADING)
+        self.assertEqual(ready_response.status_code, 200)
+
+    def test_models_are_preloaded_by_the_server_entry_points_only(self):
+        with mock.patch.object(model_lifecycle, 'start_background_load') as start_background_load:
+            apps.get_app_config('chatbot').ready() # django.setup() de cualquier comando o script
+            start_background_load.assert_not_called()
+
+            with override_settings(DERMABOT_PRELOAD_MODELS=True):
+                for module_name in ('config.wsgi', 'config.asgi'):
+                    sys.modules.pop(module_name, None)
+                    importlib.import_module(module_name)
+            self.assertEqual(start_background_load.call_count, 2)
+
+            with override_settings(DERMABOT_PRELOAD_MODELS=False):
+                sys.modules.pop('config.wsgi', None)
+                importlib.import_module('config.wsgi')
+            self.assertEqual(start_background_load.call_count, 2)
+
+class DeseaseIndexTests(TestCase):
+
+    def setUp(self):
+        self.melanoma = Desease.objects.create(name_desease='Melanoma', short_description_for_llm='Lunar irregular.', cnn_prediction_index=0)
+        Desease.objects.create(name_desease='Nevus', short_description_for_llm='Lunar común.', cnn_prediction_index=1)
+        self.index = DeseaseIndex()
+
+    def test_lookups_after_the_first_do_not_query_the_db(self):
+        self.assertEqual(self.index.get(0), self.melanoma)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.index.get(np.int64(1)).name_desease, 'Nevus')
+            self.assertIsNone(self.index.get(5))
+            self.assertEqual(list(self.index.probabilities_by_name([0.2, 0.7, 0.1])), ['Nevus', 'Melanoma', 'Clase 2 (sin Desease asociada)'])
+
+    def test_saving_a_desease_rebuilds_the_index(self):
+        self.index.get(0)
+        self.melanoma.name_desease = 'Melanoma maligno'
+        self.melanoma.save() # post_save avanza el sello de versión
+        self.assertEqual(self.index.get(0).name_desease, 'Melanoma maligno')
+
+    @override_settings(DESEASE_INDEX_TTL_SECONDS=60)
+    def test_ttl_picks_up_changes_that_did_not_bump_the_version(self):
+        self.index.get(0)
+        Desease.objects.filter(id=self.melanoma.id).update(name_desease='Melanoma maligno') # Sin señales: como otro proceso
+        self.assertEqual(self.index.get(0).name_desease, 'Melanoma')
+        self.index._built_at -= 61
+        self.assertEqual(self.index.get(0).name_desease, 'Melanoma maligno')
+
+    def test_invalidate_between_the_check_and_the_lookup_does_not_break_readers(self):
+        self.index.get(0)
+        fresh_check = self.index._is_stale
+
+        def check_then_invalidate(mapping, version):
+            stale = fresh_check(mapping, version)
+            self.index._by_index = None # invalidate() desde el post_save de otro hilo, justo después del chequeo
+            return stale
+
+        with mock.patch.object(self.index, '_is_stale', check_then_invalidate):
+            self.assertEqual(self.index.get(0), self.melanoma)
+            self.assertEqual(list(self.index.probabilities_by_name([0.2, 0.8])), ['Nevus', 'Melanoma'])
+
+
+@override_settings(CNN_BATCHING_ENABLED=False)
+class BenchmarkCNNCommandTests(FakeCNNMixin, TestCase):
+
+    def test_report_has_per_batch_size_percentiles(self):
+        output_path = os.path.join(self.media_root, 'benchmark.json')
+        call_command(
+            'benchmark_cnn', batch_sizes=[1, 4], iterations=3, warmup=1, sample_dir=None,
+            synthetic_images=2, synthetic_size=[320, 240], output=output_path, stdout=StringIO(), stderr=StringIO(),
+        )
+
+        with open(output_path, encoding='utf-8') as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report['environment']['backend'], 'fake')
+        self.assertEqual(report['decode']['synthetic']['n'], 2)
+        self.assertEqual(sorted(report['inference']), ['1', '4'])
+        for summary in report['inference'].values():
+            self.assertEqual(summary['n'], 3)
+            self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+        # Arranque en frío + (1 calentamiento + 3 mediciones) por tamaño de lote
+        self.assertEqual(self.cnn_backend.batch_sizes, [1] + [1] * 4 + [4] * 4)
+
+
+@override_settings(CNN_BATCHING_ENABLED=False)
+class UploadPipelineTests(FakeCNNMixin, TestCase):
+
+    def _form(self, *image_contents):
+        uploads = [SimpleUploadedFile(f'lesion{number}.jpg', content, content_type='image/jpeg') for number, content in enumerate(image_contents)]
+        return MessageForm(data={'user_input': ''}, files=MultiValueDict({'image_upload': uploads}))
+
+    def test_jpeg_is_decoded_close_to_model_size_but_never_below(self):
+        image = decode_for_model(jpeg_bytes((200, 120, 90), size=(1600, 1200)))
+        self.assertEqual(image.mode, 'RGB')
+        self.assertGreaterEqual(image.width, MODEL_INPUT_SIZE[0])
+        self.assertGreaterEqual(image.height, MODEL_INPUT_SIZE[1])
+        self.assertLess(image.width, 1600 // 2)
+
+    def test_cnn_reuses_the_image_decoded_by_form_validation(self):
+        form = self._form(jpeg_bytes((255, 255, 255), size=(1600, 1200)))
+        self.assertTrue(form.is_valid(), form.errors)
+        uploads = form.cleaned_data['image_upload']
+        self.assertIsNotNone(uploads[0].model_input_image)
+
+        with mock.patch('chatbot.services.cnn_service.decode_for_model') as second_decode:
+            desease, _, _ = CNNProcessor.get_instance().predict_from_image_files(uploads)
+        second_decode.assert_not_called()
+        self.assertEqual(desease.name_desease, 'Nevus')
+
+    @override_settings(CHATBOT_MAX_IMAGE_PIXELS=100_000)
+    def test_pixel_cap_is_checked_from_the_header(self):
+        form = self._form(jpeg_bytes((0, 0, 0), size=(400, 300)))
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['image_upload'][0].code, 'image_too_large')
+
+    def test_non_image_upload_is_rejected(self):
+        form = self._form(b'esto no es una imagen')
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors.as_data()['image_upload'][0].code, 'invalid_image')
+
+
+class FailingSummaryModel:
+
+    def invoke(self, messages):
+        raise TimeoutError("El proveedor no respondió a tiempo")
+
+
+class HistoryCompactionTests(TestCase):
+
+    def _context_manager(self, summary_model, history_token_budget=120):
+        return ConversationContextManager(summary_model, model_name="gpt-4o-mini", history_token_budget=history_token_budget, summary_max_tokens=50)
+
+    @staticmethod
+    def _turns(count):
+        messages = []
+        for number in range(count):
+            messages.append(HumanMessage(content=f"Turno {number}: tengo manchas rojas que pican en el brazo desde hace días", id=f"h{number}"))
+            messages.append(AIMessage(content=f"Respuesta {number}: ¿las manchas tienen escamas o relieve?", id=f"a{number}"))
+        return messages
+
+    def test_history_under_budget_is_sent_untouched(self):
+        summary_model = StructuredSummaryModel(AIMessage(content="resumen"))
+        messages = self._turns(1)
+        self.assertEqual(self._context_manager(summary_model).compact(messages, ""), (messages, "", []))
+        self.assertEqual(summary_model.calls, [])
+
+    def test_old_turns_fold_into_the_rolling_summary(self):
+        summary_model = StructuredSummaryModel(AIMessage(content="Manchas rojas que pican en el brazo."))
+        context_manager = self._context_manager(summary_model)
+        messages = self._turns(6)
+
+        recent, summary, removed = context_manager.compact(messages, "Resumen previo: consulta por el brazo.")
+        self.assertEqual(summary, "Manchas rojas que pican en el brazo.")
+        self.assertEqual(removed + recent, messages)
+        self.assertIsInstance(recent[0], HumanMessage) # Lo reciente arranca en un turno del usuario
+        self.assertLessEqual(context_manager.count_messages(recent), context_manager.history_token_budget // 2)
+        self.assertIn("Resumen previo: consulta por el brazo.", summary_model.calls[0][1].content)
+        self.assertIn("Turno 0", summary_model.calls[0][1].content)
+
+    def test_failed_summary_sends_the_full_history(self):
+        messages = self._turns(6)
+        self.assertEqual(self._context_manager(FailingSummaryModel()).compact(messages, "previo"), (messages, "previo", []))
+
+
+class StreamingAgent:
+    """Agente stub para ChatStreamView: entrega la respuesta en fragmentos y cuenta cuántos se generaron."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.generated = 0
+
+    def stream_response(self, user_input, conversation_id, user_identifier="Usuario Anónimo", telemetry_ids=None):
+        for chunk in self.chunks:
+            self.generated += 1
+            yield "token", chunk
+        yield "done", "".join(self.chunks)
+
+    async def astream_response(self, user_input, conversation_id, user_identifier="Usuario Anónimo", telemetry_ids=None):
+        for event in self.stream_response(user_input, conversation_id, user_identifier, telemetry_ids):
+            yield event
+
+
+@override_settings(CHATBOT_BACKGROUND_JOBS=False, CHATBOT_SESSION_TURNS_PER_MINUTE=0)
+class ChatStreamViewTests(TestCase):
+
+    def setUp(self):
+        saved_models = (model_lifecycle.state, model_lifecycle.derma_agent, model_lifecycle.cnn_processor)
+        self.addCleanup(lambda: setattr(model_lifecycle, 'state', saved_models[0]))
+        self.addCleanup(model_lifecycle.use_models, saved_models[1], saved_models[2])
+        self.agent = StreamingAgent(["¿Desde cuándo ", "tienes ", "las manchas?"])
+        model_lifecycle.use_models(derma_agent=self.agent, cnn_processor=None)
+        self.conversation = Conversation.objects.create()
+
+    def _post(self, data):
+        return self.client.post(f'/dermabot/session/{self.conversation.id}/stream/', data)
+
+    def test_tokens_arrive_as_events_and_the_reply_is_saved(self):
+        response = self._post({'user_input': 'Tengo manchas rojas'})
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+        events = [
+            (block.split('\n')[0].removeprefix('event: '), json.loads(block.split('\n')[1].removeprefix('data: ')))
+            for block in b''.join(response.streaming_content).decode('utf-8').strip().split('\n\n')
+        ]
+        self.assertEqual(events, [
+            ('token', {'text': '¿Desde cuándo '}),
+            ('token', {'text': 'tienes '}),
+            ('token', {'text': 'las manchas?'}),
+            ('done', {'content': '¿Desde cuándo tienes las manchas?'}),
+        ])
+        self.assertEqual(
+            list(Message.objects.filter(conversation=self.conversation).order_by('timestamp').values_list('is_bot', 'content')),
+            [(False, 'Tengo manchas rojas'), (True, '¿Desde cuándo tienes las manchas?')],
+        )
+
+    def test_reply_is_saved_even_if_the_browser_disconnects(self):
+        response = self._post({'user_input': 'Tengo manchas rojas'})
+        next(iter(response.streaming_content)) # Primer token y el navegador se va
+        response.close()
+
+        self.assertEqual(self.agent.generated, 3) # La generación terminó igual
+        self.assertTrue(Message.objects.filter(conversation=self.conversation, is_bot=True, content='¿Desde cuándo tienes las manchas?').exists())
+
+    def test_invalid_form_returns_json_errors(self):
+        response = self._post({'user_input': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('__all__', response.json()['errors'])
+        self.assertFalse(Message.objects.exists())
+
+    async def test_async_stream_sends_the_same_events_without_a_worker_thread(self):
+        response = await self.async_client.post(f'/dermabot/session/{self.conversation.id}/stream/async/', {'user_input': 'Tengo manchas rojas'})
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode('utf-8')
+        self.assertEqual([block.split('\n')[0] for block in body.strip().split('\n\n')], ['event: token'] * 3 + ['event: done'])
+        saved = [(message.is_bot, message.content) async for message in Message.objects.filter(conversation=self.conversation).order_by('timestamp')]
+        self.assertEqual(saved, [(False, 'Tengo manchas rojas'), (True, '¿Desde cuándo tienes las manchas?')])
+
+    def test_chat_page_streams_through_the_async_view_when_enabled(self):
+        stream_url = f'/dermabot/session/{self.conversation.id}/stream/'
+        with override_settings(CHATBOT_ASYNC_VIEWS=False):
+            self.assertContains(self.client.get(f'/dermabot/session/{self.conversation.id}/'), f'data-stream-url="{stream_url}"')
+        with override_settings(CHATBOT_ASYNC_VIEWS=True):
+            self.assertContains(self.client.get(f'/dermabot/session/{self.conversation.id}/'), f'data-stream-url="{stream_url}async/"')
+
+
+class HiddenSummaryStreamFilterTests(TestCase):
+
+    def test_block_split_across_chunks_never_reaches_the_client(self):
+        stream_filter = HiddenSummaryStreamFilter()
+        chunks = ["Podría ser psoriasis. ###INICIO_RES", "UMEN_MEDICO### Queja: manchas ###FIN_", "RESUMEN_MEDICO### Consulta a un dermatólogo."]
+        visible = "".join(stream_filter.feed(chunk) for chunk in chunks) + stream_filter.flush()
+        self.assertEqual(visible, "Podría ser psoriasis.  Consulta a un dermatólogo.")
+
+
+class AsyncRecordingAgent(RecordingAgent):
+
+    async def aget_response(self, user_input, conversation_id, user_identifier="Usuario Anónimo", telemetry_ids=None):
+        return self.get_response(user_input, conversation_id, user_identifier)
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHATBOT_RESPONSE_CACHE_ENABLED=False, CHATBOT_BACKGROUND_JOBS=False, CHATBOT_SESSION_TURNS_PER_MINUTE=0)
+class AsyncChatPathTests(TestCase):
+
+    def setUp(self):
+        saved_models = (model_lifecycle.state, model_lifecycle.derma_agent, model_lifecycle.cnn_processor)
+        self.addCleanup(lambda: setattr(model_lifecycle, 'state', saved_models[0]))
+        self.addCleanup(model_lifecycle.use_models, saved_models[1], saved_models[2])
+        self.conversation = Conversation.objects.create()
+
+    async def test_async_view_saves_both_messages_and_redirects(self):
+        agent = AsyncRecordingAgent()
+        model_lifecycle.use_models(derma_agent=agent, cnn_processor=None)
+
+        response = await self.async_client.post(f'/dermabot/session/{self.conversation.id}/async/', {'user_input': 'Tengo granos en la cara'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(agent.inputs, ['Tengo granos en la cara'])
+        saved = [(message.is_bot, message.content) async for message in Message.objects.filter(conversation=self.conversation).order_by('timestamp')]
+        self.assertEqual(saved, [(False, 'Tengo granos en la cara'), (True, "Entendido. ¿Desde cuándo tienes la lesión?")])
+
+    async def test_aget_response_runs_the_graph_with_ainvoke(self):
+        await Desease.objects.acreate(name_desease='Acné', short_description_for_llm='Granos, espinillas. Cara/pecho/espalda.', cnn_prediction_index=0)
+        agent = await sync_to_async(DermaBotAgent)()
+        agent.model = RecordingChatModel(reply_text="¿Desde cuándo tienes los granos?")
+        telemetry_ids = []
+
+        reply = await agent.aget_response("Tengo granos en la cara", str(self.conversation.id), 'Usuario_ana', telemetry_ids=telemetry_ids)
+
+        self.assertEqual(reply, "¿Desde cuándo tienes los granos?")
+        telemetry = await LLMTurnTelemetry.objects.aget(id=telemetry_ids[0])
+        self.assertEqual(telemetry.call_mode, LLMTurnTelemetry.MODE_ASYNC)
+
+    async def test_astream_response_streams_the_reply_through_the_graph(self):
+        await Desease.objects.acreate(name_desease='Acné', short_description_for_llm='Granos, espinillas. Cara/pecho/espalda.', cnn_prediction_index=0)
+        agent = await sync_to_async(DermaBotAgent)()
+        agent.model = RecordingChatModel(reply_text="¿Desde cuándo tienes los granos?")
+        telemetry_ids = []
+
+        events = [event async for event in agent.astream_response("Tengo granos en la cara", str(self.conversation.id), 'Usuario_ana', telemetry_ids=telemetry_ids)]
+
+        self.assertEqual(events[-1], ("done", "¿Desde cuándo tienes los granos?"))
+        self.assertEqual("".join(text for event, text in events[:-1]), "¿Desde cuándo tienes los granos?")
+        telemetry = await LLMTurnTelemetry.objects.aget(id=telemetry_ids[0])
+        self.assertEqual(telemetry.call_mode, LLMTurnTelemetry.MODE_STREAM)
+        self.assertEqual(admission.get_llm_limiter().get_metrics()['in_flight'], 0)
+
+
+class FlakyAgent(RecordingAgent):
+    """Falla los primeros `failures` turnos (como una API del LLM caída) y después responde."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def get_response(self, user_input, conversation_id, user_identifier="Usuario Anónimo", telemetry_ids=None):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("API del LLM no disponible")
+        return super().get_response(user_input, conversation_id, user_identifier, telemetry_ids)
+
+
+@override_settings(CHATBOT_JOB_MAX_ATTEMPTS=2)
+class ChatJobWorkerTests(TransactionTestCase):
+    # TransactionTestCase: process() cierra las conexiones viejas al terminar cada trabajo
+
+    def setUp(self):
+        saved_models = (model_lifecycle.state, model_lifecycle.derma_agent, model_lifecycle.cnn_processor)
+        self.addCleanup(lambda: setattr(model_lifecycle, 'state', saved_models[0]))
+        self.addCleanup(model_lifecycle.use_models, saved_models[1], saved_models[2])
+        self.conversation = Conversation.objects.create()
+
+    def _enqueue(self, content):
+        user_message = Message.objects.create(conversation=self.conversation, content=content, is_bot=False)
+        return enqueue_chat_turn(self.conversation, user_message, 'Usuario_ana')
+
+    def _worker(self):
+        return ChatJobWorker(worker_id='worker-test', concurrency=2, retry_backoff_seconds=0, poll_interval_seconds=0.01)
+
+    def _drain(self, worker):
+        # Lo mismo que run(until_empty=True) pero en este hilo: la BD de pruebas en memoria de SQLite
+        # bloquea la tabla entera y las escrituras concurrentes del pool fallan al azar
+        while (job := worker.claim_next()) is not None:
+            worker.process(job)
+
+    def test_worker_completes_turns_of_a_conversation_in_order(self):
+        agent = RecordingAgent()
+        model_lifecycle.use_models(derma_agent=agent, cnn_processor=None)
+        first_job = self._enqueue("Tengo granos")
+        second_job = self._enqueue("Desde hace un mes")
+        self.assertEqual(first_job.bot_message.content, PENDING_BOT_MESSAGE)
+
+        worker = self._worker()
+        self.assertEqual(worker.claim_next().id, first_job.id) # El segundo turno espera al primero aunque haya lugar
+        self.assertIsNone(worker.claim_next())
+        ChatJob.objects.filter(id=first_job.id).update(status=ChatJob.STATUS_PENDING, attempts=0, locked_by='')
+        self._drain(worker)
+
+        self.assertEqual(agent.inputs, ["Tengo granos", "Desde hace un mes"])
+        self.assertEqual(set(ChatJob.objects.values_list('status', flat=True)), {ChatJob.STATUS_DONE})
+        second_job.bot_message.refresh_from_db()
+        self.assertEqual(second_job.bot_message.content, "Entendido. ¿Desde cuándo tienes la lesión?")
+
+    def test_transient_error_is_retried_until_max_attempts(self):
+        model_lifecycle.use_models(derma_agent=FlakyAgent(failures=1), cnn_processor=None)
+        recovered_job = self._enqueue("Tengo granos")
+        worker = self._worker()
+        self._drain(worker)
+
+        recovered_job.refresh_from_db()
+        self.assertEqual((recovered_job.status, recovered_job.attempts), (ChatJob.STATUS_DONE, 2))
+        self.assertEqual(worker.get_metrics()['retried'], 1)
+
+        model_lifecycle.use_models(derma_agent=FlakyAgent(failures=2), cnn_processor=None)
+        failed_job = self._enqueue("Me pica")
+        self._drain(worker)
+
+        failed_job.refresh_from_db()
+        failed_job.bot_message.refresh_from_db()
+        self.assertEqual((failed_job.status, failed_job.attempts), (ChatJob.STATUS_FAILED, 2))
+        self.assertEqual(failed_job.bot_message.content, FAILED_BOT_MESSAGE)
+        self.assertEqual({key: worker.get_metrics()[key] for key in ('done', 'retried', 'failed')}, {'done': 1, 'retried': 2, 'failed': 1})
+
+    def test_status_view_hides_content_until_the_job_finishes(self):
+        job = self._enqueue("Tengo granos")
+        url = f'/dermabot/session/{self.conversation.id}/jobs/{job.id}/'
+
+        pending = self.client.get(url).json()
+        self.assertEqual((pending['status'], pending['content']), (ChatJob.STATUS_PENDING, None))
+
+        model_lifecycle.use_models(derma_agent=RecordingAgent(), cnn_processor=None)
+        self._drain(self._worker())
+        done = self.client.get(url).json()
+        self.assertEqual((done['status'], done['attempts']), (ChatJob.STATUS_DONE, 1))
+        self.assertEqual(done['content'], "Entendido. ¿Desde cuándo tienes la lesión?")
+        self.assertEqual(self.client.get(f'/dermabot/session/{Conversation.objects.create().id}/jobs/{job.id}/').status_code, 404)
+
+
+class GeneralQuestionCacheTests(TestCase):
+
+    def test_exact_and_similar_questions_hit_personal_ones_are_not_eligible(self):
+        cache = GeneralQuestionCache()
+        question = cache.eligible_question("¿Qué es el ACNÉ?")
+        self.assertEqual(question, "que es el acne")
+        self.assertIsNone(cache.eligible_question("¿Qué es esto que tengo en el brazo?"))
+        self.assertEqual(cache.lookup(question), (None, 0.0))
+
+        cache.store(question, "El acné es una afección de los folículos pilosos.")
+        self.assertEqual(cache.lookup(question), ("El acné es una afección de los folículos pilosos.", 1.0))
+        answer, similarity = cache.lookup(cache.eligible_question("que es la acne"))
+        self.assertEqual(answer, "El acné es una afección de los folículos pilosos.")
+        self.assertGreaterEqual(similarity, cache.similarity_threshold)
+        self.assertEqual(cache.lookup(cache.eligible_question("¿Cómo se trata la psoriasis?"))[0], None)
+
+        metrics = cache.get_metrics()
+        self.assertEqual((metrics['lookups'], metrics['hits'], metrics['similar_hits']), (4, 2, 1))
+
+    def test_entries_expire_are_bounded_and_flushed_on_new_prompt_version(self):
+        cache = GeneralQuestionCache(ttl_seconds=60, max_entries=2)
+        with mock.patch.object(response_cache.time, 'monotonic', return_value=1000.0):
+            cache.store("que es el acne", "Acné...", version=1)
+            cache.store("que es la psoriasis", "Psoriasis...", version=1)
+            cache.lookup("que es el acne", version=1) # El acné pasa a ser el más reciente
+            cache.store("que es el melanoma", "Melanoma...", version=1)
+        self.assertEqual(list(cache._entries), ["que es el acne", "que es el melanoma"]) # Salió el menos usado
+
+        with mock.patch.object(response_cache.time, 'monotonic', return_value=1061.0):
+            self.assertEqual(cache.lookup("que es el acne", version=1)[0], None) # Venció el TTL
+        self.assertEqual(cache.get_metrics()['evictions'], 3)
+
+        cache.store("que es el acne", "Acné...", version=1)
+        self.assertEqual(cache.lookup("que es el acne", version=2)[0], None) # Cambió la lista de enfermedades
+        self.assertEqual(cache.get_metrics()['entries'], 0)
+
+
+@override_settings(OPENAI_API_KEY='sk-test', CHATBOT_RESPONSE_CACHE_ENABLED=True, CHATBOT_TRIVIAL_TURNS_ENABLED=False)
+class ResponseCacheAgentTests(TestCase):
+
+    def setUp(self):
+        Desease.objects.create(name_desease='Psoriasis', short_description_for_llm='Placas rojas con escamas. Codos/rodillas.', cnn_prediction_index=0)
+        self.agent = DermaBotAgent()
+        self.chat_model = RecordingChatModel(reply_text="La psoriasis es una enfermedad inflamatoria crónica de la piel.")
+        self.agent.model = self.chat_model
+
+    def _first_turn(self, user_input):
+        return self.agent.get_response(user_input, str(Conversation.objects.create().id), 'Usuario_ana')
+
+    def test_general_first_turn_question_is_answered_from_cache_in_another_conversation(self):
+        self.assertEqual(self._first_turn("¿Qué es la psoriasis?"), self.chat_model.reply_text)
+        self.assertEqual(self._first_turn("que es psoriasis"), self.chat_model.reply_text)
+        self.assertEqual(len(self.chat_model.calls), 1)
+
+        self._first_turn("¿Tengo psoriasis en el codo?") # Problema personal: siempre va al LLM
+        self.assertEqual(len(self.chat_model.calls), 2)
+        metrics = self.agent.response_cache.get_metrics()
+        self.assertEqual((metrics['hits'], metrics['bypassed']), (1, 1))
+
+    def test_cached_answer_stays_in_thread_memory_and_later_turns_skip_the_cache(self):
+        self._first_turn("¿Qué es la psoriasis?")
+        thread_id = str(Conversation.objects.create().id)
+        self.agent.get_response("¿Qué es la psoriasis?", thread_id, 'Usuario_ana')
+        self.agent.get_response("¿Qué es la psoriasis?", thread_id, 'Usuario_ana')
+
+        self.assertEqual(len(self.chat_model.calls), 2) # El segundo turno depende de la conversación
+        self.assertEqual(
+            [message.content for message in self.chat_model.calls[-1][1:]],
+            ["¿Qué es la psoriasis?", self.chat_model.reply_text, "¿Qué es la psoriasis?"],
+        )
+
+
+class ScriptedHTTPTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """Reemplaza al transporte de httpx: cada intento toma el siguiente resultado (excepción o (estado, cuerpo, demora))."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _next(self, request):
+        with self._lock:
+            self.requests.append(request)
+            return self.outcomes.pop(0)
+
+    def handle_request(self, request):
+        outcome = self._next(request)
+        if isinstance(outcome, Exception):
+            raise outcome
+        status_code, body, delay_seconds = outcome
+        time.sleep(delay_seconds)
+        return httpx.Response(status_code, content=body)
+
+    async def handle_async_request(self, request):
+        outcome = self._next(request)
+        if isinstance(outcome, Exception):
+            raise outcome
+        status_code, body, delay_seconds = outcome
+        return httpx.Response(status_code, content=body)
+
+
+class LLMTransportTests(TestCase):
+    URL = 'http://llm.test/v1/chat/completions'
+
+    def _client(self, outcomes, **policy_options):
+        policy = llm_transport.LLMTransportPolicy(retry_backoff_seconds=0, **policy_options)
+        transport = llm_transport.ResilientTransport(policy, httpx.Limits(max_connections=4))
+        transport._transport = ScriptedHTTPTransport(outcomes)
+        client = httpx.Client(transport=transport)
+        self.addCleanup(client.close)
+        return policy, client
+
+    def test_connection_errors_and_retryable_statuses_are_retried(self):
+        policy, client = self._client([httpx.ConnectError("caído"), (503, b'ocupado', 0), (200, b'ok', 0)])
+
+        response = client.post(self.URL, json={'model': 'gpt-4o-mini'})
+
+        self.assertEqual((response.status_code, response.content), (200, b'ok'))
+        metrics = policy.get_metrics()
+        self.assertEqual((metrics['calls'], metrics['attempts'], metrics['retries'], metrics['failures']), (1, 3, 2, 0))
+        self.assertIsNotNone(metrics['latency_p50_s'])
+
+    def test_gives_up_after_max_retries(self):
+        policy, client = self._client([(503, b'ocupado', 0)] * 2 + [httpx.ConnectError("caído")] * 2, max_retries=1)
+
+        self.assertEqual(client.post(self.URL, json={}).status_code, 503) # El último intento devuelve el estado a la librería
+        with self.assertRaises(httpx.ConnectError):
+            client.post(self.URL, json={})
+        self.assertEqual(client._transport._transport.outcomes, [])
+        metrics = policy.get_metrics()
+        self.assertEqual((metrics['attempts'], metrics['retries'], metrics['failures']), (4, 2, 1))
+
+    def test_slow_request_is_hedged_and_the_faster_reply_wins(self):
+        policy, client = self._client([(200, b'lenta', 0.5), (200, b'rapida', 0)], hedging_enabled=True, hedge_min_samples=1)
+        policy.record_latency(0.01) # p95 observado: 10 ms
+
+        response = client.post(self.URL, json={'model': 'gpt-4o-mini'})
+
+        self.assertEqual(response.content, b'rapida')
+        metrics = policy.get_metrics()
+        self.assertEqual((metrics['hedges'], metrics['hedge_wins'], metrics['attempts']), (1, 1, 2))
+
+    def test_streaming_requests_are_never_hedged(self):
+        policy, client = self._client([(200, b'stream', 0.05)], hedging_enabled=True, hedge_min_samples=1)
+        policy.record_latency(0.01)
+
+        self.assertEqual(client.post(self.URL, json={'stream': True}).content, b'stream')
+        self.assertEqual(policy.get_metrics()['hedges'], 0)
+
+    async def test_async_transport_retries_with_the_same_policy(self):
+        policy = llm_transport.LLMTransportPolicy(retry_backoff_seconds=0)
+        transport = llm_transport.AsyncResilientTransport(policy, httpx.Limits(max_connections=4))
+        transport._transport = ScriptedHTTPTransport([(429, b'limite', 0), (200, b'ok', 0)])
+        async with httpx.AsyncClient(transport=transport) as client:
+            response = await client.post(self.URL, json={})
+
+        self.assertEqual(response.content, b'ok')
+        self.assertEqual((policy.get_metrics()['attempts'], policy.get_metrics()['retries']), (2, 1))
+
+
+class InvertedCNNBackend(FakeCNNBackend):
+    """Conversión rota: predice la clase contraria a la de Keras."""
+
+    def predict(self, batch_array):
+        return super().predict(batch_array)[:, [1, 0, 2, 3, 4, 5, 6]]
+
+
+class ConvertCNNModelCommandTests(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.sample_dir = os.path.join(self.work_dir, 'muestras')
+        os.makedirs(self.sample_dir)
+        for name, color in (('clara.jpg', (255, 255, 255)), ('oscura.jpg', (0, 0, 0))):
+            with open(os.path.join(self.sample_dir, name), 'wb') as sample_file:
+                sample_file.write(jpeg_bytes(color))
+        self.serving_path = os.path.join(self.work_dir, 'modelo.tflite')
+        with open(self.serving_path, 'wb') as serving_file:
+            serving_file.write(b'modelo en servicio')
+
+        keras_backend = FakeCNNBackend()
+        keras_backend.model = None
+        for target, replacement in (
+            ('KerasBackend', lambda use_serving_function: keras_backend),
+            ('converted_model_path', lambda backend_name, quantized=False: self.serving_path),
+        ):
+            patcher = mock.patch.object(convert_cnn_model, target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _convert(self, converted_backend_class):
+        def write_model(command, keras_model, output_path, quantize_int8, calibration_batch):
+            with open(output_path, 'wb') as output_file:
+                output_file.write(b'modelo convertido')
+
+        with mock.patch.object(convert_cnn_model.Command, '_convert_tflite', write_model), \
+                mock.patch.object(convert_cnn_model, 'TFLiteBackend', lambda path: converted_backend_class()):
+            call_command('convert_cnn_model', formats=['tflite'], sample_dir=self.sample_dir, stdout=StringIO())
+
+    def _serving_model(self):
+        with open(self.serving_path, 'rb') as serving_file:
+            return serving_file.read()
+
+    def test_failed_parity_leaves_the_serving_model_untouched(self):
+        with self.assertRaises(CommandError):
+            self._convert(InvertedCNNBackend)
+
+        self.assertEqual(self._serving_model(), b'modelo en servicio')
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['modelo.tflite', 'muestras']) # Sin restos de la conversión
+
+    def test_model_is_replaced_once_parity_passes(self):
+        self._convert(FakeCNNBackend)
+
+        self.assertEqual(self._serving_model(), b'modelo convertido')
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['modelo.tflite', 'muestras'])
+
+
+class LoadtestLLMTransportCommandTests(TestCase):
+
+    def test_policy_counters_exclude_the_warm_up_calls(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir, ignore_errors=True)
+        output_path = os.path.join(output_dir, 'transporte.json')
+        call_command(
+            'loadtest_llm_transport', calls=10, concurrency=2, llm_delay=0.0, slow_rate=0.0, error_rate=0.2,
+            modes=['pooled'], output=output_path, stdout=StringIO(),
+        )
+
+        with open(output_path, encoding='utf-8') as report_file:
+            (result,) = json.load(report_file)['results']
+        self.assertEqual(result['ok'], 10)
+        self.assertEqual(result['attempts'], result['llm_requests']) # Mismas peticiones que vio el stub
+        self.assertEqual(result['retries'], result['errors_injected'])
 
-# Create your tests here.
@@ -4,7 +4,8 @@ from .views import (
     ChatHomeView, ChatWindowView, StartNewChatSessionView,
     MedicalSummaryDetailView,
     MedicalSummaryPDFView, # Si tienes una vista separada para el PDF
-    ConversationHistoryListView )
+    ConversationHistoryListView, ReadinessView, ChatStreamView, AsyncChatWindowView, AsyncChatStreamView, ChatJobStatusView,
+    AdmissionMetricsView )
 
 app_name = 'chatbot'
 
@@ -12,6 +13,12 @@ urlpatterns = [
     path('', ChatHomeView.as_view(), name='chat_home'),
     path('new/', StartNewChatSessionView.as_view(), name='start_new_session'),
     path('session/<uuid:conversation_id>/', ChatWindowView.as_view(), name='chat_window'),
+    path('session/<uuid:conversation_id>/async/', AsyncChatWindowView.as_view(), name='chat_window_async'), # Para ASGI
+    path('session/<uuid:conversation_id>/stream/', ChatStreamView.as_view(), name='chat_stream'),
+    path('session/<uuid:conversation_id>/stream/async/', AsyncChatStreamView.as_view(), name='chat_stream_async'), # Para ASGI
+    path('session/<uuid:conversation_id>/jobs/<uuid:job_id>/', ChatJobStatusView.as_view(), name='chat_job_status'),
     path('summary/<uuid:summary_id_uuid>/', MedicalSummaryDetailView.as_view(), name='medical_summary_detail'),
     path('summary/<uuid:summary_id_uuid>/pdf/', MedicalSummaryPDFView.as_view(), name='medical_summary_pdf'), # URL para el PDF
-    path('historial/', ConversationHistoryListView.as_view(), name='conversation_history'),]
+    path('historial/', ConversationHistoryListView.as_view(), name='conversation_history'),
+    path('health/ready', ReadinessView.as_view(), name='health_ready'),
+    path('health/admission', AdmissionMetricsView.as_view(), name='health_admission'),]
@@ -1,32 +1,85 @@
 # chatbot/views.py
+import asyncio
+import json
+import math
+import time
 import uuid
-from django.shortcuts import render, redirect, get_object_or_404
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.views import View
-from django.http import HttpResponse, Http404 # Asegúrate que Http404 está importado
+from django.http import HttpResponse, Http404, JsonResponse, StreamingHttpResponse # Asegúrate que Http404 está importado
 from django.template.loader import get_template
 from django.core.paginator import Paginator
 from django.utils import timezone # Para el nombre del archivo PDF
 
-from .models import Conversation, Message, Desease, MedicalSummary
+from .models import Conversation, Message, MessageImage, Desease, MedicalSummary, ChatJob
 from .forms import MessageForm
 # ASEGÚRATE DE TENER LOS __init__.py EN LA CARPETA services
-from .services.openai_agent_service import DermaBotAgent
-from .services.cnn_service import CNNProcessor
+# Los servicios (DermaBotAgent y CNNProcessor, ambos Singleton) ya no se instancian al importar
+# este módulo: los carga model_lifecycle en segundo plano al arrancar el servidor (ver config/wsgi.py).
+from .services.model_lifecycle import model_lifecycle
+from .services.image_pipeline import StageTimer
+from .services import admission, llm_telemetry, turn_input
+from .services.admission import AdmissionRejected
+from .services.chat_jobs import enqueue_chat_turn
 
-# Instanciación de los servicios (Singleton pattern)
-try:
-    derma_agent_llm = DermaBotAgent.get_instance()
-except Exception as e:
-    print(f"!!!!!!!! ERROR CRÍTICO al instanciar DermaBotAgent: {e} !!!!!!!!")
-    derma_agent_llm = None # Manejar la ausencia del agente en las vistas
 
-try:
-    # Usar la instanciación normal si CNNProcessor no tiene get_instance()
-    # o cnn_image_processor = CNNProcessor.get_instance() si lo implementaste
-    cnn_image_processor = CNNProcessor() 
-except Exception as e:
-    print(f"!!!!!!!! ERROR CRÍTICO al instanciar CNNProcessor: {e} !!!!!!!!")
-    cnn_image_processor = None # Manejar la ausencia del procesador en las vistas
+def _save_message_images(message_obj, uploaded_images, per_image_results):
+    """Guarda una fila MessageImage por imagen con su predicción individual. Devuelve las filas."""
+    message_images = []
+    for position, (uploaded_image, (desease, confidence)) in enumerate(zip(uploaded_images, per_image_results)):
+        # La primera imagen ya la escribió message_obj.image: se reutiliza el archivo en vez de duplicarlo
+        image_value = message_obj.image.name if position == 0 and message_obj.image else uploaded_image
+        message_images.append(MessageImage.objects.create(
+            message=message_obj,
+            position=position,
+            image=image_value,
+            cnn_predicted_desease=desease,
+            cnn_confidence=confidence,
+        ))
+    return message_images
+
+
+async def _asave_message_images(message_obj, uploaded_images, per_image_results):
+    """Versión async de _save_message_images."""
+    message_images = []
+    for position, (uploaded_image, (desease, confidence)) in enumerate(zip(uploaded_images, per_image_results)):
+        image_value = message_obj.image.name if position == 0 and message_obj.image else uploaded_image
+        message_images.append(await MessageImage.objects.acreate(
+            message=message_obj,
+            position=position,
+            image=image_value,
+            cnn_predicted_desease=desease,
+            cnn_confidence=confidence,
+        ))
+    return message_images
+
+
+def _apply_cnn_predictions(message_obj, message_images, predicted_desease_obj, confidence_percent, per_image_results):
+    """Completa la predicción en el Message y sus MessageImage ya guardados (la CNN corrió en paralelo con el guardado)."""
+    message_obj.cnn_confidence = confidence_percent
+    message_obj.cnn_predicted_desease = predicted_desease_obj
+    message_obj.save(update_fields=['cnn_confidence', 'cnn_predicted_desease'])
+    for message_image, (desease, confidence) in zip(message_images, per_image_results):
+        message_image.cnn_predicted_desease = desease
+        message_image.cnn_confidence = confidence
+    MessageImage.objects.bulk_update(message_images, ['cnn_predicted_desease', 'cnn_confidence'])
+
+
+def _busy_response(message, retry_after_seconds, as_json=False):
+    """429 inmediato (sesión sin tokens o LLM/CNN saturados): no se guarda nada del turno."""
+    if as_json:
+        response = JsonResponse({'error': message}, status=429)
+    else:
+        response = HttpResponse(message, status=429, content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = str(max(1, math.ceil(retry_after_seconds)))
+    return response
+
+
+def _sse_event(event, data):
+    """Un evento Server-Sent Events con payload JSON."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
 class ChatHomeView(View):
@@ -64,7 +117,7 @@ class ChatWindowView(View):
         if request.session.get('chatbot_conversation_id') != str(conversation.id):
             request.session['chatbot_conversation_id'] = str(conversation.id)
 
-        messages = conversation.messages.all().order_by('timestamp')
+        messages = conversation.messages.select_related('cnn_predicted_desease', 'chat_job').prefetch_related('images__cnn_predicted_desease').order_by('timestamp')
         form = MessageForm()
         
         user_identifier = request.session.get('chatbot_user_nickname', f"Usuario_{str(conversation.id)[:8]}")
@@ -77,11 +130,69 @@ class ChatWindowView(View):
             'form': form,
             'user_identifier': user_identifier,
             'medical_summary_exists': medical_summary_exists,
-            'conversation_id_str': str(conversation.id) 
+            'conversation_id_str': str(conversation.id),
+            'use_async_chat': getattr(settings, 'CHATBOT_ASYNC_VIEWS', False), # El formulario postea a la vista async
+            'use_background_jobs': getattr(settings, 'CHATBOT_BACKGROUND_JOBS', False),
         }
         return render(request, self.template_name, context)
 
+    def _prepare_user_turn(self, conversation, form, request_timer):
+        """
+        Guarda el mensaje del usuario (con la predicción de la CNN si trae imágenes) y arma el input
+        para el LLM. Devuelve (input_para_llm, None), o (None, mensaje_fijo_del_bot) si la CNN no
+        está disponible. Lo comparten el POST normal y el de streaming.
+        """
+        user_input_text = form.cleaned_data.get('user_input')
+        uploaded_images = form.cleaned_data.get('image_upload') or [] # Lista (puede traer varias imágenes)
+
+        user_message_obj = Message(
+            conversation=conversation,
+            content=user_input_text, 
+            is_bot=False
+        )
+        
+        cnn_prediction_info_for_llm = "" 
+        per_image_results = [(None, None) for _ in uploaded_images]
+        prediction_future = None
+
+        if uploaded_images:
+            cnn_image_processor = model_lifecycle.get_cnn_processor()
+            if cnn_image_processor is None:
+                user_message_obj.content = user_input_text if user_input_text else "[Imagen subida, pero procesador CNN no disponible]"
+                user_message_obj.image = uploaded_images[0]
+                user_message_obj.save()
+                _save_message_images(user_message_obj, uploaded_images, per_image_results)
+                fixed_bot_message = Message.objects.create(conversation=conversation, content="Lo siento, el servicio de análisis de imágenes no está disponible actualmente.", is_bot=True)
+                return None, fixed_bot_message
+
+            print(f"--- VIEW DEBUG: ChatWindowView POST - Procesando {len(uploaded_images)} imagen(es) subida(s): {[f.name for f in uploaded_images]}")
+            user_message_obj.image = uploaded_images[0] # La primera imagen queda como imagen principal del mensaje
+
+            # Un solo forward pass para todas las imágenes, en otro hilo mientras se escriben las imágenes y el Message.
+            # Toma el lugar en el limitador de la CNN antes de guardar nada (AdmissionRejected -> 429 sin escrituras)
+            prediction_future = cnn_image_processor.submit_prediction(uploaded_images)
+
+        with request_timer.stage("save"): # Escritura al storage + filas Message/MessageImage
+            user_message_obj.save()
+            message_images = _save_message_images(user_message_obj, uploaded_images, per_image_results) if uploaded_images else []
+
+        if prediction_future is not None:
+            with request_timer.stage("cnn_wait"):
+                (predicted_desease_obj, confidence_percent, per_image_results), cnn_ms = prediction_future.result()
+            request_timer.record_overlapped("cnn", cnn_ms, request_timer.stages["cnn_wait"])
+            with request_timer.stage("save_prediction"):
+                _apply_cnn_predictions(user_message_obj, message_images, predicted_desease_obj, confidence_percent, per_image_results)
+            cnn_prediction_info_for_llm = turn_input.cnn_context_for_llm(uploaded_images, predicted_desease_obj, confidence_percent, per_image_results)
+
+        final_input_for_llm = turn_input.final_input_for_llm(user_input_text, cnn_prediction_info_for_llm)
+        print(f"--- VIEW DEBUG: ChatWindowView POST - Input final para LLM: '{final_input_for_llm}'")
+        return final_input_for_llm, None
+
     def post(self, request, conversation_id): 
+        if getattr(settings, 'CHATBOT_BACKGROUND_JOBS', False):
+            return self._enqueue_user_turn(request, conversation_id)
+
+        derma_agent_llm = model_lifecycle.get_agent() # Espera si la carga en segundo plano aún no terminó
         if derma_agent_llm is None:
             messages = Message.objects.filter(conversation_id=conversation_id).order_by('timestamp') # Recuperar mensajes existentes
             form = MessageForm(request.POST, request.FILES)
@@ -93,83 +204,78 @@ class ChatWindowView(View):
                 'conversation': conversation, 'messages': messages, 'form': form, 
                 'user_identifier': user_identifier, 'medical_summary_exists': medical_summary_exists,
                 'conversation_id_str': str(conversation.id),
+                'use_async_chat': getattr(settings, 'CHATBOT_ASYNC_VIEWS', False),
                 'error_message': "Servicio de chat no disponible debido a un problema de inicialización del agente."
             }
             return render(request, self.template_name, context, status=503)
 
 
         conversation = get_object_or_404(Conversation, id=conversation_id)
+        rejection = admission.check_turn_admission(request) # Antes de decodificar imágenes o guardar nada
+        if rejection is not None:
+            return _busy_response(*rejection)
         form = MessageForm(request.POST, request.FILES) 
         user_identifier = request.session.get('chatbot_user_nickname', f"Usuario_{str(conversation.id)[:8]}")
 
-        if form.is_valid():
-            user_input_text = form.cleaned_data.get('user_input')
-            uploaded_image_file = form.cleaned_data.get('image_upload')
+        request_timer = StageTimer(f"POST conversación {str(conversation.id)[:8]}")
+        with request_timer.stage("validation"): # Incluye la única decodificación de las imágenes
+            form_is_valid = form.is_valid()
 
-            user_message_obj = Message(
-                conversation=conversation,
-                content=user_input_text, 
-                is_bot=False
-            )
+        if form_is_valid:
+            try:
+                final_input_for_llm, fixed_bot_message = self._prepare_user_turn(conversation, form, request_timer)
+            except AdmissionRejected as e: # CNN saturada: el mensaje del usuario no queda guardado
+                return _busy_response(admission.BUSY_BOT_MESSAGE, e.retry_after_seconds)
+            if fixed_bot_message is not None:
+                return redirect('chatbot:chat_window', conversation_id=conversation.id)
             
-            input_for_llm = user_input_text if user_input_text else ""
-            cnn_prediction_info_for_llm = "" 
-
-            if uploaded_image_file:
-                if cnn_image_processor is None:
-                    user_message_obj.content = user_input_text if user_input_text else "[Imagen subida, pero procesador CNN no disponible]"
-                    user_message_obj.image = uploaded_image_file
-                    user_message_obj.save()
-                    Message.objects.create(conversation=conversation, content="Lo siento, el servicio de análisis de imágenes no está disponible actualmente.", is_bot=True)
-                    return redirect('chatbot:chat_window', conversation_id=conversation.id)
-
-                print(f"--- VIEW DEBUG: ChatWindowView POST - Procesando imagen subida: {uploaded_image_file.name}")
-                user_message_obj.image = uploaded_image_file 
-
-                predicted_desease_obj, confidence_percent = cnn_image_processor.predict_from_image_file(uploaded_image_file)
-                
-                user_message_obj.cnn_confidence = confidence_percent
-                if predicted_desease_obj:
-                    user_message_obj.cnn_predicted_desease = predicted_desease_obj
-                    cnn_prediction_info_for_llm = (
-                        f"Contexto de imagen: El análisis preliminar de la imagen subida por el usuario sugiere "
-                        f"que podría estar relacionado con '{predicted_desease_obj.name_desease}' "
-                        f"(confianza de la CNN: {confidence_percent:.1f}%). "
-                        f"Considera esta información en tu diálogo y orientación."
+            telemetry_ids = [] # Filas de LLMTurnTelemetry que guarde este turno
+            with request_timer.stage("llm"):
+                try:
+                    bot_response_content_for_user = derma_agent_llm.get_response(
+                        user_input=final_input_for_llm,
+                        conversation_id=str(conversation.id),
+                        user_identifier=user_identifier,
+                        telemetry_ids=telemetry_ids,
                     )
-                    print(f"--- VIEW DEBUG: Predicción CNN: {predicted_desease_obj.name_desease}, Confianza: {confidence_percent:.1f}%")
-                else:
-                    cnn_prediction_info_for_llm = (
-                        "Contexto de imagen: El usuario subió una imagen, pero el análisis preliminar de la CNN "
-                        "no pudo determinar una condición específica de su lista de referencia. "
-                        "Procede con preguntas generales sobre la apariencia si es necesario."
-                    )
-                    print("--- VIEW DEBUG: Predicción CNN: No se pudo determinar una condición específica.")
-            
-            user_message_obj.save()
-
-            if user_input_text and cnn_prediction_info_for_llm:
-                final_input_for_llm = f"{cnn_prediction_info_for_llm} El usuario también comentó: '{user_input_text}'"
-            elif cnn_prediction_info_for_llm: 
-                final_input_for_llm = cnn_prediction_info_for_llm
-            elif user_input_text: 
-                final_input_for_llm = user_input_text
-            else: 
-                final_input_for_llm = "El usuario no proporcionó entrada." 
-            
-            print(f"--- VIEW DEBUG: ChatWindowView POST - Input final para LLM: '{final_input_for_llm}'")
+                except AdmissionRejected as e:
+                    print(f"--- VIEW DEBUG: ChatWindowView POST - Turno rechazado por admisión: {e} ---")
+                    bot_response_content_for_user = admission.BUSY_BOT_MESSAGE # El mensaje del usuario ya está guardado
             
-            bot_response_content_for_user = derma_agent_llm.get_response(
-                user_input=final_input_for_llm,
-                conversation_id=str(conversation.id),
-                user_identifier=user_identifier
-            )
-            
-            Message.objects.create(conversation=conversation, content=bot_response_content_for_user, is_bot=True)
+            bot_message = Message.objects.create(conversation=conversation, content=bot_response_content_for_user, is_bot=True)
+            llm_telemetry.attach_to_message(conversation.id, bot_message.id, telemetry_ids)
+            request_timer.log()
             
             return redirect('chatbot:chat_window', conversation_id=conversation.id)
         
-        messages = conversation.messages.all().order_by('timestamp')
+        return self._render_invalid_form(request, conversation, form, user_identifier)
+
+    def _enqueue_user_turn(self, request, conversation_id):
+        """
+        Modo cola (CHATBOT_BACKGROUND_JOBS): guarda el mensaje del usuario con sus imágenes, deja un
+        mensaje del bot pendiente y responde de inmediato. La CNN y el LLM los corre run_dermabot_worker.
+        """
+        conversation = get_object_or_404(Conversation, id=conversation_id)
+        rejection = admission.check_turn_admission(request, check_llm_capacity=False) # La cola absorbe la carga; solo el límite por sesión
+        if rejection is not None:
+            return _busy_response(*rejection)
+        form = MessageForm(request.POST, request.FILES)
+        user_identifier = request.session.get('chatbot_user_nickname', f"Usuario_{str(conversation.id)[:8]}")
+        if not form.is_valid():
+            return self._render_invalid_form(request, conversation, form, user_identifier)
+
+        uploaded_images = form.cleaned_data.get('image_upload') or []
+        user_message_obj = Message(conversation=conversation, content=form.cleaned_data.get('user_input'), is_bot=False)
+        if uploaded_images:
+            user_message_obj.image = uploaded_images[0]
+        user_message_obj.save()
+        if uploaded_images:
+            _save_message_images(user_message_obj, uploaded_images, [(None, None) for _ in uploaded_images]) # La predicción la completa el worker
+        enqueue_chat_turn(conversation, user_message_obj, user_identifier)
+        return redirect('chatbot:chat_window', conversation_id=conversation.id)
+
+    def _render_invalid_form(self, request, conversation, form, user_identifier):
+        messages = conversation.messages.select_related('chat_job').order_by('timestamp')
         medical_summary_exists = MedicalSummary.objects.filter(conversation=conversation).exists()
         context = {
             'conversation': conversation,
@@ -177,11 +283,35 @@ class ChatWindowView(View):
             'form': form, 
             'user_identifier': user_identifier,
             'medical_summary_exists': medical_summary_exists,
-            'conversation_id_str': str(conversation.id)
+            'conversation_id_str': str(conversation.id),
+            'use_async_chat': getattr(settings, 'CHATBOT_ASYNC_VIEWS', False),
+            'use_background_jobs': getattr(settings, 'CHATBOT_BACKGROUND_JOBS', False),
         }
         return render(request, self.template_name, context)
 
 
+class ChatJobStatusView(View):
+    """Estado de un trabajo de la cola (JSON liviano para el polling del chat): una sola consulta."""
+
+    def get(self, request, conversation_id, job_id):
+        job = (
+            ChatJob.objects.filter(id=job_id, conversation_id=conversation_id)
+            .values('status', 'attempts', 'max_attempts', 'bot_message_id', 'bot_message__content')
+            .first()
+        )
+        if job is None:
+            raise Http404("Trabajo no encontrado.")
+        is_finished = job['status'] in (ChatJob.STATUS_DONE, ChatJob.STATUS_FAILED)
+        return JsonResponse({
+            'job_id': str(job_id),
+            'status': job['status'],
+            'attempts': job['attempts'],
+            'max_attempts': job['max_attempts'],
+            'bot_message_id': job['bot_message_id'],
+            'content': job['bot_message__content'] if is_finished else None,
+        })
+
+
 class MedicalSummaryDetailView(View):
     html_template_name = 'chatbot/medical_summary_detail.html'
 
@@ -273,4 +403,268 @@ class ConversationHistoryListView(View):
             'is_paginated': page_obj.has_other_pages(),
             'page_title': 'Historial de Conversaciones con Resumen'
         }
-        return render(request, self.template_name, context)
\ No newline at end of file
+        return render(request, self.template_name, context)
+
+class AsyncChatWindowView(ChatWindowView):
+    """
+    Variante async de ChatWindowView para correr bajo ASGI (config/asgi.py): el turno del LLM usa
+    DermaBotAgent.aget_response (graph_app.ainvoke), la BD se usa con los métodos async del ORM y
+    la CNN y la decodificación de imágenes van a un executor para no bloquear el event loop.
+    Se activa con CHATBOT_ASYNC_VIEWS (el formulario del chat postea a esta URL).
+    """
+
+    async def get(self, request, conversation_id):
+        # El render del template recorre querysets: se hace en el hilo sync de siempre
+        return await sync_to_async(super().get)(request, conversation_id)
+
+    async def post(self, request, conversation_id):
+        derma_agent_llm = await sync_to_async(model_lifecycle.get_agent, thread_sensitive=False)()
+        if derma_agent_llm is None:
+            return await sync_to_async(super().post)(request, conversation_id) # Página 503 del flujo sync
+
+        conversation = await aget_object_or_404(Conversation, id=conversation_id)
+        rejection = admission.check_turn_admission(request) # Sin BD: solo contadores en memoria
+        if rejection is not None:
+            return _busy_response(*rejection)
+        form = MessageForm(request.POST, request.FILES)
+        user_identifier = await request.session.aget('chatbot_user_nickname', f"Usuario_{str(conversation.id)[:8]}")
+
+        request_timer = StageTimer(f"POST async conversación {str(conversation.id)[:8]}")
+        with request_timer.stage("validation"): # Decodifica las imágenes: CPU, fuera del event loop
+            form_is_valid = await sync_to_async(form.is_valid, thread_sensitive=False)()
+
+        if not form_is_valid:
+            return await sync_to_async(self._render_invalid_form)(request, conversation, form, user_identifier)
+
+        try:
+            final_input_for_llm, fixed_bot_message = await self._aprepare_user_turn(conversation, form, request_timer)
+        except AdmissionRejected as e:
+            return _busy_response(admission.BUSY_BOT_MESSAGE, e.retry_after_seconds)
+        if fixed_bot_message is None:
+            telemetry_ids = []
+            with request_timer.stage("llm"):
+                try:
+                    bot_response_content_for_user = await derma_agent_llm.aget_response(
+                        user_input=final_input_for_llm,
+                        conversation_id=str(conversation.id),
+                        user_identifier=user_identifier,
+                        telemetry_ids=telemetry_ids,
+                    )
+                except AdmissionRejected as e:
+                    print(f"--- VIEW DEBUG: AsyncChatWindowView POST - Turno rechazado por admisión: {e} ---")
+                    bot_response_content_for_user = admission.BUSY_BOT_MESSAGE
+            bot_message = await Message.objects.acreate(conversation=conversation, content=bot_response_content_for_user, is_bot=True)
+            await llm_telemetry.aattach_to_message(conversation.id, bot_message.id, telemetry_ids)
+            request_timer.log()
+        return redirect('chatbot:chat_window', conversation_id=conversation.id)
+
+    async def _aprepare_user_turn(self, conversation, form, request_timer):
+        """Versión async de ChatWindowView._prepare_user_turn."""
+        user_input_text = form.cleaned_data.get('user_input')
+        uploaded_images = form.cleaned_data.get('image_upload') or []
+
+        user_message_obj = Message(conversation=conversation, content=user_input_text, is_bot=False)
+        cnn_prediction_info_for_llm = ""
+        per_image_results = [(None, None) for _ in uploaded_images]
+        prediction_future = None
+
+        if uploaded_images:
+            cnn_image_processor = await sync_to_async(model_lifecycle.get_cnn_processor, thread_sensitive=False)()
+            if cnn_image_processor is None:
+                user_message_obj.content = user_input_text if user_input_text else "[Imagen subida, pero procesador CNN no disponible]"
+                user_message_obj.image = uploaded_images[0]
+                await user_message_obj.asave()
+                await _asave_message_images(user_message_obj, uploaded_images, per_image_results)
+                fixed_bot_message = await Message.objects.acreate(conversation=conversation, content="Lo siento, el servicio de análisis de imágenes no está disponible actualmente.", is_bot=True)
+                return None, fixed_bot_message
+
+            print(f"--- VIEW DEBUG: AsyncChatWindowView POST - Procesando {len(uploaded_images)} imagen(es) subida(s): {[f.name for f in uploaded_images]}")
+            user_message_obj.image = uploaded_images[0]
+
+            # La inferencia (y el índice de Desease, que puede ir a la BD) corre en el pool de la CNN mientras se guarda.
+            # submit_prediction puede esperar lugar en el limitador de la CNN: fuera del event loop
+            prediction_future = asyncio.wrap_future(
+                await sync_to_async(cnn_image_processor.submit_prediction, thread_sensitive=False)(uploaded_images)
+            )
+
+        with request_timer.stage("save"):
+            await user_message_obj.asave()
+            message_images = await _asave_message_images(user_message_obj, uploaded_images, per_image_results) if uploaded_images else []
+
+        if prediction_future is not None:
+            with request_timer.stage("cnn_wait"):
+                (predicted_desease_obj, confidence_percent, per_image_results), cnn_ms = await prediction_future
+            request_timer.record_overlapped("cnn", cnn_ms, request_timer.stages["cnn_wait"])
+            with request_timer.stage("save_prediction"):
+                await sync_to_async(_apply_cnn_predictions)(user_message_obj, message_images, predicted_desease_obj, confidence_percent, per_image_results)
+            cnn_prediction_info_for_llm = turn_input.cnn_context_for_llm(uploaded_images, predicted_desease_obj, confidence_percent, per_image_results)
+
+        final_input_for_llm = turn_input.final_input_for_llm(user_input_text, cnn_prediction_info_for_llm)
+        print(f"--- VIEW DEBUG: AsyncChatWindowView POST - Input final para LLM: '{final_input_for_llm}'")
+        return final_input_for_llm, None
+
+
+class ChatStreamView(ChatWindowView):
+    """
+    Mismo flujo que ChatWindowView.post, pero la respuesta del bot llega como Server-Sent Events
+    (eventos "token" con el texto visible y un "done" final con el contenido guardado).
+    La ficha médica (MedicalSummary) ya no va en la respuesta: se extrae aparte en segundo plano.
+    """
+    http_method_names = ['post']
+
+    def post(self, request, conversation_id):
+        derma_agent_llm = model_lifecycle.get_agent() # Espera si la carga en segundo plano aún no terminó
+        conversation = get_object_or_404(Conversation, id=conversation_id)
+        if derma_agent_llm is None:
+            return JsonResponse({'error': "Servicio de chat no disponible debido a un problema de inicialización del agente."}, status=503)
+
+        rejection = admission.check_turn_admission(request)
+        if rejection is not None:
+            return _busy_response(*rejection, as_json=True) # El JS muestra el aviso sin reenviar el formulario
+
+        form = MessageForm(request.POST, request.FILES)
+        user_identifier = request.session.get('chatbot_user_nickname', f"Usuario_{str(conversation.id)[:8]}")
+
+        request_timer = StageTimer(f"POST stream conversación {str(conversation.id)[:8]}")
+        with request_timer.stage("validation"):
+            form_is_valid = form.is_valid()
+        if not form_is_valid:
+            # El cliente JS vuelve al envío normal del formulario para mostrar los errores
+            return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+
+        try:
+            final_input_for_llm, fixed_bot_message = self._prepare_user_turn(conversation, form, request_timer)
+        except AdmissionRejected as e:
+            return _busy_response(admission.BUSY_BOT_MESSAGE, e.retry_after_seconds, as_json=True)
+        response = StreamingHttpResponse(
+            self._event_stream(derma_agent_llm, conversation, user_identifier, final_input_for_llm, fixed_bot_message, request_timer),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no' # Que nginx no acumule el stream
+        return response
+
+    def _event_stream(self, derma_agent_llm, conversation, user_identifier, final_input_for_llm, fixed_bot_message, request_timer):
+        if fixed_bot_message is not None:
+            yield _sse_event('done', {'content': fixed_bot_message.content})
+            return
+
+        telemetry_ids = []
+        agent_events = derma_agent_llm.stream_response(
+            user_input=final_input_for_llm,
+            conversation_id=str(conversation.id),
+            user_identifier=user_identifier,
+            telemetry_ids=telemetry_ids,
+        )
+        llm_started_at = time.perf_counter()
+        final_content = None
+        try:
+            for event, text in agent_events:
+                if event == 'done':
+                    final_content = text
+                    break
+                if 'llm_first_token' not in request_timer.stages:
+                    request_timer.stages['llm_first_token'] = (time.perf_counter() - llm_started_at) * 1000.0
+                yield _sse_event('token', {'text': text})
+        finally:
+            # Si el navegador cortó la conexión se termina la generación igual: el mensaje se guarda siempre
+            if final_content is None:
+                final_content = next((text for event, text in agent_events if event == 'done'), None)
+            request_timer.stages['llm'] = (time.perf_counter() - llm_started_at) * 1000.0
+            if final_content is not None:
+                bot_message = Message.objects.create(conversation=conversation, content=final_content, is_bot=True)
+                llm_telemetry.attach_to_message(conversation.id, bot_message.id, telemetry_ids)
+            request_timer.log()
+        yield _sse_event('done', {'content': final_content})
+
+
+class AsyncChatStreamView(AsyncChatWindowView):
+    """
+    Variante async de ChatStreamView (mismos eventos SSE) para ASGI: el texto llega por
+    DermaBotAgent.astream_response, así que la espera al LLM no retiene un hilo del worker.
+    Con CHATBOT_ASYNC_VIEWS el JS del chat manda los turnos a esta URL.
+    """
+    http_method_names = ['post']
+
+    async def post(self, request, conversation_id):
+        derma_agent_llm = await sync_to_async(model_lifecycle.get_agent, thread_sensitive=False)()
+        conversation = await aget_object_or_404(Conversation, id=conversation_id)
+        if derma_agent_llm is None:
+            return JsonResponse({'error': "Servicio de chat no disponible debido a un problema de inicialización del agente."}, status=503)
+
+        rejection = admission.check_turn_admission(request)
+        if rejection is not None:
+            return _busy_response(*rejection, as_json=True)
+
+        form = MessageForm(request.POST, request.FILES)
+        user_identifier = await request.session.aget('chatbot_user_nickname', f"Usuario_{str(conversation.id)[:8]}")
+
+        request_timer = StageTimer(f"POST stream async conversación {str(conversation.id)[:8]}")
+        with request_timer.stage("validation"):
+            form_is_valid = await sync_to_async(form.is_valid, thread_sensitive=False)()
+        if not form_is_valid:
+            return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+
+        try:
+            final_input_for_llm, fixed_bot_message = await self._aprepare_user_turn(conversation, form, request_timer)
+        except AdmissionRejected as e:
+            return _busy_response(admission.BUSY_BOT_MESSAGE, e.retry_after_seconds, as_json=True)
+        response = StreamingHttpResponse(
+            self._aevent_stream(derma_agent_llm, conversation, user_identifier, final_input_for_llm, fixed_bot_message, request_timer),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def _aevent_stream(self, derma_agent_llm, conversation, user_identifier, final_input_for_llm, fixed_bot_message, request_timer):
+        if fixed_bot_message is not None:
+            yield _sse_event('done', {'content': fixed_bot_message.content})
+            return
+
+        telemetry_ids = []
+        agent_events = derma_agent_llm.astream_response(
+            user_input=final_input_for_llm,
+            conversation_id=str(conversation.id),
+            user_identifier=user_identifier,
+            telemetry_ids=telemetry_ids,
+        )
+        llm_started_at = time.perf_counter()
+        final_content = None
+        try:
+            async for event, text in agent_events:
+                if event == 'done':
+                    final_content = text
+                    break
+                if 'llm_first_token' not in request_timer.stages:
+                    request_timer.stages['llm_first_token'] = (time.perf_counter() - llm_started_at) * 1000.0
+                yield _sse_event('token', {'text': text})
+        finally:
+            # Si el navegador cortó la conexión se termina la generación igual: el mensaje se guarda siempre
+            if final_content is None:
+                async for event, text in agent_events:
+                    if event == 'done':
+                        final_content = text
+                        break
+            request_timer.stages['llm'] = (time.perf_counter() - llm_started_at) * 1000.0
+            if final_content is not None:
+                bot_message = await Message.objects.acreate(conversation=conversation, content=final_content, is_bot=True)
+                await llm_telemetry.aattach_to_message(conversation.id, bot_message.id, telemetry_ids)
+            request_timer.log()
+        yield _sse_event('done', {'content': final_content})
+
+
+class AdmissionMetricsView(View):
+    """Métricas del control de admisión de este proceso: en vuelo, profundidad de cola y rechazos."""
+
+    def get(self, request):
+        return JsonResponse(admission.get_metrics())
+
+
+class ReadinessView(View):
+    """Para el balanceador: 200 solo cuando los modelos están cargados y calentados, 503 si no."""
+
+    def get(self, request):
+        model_lifecycle.start_background_load() # No-op si ya arrancó (p. ej. desde config/wsgi.py)
+        status = model_lifecycle.status()
+        return JsonResponse(status, status=200 if status['ready'] else 503)
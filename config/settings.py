@@ -110,3 +110,106 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 OPENAI_API_KEY = env('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
     print("ADVERTENCIA: La variable OPENAI_API_KEY no está definida en .env")
+
+# --- CNN: Micro-batching de inferencia (ver chatbot/services/cnn_service.py) ---
+CNN_BATCHING_ENABLED = env.bool('CNN_BATCHING_ENABLED', default=True)
+CNN_BATCH_MAX_SIZE = env.int('CNN_BATCH_MAX_SIZE', default=16) # Máximo de imágenes por forward pass
+CNN_BATCH_MAX_WAIT_MS = env.float('CNN_BATCH_MAX_WAIT_MS', default=5.0) # Ventana para juntar peticiones concurrentes
+CNN_INFERENCE_TIMEOUT_SECONDS = env.float('CNN_INFERENCE_TIMEOUT_SECONDS', default=30.0)
+
+# --- CNN: Caché de predicciones por contenido de imagen (memoria LRU + BD) ---
+CNN_PREDICTION_CACHE_ENABLED = env.bool('CNN_PREDICTION_CACHE_ENABLED', default=True)
+CNN_PREDICTION_CACHE_MAX_ENTRIES = env.int('CNN_PREDICTION_CACHE_MAX_ENTRIES', default=1024) # Tamaño del LRU en memoria
+CNN_PREDICTION_CACHE_PERSIST = env.bool('CNN_PREDICTION_CACHE_PERSIST', default=True) # Respaldo en la tabla CNNPredictionCache
+
+# --- CNN: Backend de inferencia ('keras', 'tflite' u 'onnx'; ver chatbot/services/cnn_backends.py) ---
+CNN_BACKEND = env.str('CNN_BACKEND', default='keras')
+CNN_BACKEND_QUANTIZED = env.bool('CNN_BACKEND_QUANTIZED', default=False) # Usar el archivo _int8 generado por convert_cnn_model
+CNN_BACKEND_MODEL_PATH = env.str('CNN_BACKEND_MODEL_PATH', default=None) # Ruta explícita al .tflite/.onnx (opcional)
+CNN_BACKEND_NUM_THREADS = env.int('CNN_BACKEND_NUM_THREADS', default=None)
+CNN_USE_SERVING_FUNCTION = env.bool('CNN_USE_SERVING_FUNCTION', default=True) # tf.function trazada en lugar de model.predict
+
+# --- CNN: Servidor de modelo fuera de proceso (python manage.py run_cnn_model_server) ---
+CNN_MODEL_SERVER_SOCKET = env.str('CNN_MODEL_SERVER_SOCKET', default=None) # Ej: /tmp/dermabot_cnn.sock; None = inferencia en proceso
+CNN_MODEL_SERVER_TIMEOUT_SECONDS = env.float('CNN_MODEL_SERVER_TIMEOUT_SECONDS', default=30.0)
+
+# --- Ciclo de vida de los modelos (carga en segundo plano + /dermabot/health/ready) ---
+DERMABOT_PRELOAD_MODELS = env.bool('DERMABOT_PRELOAD_MODELS', default=True) # Cargar y calentar al arrancar el worker
+DERMABOT_MODEL_LOAD_WAIT_SECONDS = env.float('DERMABOT_MODEL_LOAD_WAIT_SECONDS', default=60.0) # Espera máx. de una petición si aún carga
+
+# --- Índice en memoria de Desease por cnn_prediction_index (chatbot/services/desease_index.py) ---
+DESEASE_INDEX_TTL_SECONDS = env.int('DESEASE_INDEX_TTL_SECONDS', default=300) # Reconstrucción periódica del índice de Desease y del prompt de sistema en memoria (sin caché compartido entre procesos)
+
+# --- Chat: varias imágenes por mensaje (un solo forward pass, predicción agregada) ---
+CHATBOT_MAX_IMAGES_PER_MESSAGE = env.int('CHATBOT_MAX_IMAGES_PER_MESSAGE', default=5)
+
+# --- Pipeline de subida de imágenes (chatbot/services/image_pipeline.py) ---
+CHATBOT_MAX_IMAGE_PIXELS = env.int('CHATBOT_MAX_IMAGE_PIXELS', default=40_000_000) # Se rechaza antes de decodificar
+CHATBOT_IMAGE_DRAFT_DECODE = env.bool('CHATBOT_IMAGE_DRAFT_DECODE', default=True) # JPEG: decodificar directo a ~tamaño del modelo
+
+# --- Memoria de conversación del agente (chatbot/services/conversation_memory.py) ---
+CHATBOT_MEMORY_MAX_THREADS = env.int('CHATBOT_MEMORY_MAX_THREADS', default=1000) # Hilos en memoria por worker (LRU)
+CHATBOT_MEMORY_TTL_SECONDS = env.int('CHATBOT_MEMORY_TTL_SECONDS', default=3600) # Hilo inactivo se desaloja (0 = sin TTL)
+CHATBOT_MEMORY_MAX_MB = env.int('CHATBOT_MEMORY_MAX_MB', default=256) # Techo aproximado (bytes serializados) por worker
+
+# --- Ventana de historial por tokens (ConversationContextManager en openai_agent_service.py) ---
+CHATBOT_HISTORY_TOKEN_BUDGET = env.int('CHATBOT_HISTORY_TOKEN_BUDGET', default=2000) # Al pasarlo, se compacta a la mitad
+CHATBOT_HISTORY_SUMMARY_MAX_TOKENS = env.int('CHATBOT_HISTORY_SUMMARY_MAX_TOKENS', default=300) # Largo del resumen rodante
+
+# --- Vistas async (AsyncChatWindowView; tiene sentido solo sirviendo con ASGI: config/asgi.py) ---
+CHATBOT_ASYNC_VIEWS = env.bool('CHATBOT_ASYNC_VIEWS', default=False) # El formulario y el stream SSE del chat usan las vistas async
+OPENAI_BASE_URL = env.str('OPENAI_BASE_URL', default=None) # Opcional: proxy o servidor stub local (loadtest_chat)
+
+# --- Cola de trabajos del chat en la BD (chatbot/services/chat_jobs.py; python manage.py run_dermabot_worker) ---
+CHATBOT_BACKGROUND_JOBS = env.bool('CHATBOT_BACKGROUND_JOBS', default=False) # El POST responde al instante; CNN + LLM en el worker
+CHATBOT_JOB_MAX_ATTEMPTS = env.int('CHATBOT_JOB_MAX_ATTEMPTS', default=3)
+CHATBOT_JOB_VISIBILITY_TIMEOUT_SECONDS = env.int('CHATBOT_JOB_VISIBILITY_TIMEOUT_SECONDS', default=300) # Tras esto otro worker retoma el trabajo
+CHATBOT_JOB_RETRY_BACKOFF_SECONDS = env.float('CHATBOT_JOB_RETRY_BACKOFF_SECONDS', default=5.0) # Espera base (se duplica por intento)
+CHATBOT_WORKER_CONCURRENCY = env.int('CHATBOT_WORKER_CONCURRENCY', default=4) # Trabajos en paralelo por worker
+CHATBOT_WORKER_POLL_SECONDS = env.float('CHATBOT_WORKER_POLL_SECONDS', default=1.0)
+
+# --- Caché de respuestas a preguntas generales (chatbot/services/response_cache.py) ---
+CHATBOT_RESPONSE_CACHE_ENABLED = env.bool('CHATBOT_RESPONSE_CACHE_ENABLED', default=True) # Solo 1er turno, sin imagen, no personal
+CHATBOT_RESPONSE_CACHE_SIMILARITY = env.float('CHATBOT_RESPONSE_CACHE_SIMILARITY', default=0.85) # Coseno TF-IDF (n-gramas de caracteres)
+CHATBOT_RESPONSE_CACHE_TTL_SECONDS = env.int('CHATBOT_RESPONSE_CACHE_TTL_SECONDS', default=86400)
+CHATBOT_RESPONSE_CACHE_MAX_ENTRIES = env.int('CHATBOT_RESPONSE_CACHE_MAX_ENTRIES', default=500)
+
+# --- Ficha médica en segundo plano (chatbot/services/medical_summary.py) ---
+CHATBOT_SUMMARY_WORKERS = env.int('CHATBOT_SUMMARY_WORKERS', default=2) # Hilos para la extracción estructurada de MedicalSummary
+
+# --- Cliente HTTP compartido del LLM (chatbot/services/llm_transport.py; python manage.py loadtest_llm_transport) ---
+CHATBOT_LLM_MAX_CONNECTIONS = env.int('CHATBOT_LLM_MAX_CONNECTIONS', default=20) # Pool httpx compartido por todas las llamadas
+CHATBOT_LLM_MAX_KEEPALIVE_CONNECTIONS = env.int('CHATBOT_LLM_MAX_KEEPALIVE_CONNECTIONS', default=10)
+CHATBOT_LLM_CONNECT_TIMEOUT_SECONDS = env.float('CHATBOT_LLM_CONNECT_TIMEOUT_SECONDS', default=5.0)
+CHATBOT_LLM_DEADLINE_SECONDS = env.float('CHATBOT_LLM_DEADLINE_SECONDS', default=30.0) # Plazo por llamada, reintentos incluidos
+CHATBOT_LLM_MAX_RETRIES = env.int('CHATBOT_LLM_MAX_RETRIES', default=2) # Errores de red, timeouts y 429/5xx
+CHATBOT_LLM_RETRY_BACKOFF_SECONDS = env.float('CHATBOT_LLM_RETRY_BACKOFF_SECONDS', default=0.5) # Base del backoff con jitter
+CHATBOT_LLM_HEDGING_ENABLED = env.bool('CHATBOT_LLM_HEDGING_ENABLED', default=False) # Réplica de la petición si supera el p95
+CHATBOT_LLM_HEDGE_PERCENTILE = env.float('CHATBOT_LLM_HEDGE_PERCENTILE', default=95.0)
+CHATBOT_LLM_HEDGE_MIN_SAMPLES = env.int('CHATBOT_LLM_HEDGE_MIN_SAMPLES', default=20) # Latencias observadas antes de activar el hedging
+
+# --- Telemetría por llamada al LLM (chatbot/services/llm_telemetry.py; admin "Telemetría de Llamadas al LLM") ---
+CHATBOT_LLM_TELEMETRY_ENABLED = env.bool('CHATBOT_LLM_TELEMETRY_ENABLED', default=True) # Una fila LLMTurnTelemetry por turno
+CHATBOT_LLM_TELEMETRY_ADMIN_DAYS = env.int('CHATBOT_LLM_TELEMETRY_ADMIN_DAYS', default=14) # Días con percentiles en el admin
+
+# --- Control de admisión (chatbot/services/admission.py; métricas en /dermabot/health/admission) ---
+CHATBOT_LLM_MAX_IN_FLIGHT = env.int('CHATBOT_LLM_MAX_IN_FLIGHT', default=16) # Turnos del LLM a la vez por proceso (0 = sin tope)
+CHATBOT_LLM_MAX_QUEUE = env.int('CHATBOT_LLM_MAX_QUEUE', default=32) # Esperando lugar; con la cola llena se responde 429 enseguida
+# Peticiones a la CNN a la vez por proceso (0 = sin tope). Cada una ocupa su lugar también mientras espera que
+# CNNBatchScheduler arme el lote, así que conviene >= CNN_BATCH_MAX_SIZE; el doble deja armar un lote mientras
+# corre el anterior. Si es menor se respeta y los lotes se recortan a este tope (admission.cnn_batch_max_size).
+CHATBOT_CNN_MAX_IN_FLIGHT = env.int('CHATBOT_CNN_MAX_IN_FLIGHT', default=32)
+CHATBOT_CNN_MAX_QUEUE = env.int('CHATBOT_CNN_MAX_QUEUE', default=32)
+CHATBOT_ADMISSION_QUEUE_TIMEOUT_SECONDS = env.float('CHATBOT_ADMISSION_QUEUE_TIMEOUT_SECONDS', default=5.0) # Espera máxima en cola
+CHATBOT_SESSION_TURNS_PER_MINUTE = env.int('CHATBOT_SESSION_TURNS_PER_MINUTE', default=12) # Token bucket por sesión (0 = sin límite)
+CHATBOT_SESSION_TURN_BURST = env.int('CHATBOT_SESSION_TURN_BURST', default=5) # Turnos seguidos permitidos antes de limitar
+# Proxies inversos delante de Django (nginx, balanceador). Con N > 0 los turnos sin sesión se limitan por la IP
+# que el primero de ellos agregó a X-Forwarded-For; con 0 por REMOTE_ADDR (solo si Django recibe las conexiones directo).
+CHATBOT_TRUSTED_PROXY_COUNT = env.int('CHATBOT_TRUSTED_PROXY_COUNT', default=0)
+
+# --- Turnos triviales sin LLM: saludos, gracias, despedidas, vacíos (chatbot/services/trivial_turns.py) ---
+CHATBOT_TRIVIAL_TURNS_ENABLED = env.bool('CHATBOT_TRIVIAL_TURNS_ENABLED', default=True)
+CHATBOT_TRIVIAL_TURNS_MAX_CHARS = env.int('CHATBOT_TRIVIAL_TURNS_MAX_CHARS', default=60) # Mensajes más largos siempre van al LLM
+
+# --- CNN en paralelo con el guardado del mensaje (CNNProcessor.submit_prediction) ---
+CHATBOT_CNN_OVERLAP_WORKERS = env.int('CHATBOT_CNN_OVERLAP_WORKERS', default=8) # Hilos del pool; conviene >= CHATBOT_CNN_MAX_IN_FLIGHT
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# Precarga de los modelos solo en los procesos que sirven peticiones (gunicorn/uvicorn y el proceso hijo
+# de runserver, que importa este módulo). manage.py, los scripts con django.setup() y los tests no la disparan.
+from chatbot.services.model_lifecycle import preload_models  # noqa: E402
+
+preload_models()